@@ -0,0 +1,736 @@
+"""
+"benchmark.py"
+Forum Server Benchmarks
+Usage: python3 benchmark.py locks [--workers 1,2,4,8,16,32] [--ops N]
+       python3 benchmark.py transfer [--sizes 1M,10M,100M,1G,2G]
+       python3 benchmark.py chunked [--rtts 0,10,50,100] [--streams 1,2,4,8]
+       python3 benchmark.py batch [--rtts 0,10,50] [--commands 200]
+       python3 benchmark.py scaling [--workers 1,2,4,8,16] [--clients 16]
+       python3 benchmark.py compression [--rtts 0,20] [--size 16M]
+       python3 benchmark.py smallfiles [--rtts 0,10,50] [--files 200]
+       python3 benchmark.py protocol [--commands 100000]
+"""
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import contextmanager, redirect_stdout
+from socket import *
+from threading import Thread, Timer
+import argparse
+import os
+import random
+import tempfile
+import time
+
+import client
+import loadgen
+import server
+
+
+@contextmanager
+def quiet():
+    # The client prints status lines, keep them off the terminal
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        yield
+
+
+@contextmanager
+def fresh_server(base_dir):
+    # Run the server's storage in an empty scratch directory
+    old_cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(dir=base_dir) as workdir:
+        os.chdir(workdir)
+        server.thread_metadata.clear()
+        server.dirty_threads.clear()
+        server.wal = server.WriteAheadLog(server.WAL_PREFIX)
+        server.thread_locks = server.LockManager()
+        try:
+            with quiet():
+                server.load_threads()
+            yield workdir
+        finally:
+            server.wal.close()
+            os.chdir(old_cwd)
+
+
+def parse_counts(text):
+    return [int(n) for n in text.split(",") if n]
+
+
+def parse_size(text):
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    text = text.strip().upper()
+    if text[-1:] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def parse_sizes(text):
+    return [parse_size(n) for n in text.split(",") if n]
+
+
+def format_size(size):
+    for unit, scale in (("G", 1 << 30), ("M", 1 << 20), ("K", 1 << 10)):
+        if size >= scale and size % scale == 0:
+            return f"{size // scale}{unit}"
+    return str(size)
+
+
+def bench_locks(args):
+    titles = [f"bench{i}" for i in range(args.threads)]
+    hot = titles[0]
+    rng = random.Random(args.seed)
+    ops = []
+    for _ in range(args.ops):
+        if rng.random() < args.read_ratio:
+            ops.append(("RDT", hot))
+        else:
+            ops.append(("MSG", rng.choice(titles)))
+
+    def run(op):
+        command, title = op
+        if command == "RDT":
+            return server.read_thread(None, None, title)
+        return server.post_message("bench", None, title, "load test message")
+
+    print(f"{args.ops} ops, {args.threads} threads, "
+          f"{args.read_ratio:.0%} RDT on '{hot}', rest MSG")
+    print(f"{'workers':>8} {'ops/s':>10} {'speedup':>8}")
+    baseline = None
+    for workers in args.workers:
+        with fresh_server(args.dir), quiet():
+            for title in titles:
+                server.create_thread("bench", None, title)
+                server.post_message("bench", None, title, "first")
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(run, ops, chunksize=16))
+            elapsed = time.perf_counter() - start
+        rate = args.ops / elapsed
+        baseline = baseline or rate
+        print(f"{workers:>8} {rate:>10.0f} {rate / baseline:>7.2f}x")
+
+
+# Download path before user-006: 4096-byte read()/sendall() on the server,
+# 1024-byte recv() plus a print per chunk on the client
+def legacy_send(conn, path):
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(4096)
+            if not data:
+                break
+            conn.sendall(data)
+
+
+def legacy_recv(conn, path, log):
+    with open(path, "wb") as f:
+        while True:
+            data = conn.recv(1024)
+            if not data:
+                break
+            f.write(data)
+            print(f"Received '{path}'", file=log)
+
+
+# Current download path: socket.sendfile() on the server, recv_into() a
+# preallocated buffer on the client
+def zero_copy_send(conn, path):
+    with open(path, "rb") as f:
+        conn.sendfile(f)
+
+
+def buffered_recv(conn, path, log):
+    buffer = bytearray(1024 * 1024)
+    view = memoryview(buffer)
+    with open(path, "wb") as f:
+        while True:
+            size = conn.recv_into(buffer)
+            if not size:
+                break
+            f.write(view[:size])
+
+
+def time_transfer(src, dst, send, recv):
+    listener = socket(AF_INET, SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+
+    def serve():
+        conn, _ = listener.accept()
+        with conn:
+            send(conn, src)
+
+    sender = Thread(target=serve, daemon=True)
+    sender.start()
+    start = time.perf_counter()
+    with socket(AF_INET, SOCK_STREAM) as conn, open(os.devnull, "w") as log:
+        conn.connect(listener.getsockname())
+        recv(conn, dst, log)
+    elapsed = time.perf_counter() - start
+    sender.join()
+    listener.close()
+    return elapsed
+
+
+def bench_transfer(args):
+    paths = [("before", legacy_send, legacy_recv),
+             ("after", zero_copy_send, buffered_recv)]
+    print(f"{'size':>6} " + " ".join(f"{name + ' MB/s':>12}"
+                                     for name, _, _ in paths))
+    with tempfile.TemporaryDirectory(dir=args.dir) as workdir:
+        src = os.path.join(workdir, "source.bin")
+        dst = os.path.join(workdir, "received.bin")
+        for size in args.sizes:
+            with open(src, "wb") as f:
+                for offset in range(0, size, 1 << 20):
+                    f.write(os.urandom(min(1 << 20, size - offset)))
+            rates = []
+            for _, send, recv in paths:
+                elapsed = time_transfer(src, dst, send, recv)
+                if os.path.getsize(dst) != size:
+                    raise RuntimeError("transfer was truncated")
+                os.remove(dst)
+                rates.append(size / elapsed / (1 << 20))
+            print(f"{format_size(size):>6} " +
+                  " ".join(f"{rate:>12.1f}" for rate in rates))
+
+
+def serve_transfers(listener):
+    while True:
+        try:
+            conn, addr = listener.accept()
+        except OSError:
+            return
+        Thread(target=server.file_transfer, args=(conn, addr),
+               daemon=True).start()
+
+
+def delay_proxy(listener, upstream, rtt, window):
+    # Crude long-fat-network model: each direction forwards at most
+    # `window` bytes per round trip, like a TCP connection whose send
+    # window is full, so one stream tops out at window / rtt
+    def pump(src, dst):
+        try:
+            while True:
+                data = src.recv(window)
+                if not data:
+                    break
+                if rtt:
+                    time.sleep(rtt)
+                dst.sendall(data)
+            dst.shutdown(SHUT_WR)
+        except OSError:
+            pass
+
+    while True:
+        try:
+            conn, _ = listener.accept()
+        except OSError:
+            return
+        out = create_connection(upstream)
+        Thread(target=pump, args=(conn, out), daemon=True).start()
+        Thread(target=pump, args=(out, conn), daemon=True).start()
+
+
+def bench_chunked(args):
+    print(f"{format_size(args.size)} download, {format_size(args.window)} "
+          f"window, {format_size(args.chunk_size)} chunks")
+    print(f"{'rtt ms':>6} " + " ".join(f"{f'{n} stream MB/s':>16}"
+                                      for n in args.streams))
+    with fresh_server(args.dir):
+        path = server.attachment_path("bench", "data.bin")
+        os.makedirs(os.path.dirname(path))
+        with open(path, "wb") as f:
+            for offset in range(0, args.size, 1 << 20):
+                f.write(os.urandom(min(1 << 20, args.size - offset)))
+        backend = socket(AF_INET, SOCK_STREAM)
+        backend.bind(("127.0.0.1", 0))
+        backend.listen(64)
+        Thread(target=serve_transfers, args=(backend,), daemon=True).start()
+        client.current_user = "bench"
+        client.CHUNK_SIZE = args.chunk_size
+        for rtt in args.rtts:
+            proxy = socket(AF_INET, SOCK_STREAM)
+            proxy.bind(("127.0.0.1", 0))
+            proxy.listen(64)
+            Thread(target=delay_proxy, daemon=True,
+                   args=(proxy, backend.getsockname(), rtt / 1000,
+                         args.window)).start()
+            client.SERVER_ADDRESS = proxy.getsockname()
+            rates = []
+            for streams in args.streams:
+                client.TRANSFER_STREAMS = streams
+                start = time.perf_counter()
+                with quiet():
+                    if streams == 1:
+                        client.download_attempt("bench", "data.bin",
+                                                "data.bin.part")
+                    else:
+                        client.download_chunked("bench", "data.bin")
+                elapsed = time.perf_counter() - start
+                if os.path.getsize("data.bin") != args.size:
+                    raise RuntimeError("transfer was truncated")
+                os.remove("data.bin")
+                rates.append(args.size / elapsed / (1 << 20))
+            proxy.close()
+            print(f"{rtt:>6} " + " ".join(f"{rate:>16.1f}" for rate in rates))
+        backend.close()
+
+
+def write_log_file(path, size, seed):
+    # Log-style lines, the kind of attachment compression is meant for
+    rng = random.Random(seed)
+    levels = ["INFO"] * 6 + ["DEBUG", "WARNING", "ERROR"]
+    paths = ["/threads", "/login", "/upload", "/download", "/messages"]
+    with open(path, "w") as f:
+        written = 0
+        while written < size:
+            line = (f"2026-10-18 12:{rng.randrange(60):02d}:"
+                    f"{rng.randrange(60):02d}.{rng.randrange(1000):03d} "
+                    f"{rng.choice(levels)} worker-{rng.randrange(8)} GET "
+                    f"{rng.choice(paths)} from 10.0.{rng.randrange(256)}."
+                    f"{rng.randrange(256)} status 200 took "
+                    f"{rng.randrange(500)} ms\n")
+            written += f.write(line[:size - written])
+
+
+def bench_compression(args):
+    codecs = [("off", 0), ("zlib", client.FLAG_ZLIB),
+              ("lzma", client.FLAG_LZMA)]
+    print(f"{format_size(args.size)} upload + download per file and codec, "
+          f"{format_size(args.window)} window per RTT when rtt > 0")
+    print(f"{'rtt ms':>6} {'file':>6} {'codec':>5} {'wire MB':>8} "
+          f"{'ratio':>6} {'upload s':>9} {'download s':>11}")
+    with fresh_server(args.dir):
+        with quiet():
+            server.create_thread("bench", None, "bench")
+        write_log_file("text.src", args.size, args.seed)
+        with open("binary.src", "wb") as f:
+            for offset in range(0, args.size, 1 << 20):
+                f.write(os.urandom(min(1 << 20, args.size - offset)))
+        backend = socket(AF_INET, SOCK_STREAM)
+        backend.bind(("127.0.0.1", 0))
+        backend.listen(64)
+        Thread(target=serve_transfers, args=(backend,), daemon=True).start()
+        client.current_user = "bench"
+        for rtt in args.rtts:
+            client.SERVER_ADDRESS = backend.getsockname()
+            proxy = None
+            if rtt:
+                proxy = socket(AF_INET, SOCK_STREAM)
+                proxy.bind(("127.0.0.1", 0))
+                proxy.listen(64)
+                Thread(target=delay_proxy, daemon=True,
+                       args=(proxy, backend.getsockname(), rtt / 1000,
+                             args.window)).start()
+                client.SERVER_ADDRESS = proxy.getsockname()
+            for kind in ("text", "binary"):
+                for name, codec in codecs:
+                    client.COMPRESSION = codec
+                    # A new name each time, uploads without a digest so
+                    # the server cannot skip the body as a duplicate
+                    fname = f"{kind}-{name}-{rtt}.dat"
+                    os.link(f"{kind}.src", fname)
+                    wire = server.metrics.bytes_in + server.metrics.bytes_out
+                    with quiet():
+                        start = time.perf_counter()
+                        status, _, message = client.upload_attempt(
+                            "bench", fname, args.size, 0, b"")
+                        upload = time.perf_counter() - start
+                        os.remove(fname)
+                        start = time.perf_counter()
+                        client.download_attempt("bench", fname,
+                                                f"{fname}.part")
+                        download = time.perf_counter() - start
+                    if status != client.STATUS_OK or \
+                            os.path.getsize(fname) != args.size:
+                        raise RuntimeError(f"transfer failed: {message}")
+                    os.remove(fname)
+                    wire = server.metrics.bytes_in + \
+                        server.metrics.bytes_out - wire
+                    print(f"{rtt:>6} {kind:>6} {name:>5} "
+                          f"{wire / (1 << 20):>8.1f} "
+                          f"{2 * args.size / wire:>5.1f}x {upload:>9.2f} "
+                          f"{download:>11.2f}")
+            if proxy:
+                proxy.close()
+        backend.close()
+        # RDT replies go over UDP, compressed for clients sending REQZ
+        with quiet():
+            for i in range(args.messages):
+                server.post_message("bench", None, "bench",
+                                    f"{i} " + "forum text " * 8)
+        reply = server.read_thread(None, None, "bench")
+        for name, compress in (("off", False), ("zlib", True)):
+            datagrams = server.fragment_reply(1, reply, compress)
+            print(f"RDT of {args.messages} messages, {name}: "
+                  f"{len(datagrams)} datagrams, "
+                  f"{sum(map(len, datagrams))} bytes")
+    client.COMPRESSION = 0
+
+
+def serve_commands(sock):
+    while True:
+        try:
+            data, addr = sock.recvfrom(65535)
+        except OSError:
+            return
+        server.executor.submit(server.process_udp_request_sync,
+                               sock, data, addr)
+
+
+def udp_delay_proxy(sock, upstream, rtt):
+    # Delays every datagram by half the RTT in each direction
+    out = socket(AF_INET, SOCK_DGRAM)
+    out.bind(("127.0.0.1", 0))
+    peer = []
+
+    def later(target, data, addr):
+        if rtt:
+            Timer(rtt / 2, target.sendto, (data, addr)).start()
+        else:
+            target.sendto(data, addr)
+
+    def replies():
+        while True:
+            try:
+                data, _ = out.recvfrom(65535)
+            except OSError:
+                return
+            later(sock, data, peer[0])
+
+    Thread(target=replies, daemon=True).start()
+    while True:
+        try:
+            data, addr = sock.recvfrom(65535)
+        except OSError:
+            out.close()
+            return
+        peer[:] = [addr]
+        later(out, data, upstream)
+
+
+def bench_batch(args):
+    print(f"{args.commands} MSG commands, one per round trip vs send_batch()")
+    print(f"{'rtt ms':>6} {'single s':>9} {'batched s':>10} {'speedup':>8}")
+    with fresh_server(args.dir):
+        backend = socket(AF_INET, SOCK_DGRAM)
+        backend.bind(("127.0.0.1", 0))
+        Thread(target=serve_commands, args=(backend,), daemon=True).start()
+        with quiet():
+            server.load_credentials()
+        server.credentials.register("bench", "bench")
+        for rtt in args.rtts:
+            proxy = socket(AF_INET, SOCK_DGRAM)
+            proxy.bind(("127.0.0.1", 0))
+            Thread(target=udp_delay_proxy, daemon=True,
+                   args=(proxy, backend.getsockname(), rtt / 1000)).start()
+            client.channel = client.CommandChannel(proxy.getsockname())
+            commands = [f"MSG bench bench{rtt} message {i}"
+                        for i in range(args.commands)]
+            with quiet():
+                client.send_command("LOGIN bench")
+                client.send_command("AUTH bench bench")
+                client.send_command(f"CRT bench bench{rtt}")
+                start = time.perf_counter()
+                for command in commands:
+                    client.send_command(command)
+                single = time.perf_counter() - start
+                start = time.perf_counter()
+                results = client.send_batch(commands)
+                batched = time.perf_counter() - start
+                client.send_command("XIT bench")
+            if not all(ok for ok, _ in results):
+                raise RuntimeError("batched command failed")
+            client.channel.close()
+            proxy.close()
+            print(f"{rtt:>6} {single:>9.3f} {batched:>10.3f} "
+                  f"{single / batched:>7.1f}x")
+        backend.close()
+        server.credentials.close()
+
+
+def command_client(address, index, titles, start, args):
+    # One client process: a user of its own, then RDT/MSG back to back
+    # from `start` for args.duration seconds; returns the commands done
+    rng = random.Random(args.seed + index)
+    user = f"bench{index}"
+    client.channel = client.CommandChannel(address)
+    with quiet():
+        client.send_command(f"REGISTER {user} bench")
+        time.sleep(max(0.0, start - time.time()))
+        done = 0
+        while time.time() < start + args.duration:
+            title = rng.choice(titles)
+            if rng.random() < args.read_ratio:
+                client.send_command(f"RDT {title} from 1 count 20")
+            else:
+                client.send_command(f"MSG {user} {title} message {done}")
+            done += 1
+    client.channel.close()
+    return done
+
+
+def bench_scaling(args):
+    print(f"{args.clients} client processes, {args.read_ratio:.0%} RDT / "
+          f"rest MSG over {args.threads} threads, {args.duration}s per run, "
+          f"{os.cpu_count()} CPUs")
+    print(f"{'workers':>8} {'ops/s':>10} {'speedup':>8}")
+    titles = [f"scale{i}" for i in range(args.threads)]
+    baseline = None
+    for workers in args.workers:
+        workdir = tempfile.TemporaryDirectory(dir=args.dir)
+        # Every client is user "bench", so no per-user rate limit
+        proc, address = loadgen.spawn_server(
+            workdir.name, "--workers", str(workers), "--log-level", "OFF",
+            "--rate", "0")
+        try:
+            client.channel = client.CommandChannel(address)
+            with quiet():
+                client.send_command("REGISTER bench bench")
+                client.send_batch([f"CRT bench {title}" for title in titles])
+            client.channel.close()
+            # Registering costs a password hash each, start together after
+            start = time.time() + 1 + args.clients * 0.1
+            with ProcessPoolExecutor(max_workers=args.clients) as pool:
+                futures = [pool.submit(command_client, address, i, titles,
+                                       start, args)
+                           for i in range(args.clients)]
+                done = sum(f.result() for f in futures)
+        finally:
+            proc.terminate()
+            proc.wait()
+            workdir.cleanup()
+        rate = done / args.duration
+        baseline = baseline or rate
+        print(f"{workers:>8} {rate:>10.0f} {rate / baseline:>7.2f}x")
+
+
+def bench_small_files(args):
+    print(f"{args.files} uploads of {format_size(args.size)}, UPD + a "
+          f"connection each vs queued on one --session "
+          f"({args.queued} at once)")
+    print(f"{'rtt ms':>6} {'per file s':>11} {'session s':>10} "
+          f"{'files/s':>8} {'speedup':>8}")
+    with fresh_server(args.dir):
+        commands = socket(AF_INET, SOCK_DGRAM)
+        commands.bind(("127.0.0.1", 0))
+        Thread(target=serve_commands, args=(commands,), daemon=True).start()
+        transfers = socket(AF_INET, SOCK_STREAM)
+        transfers.bind(("127.0.0.1", 0))
+        transfers.listen(64)
+        Thread(target=serve_transfers, args=(transfers,), daemon=True).start()
+        with quiet():
+            server.load_credentials()
+        server.credentials.register("bench", "bench")
+        for n in range(args.files):
+            with open(f"small{n}.bin", "wb") as f:
+                f.write(os.urandom(args.size))
+        for rtt in args.rtts:
+            command_address = commands.getsockname()
+            client.SERVER_ADDRESS = transfers.getsockname()
+            proxies = []
+            if rtt:
+                udp_proxy = socket(AF_INET, SOCK_DGRAM)
+                udp_proxy.bind(("127.0.0.1", 0))
+                Thread(target=udp_delay_proxy, daemon=True,
+                       args=(udp_proxy, commands.getsockname(),
+                             rtt / 1000)).start()
+                tcp_proxy = socket(AF_INET, SOCK_STREAM)
+                tcp_proxy.bind(("127.0.0.1", 0))
+                tcp_proxy.listen(64)
+                Thread(target=delay_proxy, daemon=True,
+                       args=(tcp_proxy, transfers.getsockname(), rtt / 1000,
+                             args.window)).start()
+                proxies = [udp_proxy, tcp_proxy]
+                command_address = udp_proxy.getsockname()
+                client.SERVER_ADDRESS = tcp_proxy.getsockname()
+            client.channel = client.CommandChannel(command_address)
+            client.current_user = "bench"
+            single, queued = f"single{rtt}", f"session{rtt}"
+            with quiet():
+                client.send_command("LOGIN bench")
+                client.send_command("AUTH bench bench")
+                client.send_command(f"CRT bench {single}")
+                client.send_command(f"CRT bench {queued}")
+                start = time.perf_counter()
+                for n in range(args.files):
+                    client.upload_file(f"{single} small{n}.bin")
+                per_file = time.perf_counter() - start
+                start = time.perf_counter()
+                client.QUEUED_TRANSFERS = args.queued
+                client.start_session()
+                for n in range(args.files):
+                    client.upload_file(f"{queued} small{n}.bin")
+                client.transfer_queue.shutdown(wait=True)
+                session = time.perf_counter() - start
+                client.session.close()
+                client.session = client.transfer_queue = None
+                client.send_command("XIT bench")
+            for title in (single, queued):
+                if len(server.thread_metadata[title]["files"]) != args.files:
+                    raise RuntimeError(f"uploads to {title} went missing")
+            client.channel.close()
+            for proxy in proxies:
+                proxy.close()
+            print(f"{rtt:>6} {per_file:>11.3f} {session:>10.3f} "
+                  f"{args.files / session:>8.0f} {per_file / session:>7.1f}x")
+        commands.close()
+        transfers.close()
+        server.credentials.close()
+
+
+# One of each command shape: plain fields, options, free text, no fields
+PROTOCOL_SAMPLES = [
+    ("MSG", ["networks", "the quick brown fox jumps over the lazy dog"]),
+    ("RDT", ["networks", "41", "20", "7"]),
+    ("EDT", ["networks", "3", "fixed a typo in the message"]),
+    ("DLT", ["networks", "3"]),
+    ("CRT", ["networks"]),
+    ("LST", [""]),
+    ("SRC", ["quick fox", "21", ""]),
+]
+
+
+def bench_protocol(args):
+    # Server-side parse and dispatch only, the part the wire format changes
+    print(f"{args.commands} commands per form, decode_command() plus the "
+          f"COMMAND_HANDLERS lookup")
+    print(f"{'command':>7} {'text B':>7} {'binary B':>9} {'text ns':>8} "
+          f"{'binary ns':>10} {'speedup':>8}")
+    client.current_user = "bench"
+    client_id = os.urandom(8).hex()
+    for command, fields in PROTOCOL_SAMPLES:
+        text = client.text_command(command, fields)
+        binary = client.encode_command(command, fields)
+        text_size = len(f"REQ {client_id} 12345 {text}".encode())
+        binary_size = client.BINARY_REQUEST.size + len(binary)
+        text = text.encode()
+        if server.decode_command(text) != server.decode_command(binary):
+            raise RuntimeError(f"{command} decodes differently")
+        timings = []
+        for data in (text, binary):
+            start = time.perf_counter()
+            for _ in range(args.commands):
+                name, decoded = server.decode_command(data)
+                server.COMMAND_HANDLERS[name]
+            timings.append((time.perf_counter() - start) / args.commands * 1e9)
+        print(f"{command:>7} {text_size:>7} {binary_size:>9} "
+              f"{timings[0]:>8.0f} {timings[1]:>10.0f} "
+              f"{timings[0] / timings[1]:>7.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Forum server benchmarks")
+    sub = parser.add_subparsers(dest="bench", required=True)
+    locks = sub.add_parser(
+        "locks", help="thread lock contention vs executor worker count")
+    locks.add_argument("--workers", type=parse_counts,
+                       default=[1, 2, 4, 8, 16, 32])
+    locks.add_argument("--ops", type=int, default=20000)
+    locks.add_argument("--threads", type=int, default=64)
+    locks.add_argument("--read-ratio", type=float, default=0.8)
+    locks.add_argument("--seed", type=int, default=9331)
+    locks.add_argument("--dir", default=".",
+                       help="where to create the scratch data directory")
+    transfer = sub.add_parser(
+        "transfer", help="download throughput, old vs zero-copy path")
+    transfer.add_argument("--sizes", type=parse_sizes,
+                          default=parse_sizes("1M,10M,100M,1G,2G"))
+    transfer.add_argument("--dir", default=".",
+                          help="where to create the scratch files")
+    chunked = sub.add_parser(
+        "chunked", help="download throughput vs RTT and parallel streams")
+    chunked.add_argument("--rtts", type=parse_counts, default=[0, 10, 50, 100],
+                         help="simulated round-trip times in ms")
+    chunked.add_argument("--streams", type=parse_counts, default=[1, 2, 4, 8])
+    chunked.add_argument("--size", type=parse_size, default=parse_size("64M"))
+    chunked.add_argument("--chunk-size", type=parse_size,
+                         default=parse_size("4M"))
+    chunked.add_argument("--window", type=parse_size, default=parse_size("256K"),
+                         help="bytes each simulated connection moves per RTT")
+    chunked.add_argument("--dir", default=".",
+                         help="where to create the scratch data directory")
+    batch = sub.add_parser(
+        "batch", help="bulk command latency, one per round trip vs BATCH")
+    batch.add_argument("--rtts", type=parse_counts, default=[0, 10, 50],
+                       help="simulated round-trip times in ms")
+    batch.add_argument("--commands", type=int, default=200)
+    batch.add_argument("--dir", default=".",
+                       help="where to create the scratch data directory")
+    scaling = sub.add_parser(
+        "scaling", help="command throughput vs server --workers processes")
+    scaling.add_argument("--workers", type=parse_counts,
+                         default=[1, 2, 4, 8, 16])
+    scaling.add_argument("--clients", type=int, default=16,
+                         help="client processes, each one user")
+    scaling.add_argument("--duration", type=float, default=10)
+    scaling.add_argument("--threads", type=int, default=64)
+    scaling.add_argument("--read-ratio", type=float, default=0.8)
+    scaling.add_argument("--seed", type=int, default=9331)
+    scaling.add_argument("--dir", default=".",
+                         help="where to create the scratch data directories")
+    compression = sub.add_parser(
+        "compression", help="bytes on the wire and transfer time per codec")
+    compression.add_argument("--rtts", type=parse_counts, default=[0, 20],
+                             help="simulated round-trip times in ms, 0 "
+                                  "connects directly")
+    compression.add_argument("--size", type=parse_size,
+                             default=parse_size("16M"))
+    compression.add_argument("--window", type=parse_size,
+                             default=parse_size("256K"),
+                             help="bytes the simulated link moves per RTT")
+    compression.add_argument("--messages", type=int, default=200,
+                             help="thread length for the RDT reply sizes")
+    compression.add_argument("--seed", type=int, default=9331)
+    compression.add_argument("--dir", default=".",
+                             help="where to create the scratch data directory")
+    small_files = sub.add_parser(
+        "smallfiles", help="small-file uploads, one connection each vs a "
+                           "transfer session")
+    small_files.add_argument("--rtts", type=parse_counts, default=[0, 10, 50],
+                             help="simulated round-trip times in ms, 0 "
+                                  "connects directly")
+    small_files.add_argument("--files", type=int, default=200)
+    small_files.add_argument("--size", type=parse_size,
+                             default=parse_size("4K"))
+    small_files.add_argument("--queued", type=int,
+                             default=client.QUEUED_TRANSFERS,
+                             help="session transfers running at once")
+    small_files.add_argument("--window", type=parse_size,
+                             default=parse_size("256K"),
+                             help="bytes the simulated link moves per RTT")
+    small_files.add_argument("--dir", default=".",
+                             help="where to create the scratch data directory")
+    protocol = sub.add_parser(
+        "protocol", help="command parse and dispatch cost, text vs binary")
+    protocol.add_argument("--commands", type=int, default=100000)
+    args = parser.parse_args()
+    if args.bench == "locks":
+        bench_locks(args)
+    elif args.bench == "transfer":
+        bench_transfer(args)
+    elif args.bench == "chunked":
+        bench_chunked(args)
+    elif args.bench == "batch":
+        bench_batch(args)
+    elif args.bench == "scaling":
+        bench_scaling(args)
+    elif args.bench == "compression":
+        bench_compression(args)
+    elif args.bench == "smallfiles":
+        bench_small_files(args)
+    elif args.bench == "protocol":
+        bench_protocol(args)
+
+
+if __name__ == "__main__":
+    main()
+
+# python benchmark.py locks --workers 1,2,4,8,16,32
+# python benchmark.py transfer --sizes 1M,10M,100M,1G,2G
+# python benchmark.py chunked --rtts 0,10,50,100 --streams 1,2,4,8
+# python benchmark.py batch --rtts 0,10,50 --commands 200
+# python benchmark.py scaling --workers 1,2,4,8,16 --clients 16
+# python benchmark.py compression --rtts 0,20 --size 16M
+# python benchmark.py smallfiles --rtts 0,10,50 --files 200
+# python benchmark.py protocol --commands 100000
@@ -1,38 +1,818 @@
 """
 "client.py"
 Forum Application Client
-Usage: python3 client.py SERVER_IP SERVER_PORT
+Usage: python3 client.py SERVER_IP SERVER_PORT [--streams N] [--chunk-size BYTES]
+                        [--compress zlib|lzma] [--session] [--text-commands]
 """
 
 from socket import *
-from threading import Thread
-import sys
+from threading import Thread, Lock, Condition
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty
+from collections import deque
+import argparse
 import os
+import time
+import struct
+import hashlib
+import json
+import lzma
+import zlib
 
-if len(sys.argv) != 3:
-    print("\n=== Usage: python3 client.py SERVER_IP SERVER_PORT ====\n")
-    exit(1)
-# Server configuration
-SERVER_HOST = sys.argv[1]
-SERVER_PORT = int(sys.argv[2])
-SERVER_ADDRESS = (SERVER_HOST, SERVER_PORT)
+# Server configuration, set from the command line in main()
+SERVER_ADDRESS = None
 # Global variables
-udp_socket = None  # For Thread operation
+channel = None  # CommandChannel to the server, opened in main()
 tcp_socket = None  # For UPD/DWN implementation
+session = None  # TransferSession carrying all transfers (--session)
+transfer_queue = None  # runs UPD/DWN in the background with a session
 current_user = None
+read_cache = {}  # {"LST" or thread title: (version, text)} for conditional reads
 is_client_running = False
+TRANSFER_BUFFER = 1024 * 1024  # bytes per recv_into() on downloads
+PROGRESS_INTERVAL = 1.0  # seconds between download progress lines
+VERIFY_UPLOADS = True  # send a SHA-256 of each upload, which the server
+                       # checks and uses to skip content it already stores
+TRANSFER_RETRIES = 5  # attempts per transfer, resuming after each drop
+TRANSFER_TIMEOUT = 30  # seconds a transfer may stall before it is retried
+TRANSFER_STREAMS = 1  # parallel TCP connections for large files (--streams)
+CHUNK_SIZE = 8 * 1024 * 1024  # bytes per chunk in parallel mode (--chunk-size)
+COMPRESSION = 0  # codec offered for transfers (--compress), 0 sends raw bytes
+COMPRESS_REPLIES = True  # ask for long command replies zlib-compressed
+BINARY_COMMANDS = True  # offer binary commands at LOGIN (--text-commands)
+# TCP transfer header, must match server.py: magic, version, op/status,
+# flags, body size, byte offset, length of the NUL-separated names, SHA-256
+TRANSFER_HEADER = struct.Struct("!2sBBBQQH32s")
+TRANSFER_MAGIC = b"FT"
+TRANSFER_VERSION = 2
+OP_UPLOAD = 1
+OP_DOWNLOAD = 2
+OP_MANIFEST = 3
+OP_CHUNK = 4
+OP_COMMIT = 5
+OP_STAT = 6
+OP_SESSION = 7
+STATUS_OK = 0
+FLAG_CHECKSUM = 0x01
+FLAG_RESUME = 0x02
+FLAG_ZLIB = 0x04
+FLAG_LZMA = 0x08
+CODECS = {"zlib": FLAG_ZLIB, "lzma": FLAG_LZMA}
+ZLIB_LEVEL = 1
+LZMA_PRESET = 1
+COMPRESS_FRAME = struct.Struct("!I")
+MAX_COMPRESS_FRAME = 4 * 1024 * 1024
+COMPRESS_SAMPLE = 64 * 1024
+COMPRESS_MIN_SAVING = 0.1
+COMPRESSED_TYPES = {
+    ".gz", ".tgz", ".bz2", ".xz", ".lzma", ".zst", ".zip", ".7z", ".rar",
+    ".jar", ".apk", ".docx", ".xlsx", ".pptx", ".odt", ".epub", ".pdf",
+    ".png", ".jpg", ".jpeg", ".gif", ".webp", ".heic", ".mp3", ".aac",
+    ".ogg", ".flac", ".mp4", ".m4a", ".mkv", ".mov", ".avi", ".webm"}
+MUX_FRAME = struct.Struct("!IBI")  # session frame: stream id, kind, length
+MUX_DATA = 0
+MUX_CLOSE = 1
+MUX_CHUNK = 256 * 1024
+MUX_WINDOW = 1024 * 1024  # bytes buffered per stream before reading stalls
+QUEUED_TRANSFERS = 16  # queued transfers running at once over the session
+REPLY_ZLIB = b"\0z"  # prefix of a compressed command reply
+# Command retransmission (RFC 6298 style timer)
+COMMAND_ATTEMPTS = 6  # sends per command before giving up
+INITIAL_RTO = 1.0  # seconds, until the first RTT sample
+MIN_RTO = 0.5  # above a password hash or slow fsync after fast LOGINs
+MAX_RTO = 8.0
+RDT_PAGE_SIZE = 100  # messages fetched per RDT request
+MAX_BATCH = 64  # commands per BATCH request, must match server.py
+BATCH_BYTES = 8192  # request size at which send_batch() starts a new BATCH
+PUSH_MEMORY = 256  # recent push ids kept to spot resends
+BUSY_REPLY = "BUSY, retry after "  # the server's admission control said no
+BUSY_RETRIES = 10  # waits on BUSY per command before giving up
+# Command forms, must match server.py: opcode, fields, trailing options
+COMMAND_FORMS = {
+    "LOGIN": (1, 1, ("binary",)),
+    "AUTH": (2, 2, ()),
+    "REGISTER": (3, 2, ()),
+    "XIT": (4, 0, ()),
+    "CRT": (5, 1, ()),
+    "LST": (6, 0, ("if-version",)),
+    "MSG": (7, 2, ()),
+    "RDT": (8, 1, ("from", "count", "if-version")),
+    "SRC": (9, 1, ("from", "count")),
+    "EDT": (10, 3, ()),
+    "DLT": (11, 2, ()),
+    "RMV": (12, 1, ()),
+    "SUB": (13, 1, ()),
+    "UNSUB": (14, 1, ()),
+    "UPD": (15, 2, ()),
+    "DWN": (16, 2, ()),
+    "SES": (17, 0, ()),
+    "STATS": (18, 0, ()),
+}
+TEXT_WITH_USER = {"XIT", "CRT", "MSG", "EDT", "DLT", "RMV", "UPD", "DWN",
+                  "SUB", "UNSUB"}  # text forms naming the sender first
+BINARY_MAGIC = b"\0B"
+BINARY_VERSION = 1
+BINARY_REQUEST = struct.Struct("!2sBB8sI")  # magic, version, flags, client id, seq
+BINARY_COMMAND = struct.Struct("!xBB")  # NUL, opcode, field count
+BINARY_FIELD = struct.Struct("!H")
+BINARY_REPLY = struct.Struct("!2sBIHH")  # magic, version, seq, fragment, count
+BINARY_ZLIB = 0x01
 
 
-def send_command(command):
-    global udp_socket
-    for _ in range(6):
+class CommandChannel:
+    """
+    UDP commands sent as "REQ <client id> <seq> <command>" ("REQZ" when
+    long replies may come back compressed). The server
+    answers "RSP <seq> <reply>" and replays the same reply for a
+    retransmit, so a resent MSG or DLT never runs twice. Replies for any
+    other seq (late answers to an earlier command) are dropped. The
+    retransmission timeout tracks the measured RTT (SRTT/RTTVAR) and only
+    takes samples from commands that were not retransmitted (Karn's rule).
+    It backs off exponentially while a command goes unanswered, and drops
+    back to the estimate once any reply gets through. A "BUSY, retry
+    after <seconds>" reply means the command did not run: the same
+    datagram is sent again after the pause, without using up an attempt.
+    A background thread reads the socket: "PSH" datagrams (changes to
+    threads we subscribed to) are acknowledged and passed to on_push,
+    everything else is queued for request(). Once LOGIN has agreed on it
+    (`binary`), commands given as fields go out as BINARY_REQUEST with
+    the same client id and seq, and come back as BINARY_REPLY fragments.
+    """
+
+    def __init__(self, address):
+        self.address = address
+        self.sock = socket(AF_INET, SOCK_DGRAM)
+        self.sock.bind(('', 0))
+        # Room for a burst of reply fragments
+        self.sock.setsockopt(SOL_SOCKET, SO_RCVBUF, 1024 * 1024)
+        self.client_id = os.urandom(8).hex()
+        self.binary = False  # send commands binary, see encode_command()
+        self.seq = 0
+        self.srtt = None
+        self.rttvar = None
+        self.estimate = INITIAL_RTO  # SRTT + 4 * RTTVAR, clamped
+        self.rto = INITIAL_RTO  # current timeout, including backoff
+        self.verbose = True  # print a line for every retransmission
+        self.retransmits = 0
+        self.timeouts = 0  # commands given up after COMMAND_ATTEMPTS
+        self.busy = 0  # BUSY replies waited out
+        self.replies = Queue()
+        self.on_push = None  # on_push(title, delta lines)
+        self.seen_pushes = deque(maxlen=PUSH_MEMORY)
+        self.closed = False
+        Thread(target=self.receive, daemon=True).start()
+
+    def receive(self):
+        while True:
+            try:
+                response, _ = self.sock.recvfrom(65535)
+            except OSError:
+                return
+            if self.closed:
+                return
+            if response.startswith(b"PSH "):
+                self.push_received(response)
+            else:
+                self.replies.put(response)
+
+    def push_received(self, datagram):
+        header, _, body = datagram.partition(b"\n")
+        try:
+            _, push_id, title = header.decode().split(" ", 2)
+        except ValueError:
+            return
+        self.sock.sendto(f"PSHACK {title} {push_id}".encode(), self.address)
+        # A resend means our acknowledgement was lost, it is shown once
+        if (title, push_id) in self.seen_pushes:
+            return
+        self.seen_pushes.append((title, push_id))
+        if self.on_push:
+            self.on_push(title, body.decode().split("\n"))
+
+    def update_rto(self, rtt):
+        if self.srtt is None:
+            self.srtt, self.rttvar = rtt, rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.estimate = min(max(self.srtt + 4 * self.rttvar, MIN_RTO),
+                            MAX_RTO)
+
+    def reply_piece(self, response):
+        # (index, count, bytes) of a reply to the current command, None for
+        # a stale reply to an earlier one
+        if response.startswith(BINARY_MAGIC):
+            try:
+                _, _, seq, index, count = BINARY_REPLY.unpack_from(response)
+            except struct.error:
+                return None
+            if seq != self.seq:
+                return None
+            return index, count, response[BINARY_REPLY.size:]
+        prefix = f"RSP {self.seq} ".encode()
+        if response.startswith(prefix):
+            return 0, 1, response[len(prefix):]
+        prefix = f"RSPF {self.seq} ".encode()
+        if not response.startswith(prefix):
+            return None
+        try:
+            index, count, piece = response[len(prefix):].split(b" ", 2)
+            return int(index), int(count), piece
+        except ValueError:
+            return None
+
+    def request(self, command, fields=None):
+        # A text command, or with `fields` a binary one
+        self.seq += 1
+        if fields is None:
+            envelope = "REQZ" if COMPRESS_REPLIES else "REQ"
+            datagram = \
+                f"{envelope} {self.client_id} {self.seq} {command}".encode()
+        else:
+            datagram = BINARY_REQUEST.pack(
+                BINARY_MAGIC, BINARY_VERSION,
+                BINARY_ZLIB if COMPRESS_REPLIES else 0,
+                bytes.fromhex(self.client_id), self.seq) + \
+                encode_command(command, fields)
+        # Long replies arrive as numbered fragments; pieces from every
+        # attempt count, and each new one restarts the timer
+        fragments = {}
+        arrived = None  # first reply datagram, for the RTT sample
+        attempt = busy_waits = 0
+        while attempt < COMMAND_ATTEMPTS:
+            sent = time.monotonic()
+            self.sock.sendto(datagram, self.address)
+            deadline = sent + self.rto
+            pause = None  # set by a BUSY reply
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    response = self.replies.get(timeout=remaining)
+                except Empty:
+                    break
+                piece = self.reply_piece(response)
+                if piece is None:
+                    continue
+                arrived = arrived or time.monotonic()
+                index, count, data = piece
+                fragments[index] = data
+                if len(fragments) < count:
+                    deadline = time.monotonic() + self.rto
+                    continue
+                reply = b"".join(fragments[i] for i in range(count))
+                if attempt == 0:
+                    self.update_rto(arrived - sent)
+                self.rto = self.estimate
+                if reply.startswith(REPLY_ZLIB):
+                    reply = zlib.decompress(reply[len(REPLY_ZLIB):])
+                reply = reply.decode()
+                if reply.startswith(BUSY_REPLY) and busy_waits < BUSY_RETRIES:
+                    pause = busy_pause(reply)
+                    fragments = {}
+                    break
+                return reply
+            if pause is not None:
+                busy_waits += 1
+                self.busy += 1
+                arrived = None
+                time.sleep(pause)
+                continue
+            self.rto = min(self.rto * 2, MAX_RTO)
+            attempt += 1
+            if attempt < COMMAND_ATTEMPTS:
+                self.retransmits += 1
+                if self.verbose:
+                    print("Timeout...Retrying...")
+        self.timeouts += 1
+        return "ERROR: No response"
+
+    def close(self):
+        self.closed = True
+        try:
+            # Wakes the receiver thread out of recvfrom()
+            self.sock.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+def busy_pause(message):
+    try:
+        return min(float(message[len(BUSY_REPLY):]), MAX_RTO)
+    except ValueError:
+        return INITIAL_RTO
+
+
+class ServerBusy(ConnectionError):
+    """A transfer the server turned away for now; retried like a drop."""
+
+
+def send_command(command, *fields):
+    # send_command("MSG", title, text) sends the command's fields, binary
+    # when LOGIN agreed on it and as the same text otherwise; options left
+    # out are empty. A whole text command ("MSG hans t hi") goes as it is.
+    if " " in command:
+        return channel.request(command)
+    _, count, options = COMMAND_FORMS[command]
+    fields = [str(field) for field in fields]
+    fields += [""] * (count + len(options) - len(fields))
+    if channel.binary:
+        return channel.request(command, fields)
+    return channel.request(text_command(command, fields))
+
+
+def text_command(command, fields):
+    _, count, options = COMMAND_FORMS[command]
+    words = [command]
+    if command in TEXT_WITH_USER:
+        words.append(current_user)
+    words += fields[:count]
+    for name, value in zip(options, fields[count:]):
+        if value:
+            words += [name, value]
+    return " ".join(words)
+
+
+def encode_command(command, fields):
+    # BINARY_COMMAND, then each field as a BINARY_FIELD length and UTF-8
+    parts = [BINARY_COMMAND.pack(COMMAND_FORMS[command][0], len(fields))]
+    for field in fields:
+        data = field.encode()
+        parts.append(BINARY_FIELD.pack(len(data)) + data)
+    return b"".join(parts)
+
+
+def split_batch(body):
+    # "<length>:<bytes>" items back to back, lengths in bytes
+    items = []
+    pos = 0
+    while pos < len(body):
+        colon = body.index(b":", pos)
+        size = int(body[pos:colon])
+        start = colon + 1
+        if size < 0 or start + size > len(body):
+            raise ValueError("Truncated batch item")
+        items.append(body[start:start + size])
+        pos = start + size
+    return items
+
+
+def send_batch(commands):
+    # Runs the commands in order with one round trip per BATCH request
+    # (MAX_BATCH commands or BATCH_BYTES each) instead of one per command.
+    # Returns a (succeeded, reply) pair per command.
+    results = []
+    start = 0
+    while start < len(commands):
+        items = []
+        size = 0
+        for command in commands[start:start + MAX_BATCH]:
+            data = command.encode()
+            item = str(len(data)).encode() + b":" + data
+            if items and size + len(item) > BATCH_BYTES:
+                break
+            items.append(item)
+            size += len(item)
+        start += len(items)
+        response = send_command("BATCH " + b"".join(items).decode())
+        try:
+            if not response.startswith("BATCH "):
+                raise ValueError(response)
+            replies = split_batch(response[len("BATCH "):].encode())
+        except ValueError:
+            results.extend([(False, response)] * len(items))
+            continue
+        for reply in replies:
+            status, _, text = reply.decode().partition(" ")
+            results.append((status == "OK", text))
+    return results
+
+
+def recv_exact(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        part = sock.recv(size - len(data))
+        if not part:
+            raise ConnectionError("Connection closed by server")
+        data += part
+    return bytes(data)
+
+
+def send_transfer_header(sock, op, flags=0, size=0, offset=0, digest=b"",
+                         names=()):
+    payload = "\0".join(names).encode()
+    sock.sendall(TRANSFER_HEADER.pack(TRANSFER_MAGIC, TRANSFER_VERSION, op,
+                                      flags, size, offset, len(payload),
+                                      digest)
+                 + payload)
+
+
+def read_transfer_reply(sock):
+    magic, version, status, flags, size, offset, names_len, digest = \
+        TRANSFER_HEADER.unpack(recv_exact(sock, TRANSFER_HEADER.size))
+    if magic != TRANSFER_MAGIC or version != TRANSFER_VERSION:
+        raise ConnectionError("Unexpected reply from server")
+    message = recv_exact(sock, names_len).decode()
+    if status != STATUS_OK and message.startswith(BUSY_REPLY):
+        # The retry loops pause before the next attempt
+        raise ServerBusy(message)
+    return status, flags, size, offset, message
+
+
+def compressible(fname, offset=0):
+    # Skips formats that are compressed already, by extension and by how
+    # well a sample from `offset` compresses
+    if os.path.splitext(fname)[1].lower() in COMPRESSED_TYPES:
+        return False
+    with open(fname, "rb") as f:
+        f.seek(offset)
+        sample = f.read(COMPRESS_SAMPLE)
+    return len(zlib.compress(sample, 1)) <= \
+        len(sample) * (1 - COMPRESS_MIN_SAVING)
+
+
+def send_body(sock, f, offset, count, codec):
+    # Bytes [offset, offset + count) of f, raw or as "<length><compressed
+    # bytes>" frames ended by an empty one; returns the bytes on the wire
+    if not codec:
+        return sock.sendfile(f, offset, count) if count else 0
+    comp = (lzma.LZMACompressor(preset=LZMA_PRESET) if codec == FLAG_LZMA
+            else zlib.compressobj(ZLIB_LEVEL))
+    f.seek(offset)
+    sent = 0
+    while True:
+        block = f.read(min(count, TRANSFER_BUFFER))
+        count -= len(block)
+        data = comp.compress(block) if block else comp.flush()
+        if data:
+            sock.sendall(COMPRESS_FRAME.pack(len(data)) + data)
+            sent += COMPRESS_FRAME.size + len(data)
+        if not block:
+            break
+    sock.sendall(COMPRESS_FRAME.pack(0))
+    return sent + COMPRESS_FRAME.size
+
+
+def receive_compressed(sock, size, codec, consume):
+    # Inflates frames until the empty one, passing at most TRANSFER_BUFFER
+    # bytes at a time to consume(); returns the bytes read off the wire
+    lzma_codec = codec == FLAG_LZMA
+    decomp = lzma.LZMADecompressor() if lzma_codec else zlib.decompressobj()
+    produced = received = 0
+    while True:
+        length, = COMPRESS_FRAME.unpack(recv_exact(sock, COMPRESS_FRAME.size))
+        received += COMPRESS_FRAME.size + length
+        if not length:
+            break
+        if length > MAX_COMPRESS_FRAME:
+            raise ConnectionError("Compressed frame too large")
+        data = recv_exact(sock, length)
+        while True:
+            if lzma_codec:
+                piece = decomp.decompress(data, TRANSFER_BUFFER)
+                data = b""
+                more = not decomp.needs_input and not decomp.eof
+            else:
+                piece = decomp.decompress(data, TRANSFER_BUFFER)
+                data = decomp.unconsumed_tail
+                more = data or len(piece) == TRANSFER_BUFFER
+            produced += len(piece)
+            if produced > size:
+                raise ConnectionError("Body longer than announced")
+            consume(piece)
+            if not more:
+                break
+    if produced != size:
+        raise ConnectionError(f"Connection lost after {produced} of {size} "
+                              f"bytes")
+    return received
+
+
+def receive_to_file(sock, f, size, fname, codec=0):
+    if codec:
+        return receive_compressed(sock, size, codec, f.write)
+    buffer = bytearray(TRANSFER_BUFFER)
+    view = memoryview(buffer)
+    received = 0
+    last_report = time.monotonic()
+    while received < size:
+        chunk = sock.recv_into(buffer, min(size - received, TRANSFER_BUFFER))
+        if not chunk:
+            raise ConnectionError(
+                f"Connection lost after {received} of {size} bytes")
+        f.write(view[:chunk])
+        received += chunk
+        now = time.monotonic()
+        if now - last_report >= PROGRESS_INTERVAL:
+            last_report = now
+            print(f"Receiving '{fname}': {received >> 20} MB")
+    return size
+
+
+class MuxStream:
+    """
+    One transfer inside a TransferSession, used like a connected socket.
+    The session's reader feeds incoming DATA frames into `buffer`, and
+    waits while it holds MUX_WINDOW bytes; sends go out as DATA frames of
+    at most MUX_CHUNK bytes.
+    """
+
+    def __init__(self, session, stream_id):
+        self.session = session
+        self.id = stream_id
+        self.cond = Condition()
+        self.buffer = bytearray()
+        self.ended = False  # the server closed the stream, or the session ended
+        self.closed = False
+        self.timeout = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def feed(self, data):
+        with self.cond:
+            self.cond.wait_for(lambda: len(self.buffer) < MUX_WINDOW or
+                               self.closed)
+            if not self.closed:
+                self.buffer += data
+                self.cond.notify_all()
+
+    def end(self):
+        with self.cond:
+            self.ended = True
+            self.cond.notify_all()
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def recv_into(self, buffer, nbytes=0):
+        nbytes = nbytes or len(buffer)
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.buffer or self.ended or
+                                      self.closed, self.timeout):
+                raise timeout("timed out")
+            n = min(nbytes, len(self.buffer))
+            buffer[:n] = self.buffer[:n]
+            del self.buffer[:n]
+            self.cond.notify_all()
+            return n
+
+    def recv(self, bufsize):
+        data = bytearray(min(bufsize, MUX_WINDOW))
+        return bytes(data[:self.recv_into(data)])
+
+    def sendall(self, data):
+        view = memoryview(data)
+        for start in range(0, len(view), MUX_CHUNK):
+            self.session.send(self.id, MUX_DATA,
+                              view[start:start + MUX_CHUNK])
+
+    def sendfile(self, file, offset=0, count=None):
+        file.seek(offset)
+        sent = 0
+        while count is None or sent < count:
+            block = file.read(MUX_CHUNK if count is None else
+                              min(MUX_CHUNK, count - sent))
+            if not block:
+                break
+            self.sendall(block)
+            sent += len(block)
+        return sent
+
+    def close(self):
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.buffer.clear()
+            self.cond.notify_all()
+        self.session.close_stream(self)
+
+
+class TransferSession:
+    """
+    One long-lived TCP connection carrying every transfer (--session),
+    so small files no longer pay for a connect and an UPD/DWN round trip
+    each. It is opened with OP_SESSION and the token the server hands out
+    for SES. Each transfer gets a stream of its own (open_stream()), with
+    frames of MUX_FRAME (stream id, kind, length) and a payload, and a
+    reader thread hands incoming frames to their streams. A dropped
+    connection is reopened with the same token on the next transfer.
+    """
+
+    def __init__(self, address, username, token):
+        self.address = address
+        self.username = username
+        self.token = token
+        self.lock = Lock()
+        self.send_lock = Lock()
+        self.sock = None
+        self.streams = {}  # {stream id: MuxStream}
+        self.next_id = 0
+        self.closed = True
+        self.connect()
+
+    def connect(self):
+        sock = create_connection(self.address, TRANSFER_TIMEOUT)
+        try:
+            send_transfer_header(sock, OP_SESSION, digest=self.token,
+                                 names=(self.username,))
+            status, _, _, _, message = read_transfer_reply(sock)
+            if status != STATUS_OK:
+                raise ConnectionError(message)
+        except OSError:
+            sock.close()
+            raise
+        sock.settimeout(None)
+        # Small frames go out at once instead of waiting on Nagle
+        sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        self.sock = sock
+        self.streams = {}
+        self.closed = False
+        Thread(target=self.receive, args=(sock, self.streams),
+               daemon=True).start()
+
+    def receive(self, sock, streams):
+        try:
+            while True:
+                stream_id, kind, length = MUX_FRAME.unpack(
+                    recv_exact(sock, MUX_FRAME.size))
+                data = recv_exact(sock, length) if length else b""
+                with self.lock:
+                    stream = streams.get(stream_id)
+                if stream is None:
+                    continue
+                if kind == MUX_CLOSE:
+                    stream.end()
+                else:
+                    stream.feed(data)
+        except OSError:
+            pass
+        with self.lock:
+            if self.sock is sock:
+                self.closed = True
+            ended = list(streams.values())
+        for stream in ended:
+            stream.end()
+
+    def open_stream(self):
+        with self.lock:
+            if self.closed:
+                self.connect()
+            self.next_id += 1
+            stream = self.streams[self.next_id] = MuxStream(self, self.next_id)
+            # Opened in id order: the server takes a frame for an id below
+            # the highest it has seen as left over from a closed stream
+            self.send(stream.id, MUX_DATA)
+        stream.settimeout(TRANSFER_TIMEOUT)
+        return stream
+
+    def send(self, stream_id, kind, data=b""):
+        with self.send_lock:
+            # A stream of a connection that has since been replaced
+            if kind == MUX_DATA and stream_id not in self.streams:
+                raise ConnectionError("Transfer session closed")
+            header = MUX_FRAME.pack(stream_id, kind, len(data))
+            if len(data) < MUX_CHUNK:
+                # Header and payload in one segment, small frames are common
+                self.sock.sendall(header + bytes(data))
+            else:
+                self.sock.sendall(header)
+                self.sock.sendall(data)
+
+    def close_stream(self, stream):
+        with self.lock:
+            if self.streams.get(stream.id) is not stream:
+                return
+            del self.streams[stream.id]
+        try:
+            self.send(stream.id, MUX_CLOSE)
+        except OSError:
+            pass
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            sock, self.sock = self.sock, None
+        if sock is not None:
+            try:
+                sock.shutdown(SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+
+
+def start_session():
+    # Without a session every transfer opens a connection of its own
+    global session, transfer_queue
+    response = send_command("SES")
+    try:
+        if not response.startswith("SESSION "):
+            raise ConnectionError(response)
+        session = TransferSession(SERVER_ADDRESS, current_user,
+                                  bytes.fromhex(response.split(" ", 1)[1]))
+    except (OSError, ValueError) as e:
+        print(f"Transfer session unavailable: {e}")
+        return
+    transfer_queue = ThreadPoolExecutor(max_workers=QUEUED_TRANSFERS)
+    print("Transfers run in the background over one session")
+
+
+def queue_transfer(label, work, *args):
+    # The prompt comes back at once; the transfer prints its result, then
+    # the prompt again, when it is done
+    def run():
         try:
-            udp_socket.sendto(command.encode(), SERVER_ADDRESS)
-            response, _ = udp_socket.recvfrom(1024)
-            return response.decode()
-        except timeout:
-            print("Timeout...Retrying...")
-    return "ERROR: No response"
+            work(*args)
+        except Exception as e:
+            print(f"{label} failed: {e}")
+        if is_client_running:
+            print(f"{current_user}> ", end="", flush=True)
+
+    transfer_queue.submit(run)
+    print(f"{label} queued")
+
+
+def open_transfer():
+    # A stream of the transfer session, or a connection of its own
+    if session is not None:
+        return session.open_stream()
+    tcp = socket(AF_INET, SOCK_STREAM)
+    tcp.settimeout(TRANSFER_TIMEOUT)
+    try:
+        tcp.connect(SERVER_ADDRESS)
+    except OSError:
+        tcp.close()
+        raise
+    return tcp
+
+
+def write_at(fd, data, offset):
+    # Positional write, so parallel streams never share a file position
+    while data:
+        if hasattr(os, "pwrite"):
+            written = os.pwrite(fd, data, offset)
+        else:
+            os.lseek(fd, offset, os.SEEK_SET)
+            written = os.write(fd, data)
+        data = data[written:]
+        offset += written
+
+
+def run_streams(jobs, work):
+    # Spreads jobs over TRANSFER_STREAMS connections; a stream that drops
+    # reconnects and retries its current job. Returns the jobs that failed.
+    pending = Queue()
+    for job in jobs:
+        pending.put(job)
+    failed = []
+
+    def stream():
+        tcp = None
+        while True:
+            try:
+                job = pending.get_nowait()
+            except Empty:
+                break
+            for attempt in range(1, TRANSFER_RETRIES + 1):
+                try:
+                    if tcp is None:
+                        tcp = open_transfer()
+                    work(tcp, job)
+                    break
+                except OSError as e:
+                    if tcp is not None:
+                        tcp.close()
+                        tcp = None
+                    if attempt == TRANSFER_RETRIES:
+                        print(f"Chunk at byte {job[0]} failed: {e}")
+                        failed.append(job)
+                    retry_pause(attempt)
+        if tcp is not None:
+            tcp.close()
+
+    with ThreadPoolExecutor(max_workers=TRANSFER_STREAMS) as pool:
+        for _ in range(TRANSFER_STREAMS):
+            pool.submit(stream)
+    return failed
+
+
+def retry_pause(attempt):
+    if attempt < TRANSFER_RETRIES:
+        time.sleep(min(2 ** (attempt - 1), 10))
+
+
+def file_digest(fname):
+    hasher = hashlib.sha256()
+    with open(fname, "rb") as f:
+        for block in iter(lambda: f.read(TRANSFER_BUFFER), b""):
+            hasher.update(block)
+    return hasher.digest()
 
 
 def auth_user():
@@ -43,15 +823,19 @@ def auth_user():
         if not username:
             print("ERROR: Name required!")
             continue
-        response = send_command(f"LOGIN {username}")
+        response = send_command("LOGIN", username,
+                                BINARY_VERSION if BINARY_COMMANDS else "")
+        # "binary <version>" when the server takes binary commands too
+        response, _, binary = response.partition(" binary ")
         if response == "PASSWORD_REQUIRED":
             password = input("Enter password: ")
             if not password:
                 print("ERROR: Password required!")
                 continue
-            auth_response = send_command(f"AUTH {username} {password}")
+            auth_response = send_command("AUTH", username, password)
             if "Login successful" in auth_response:
                 current_user = username
+                channel.binary = binary == str(BINARY_VERSION)
                 print(f"Welcome to the forum, {current_user}!")
                 return
             print(auth_response)
@@ -61,9 +845,10 @@ def auth_user():
             if not pwd:
                 print("ERROR: Password required!")
                 continue
-            reg_response = send_command(f"REGISTER {username} {pwd}")
+            reg_response = send_command("REGISTER", username, pwd)
             if "Registration successful" in reg_response:
                 current_user = username
+                channel.binary = binary == str(BINARY_VERSION)
                 print(f"Welcome to the forum, {username}!")
                 return
             else:
@@ -72,8 +857,11 @@ def auth_user():
 
 def exit_forum():
     global is_client_running
-    response = send_command(f"XIT {current_user}")
     is_client_running = False
+    if transfer_queue is not None:
+        print("Waiting for queued transfers...")
+        transfer_queue.shutdown(wait=True)
+    response = send_command("XIT")
     print(response)
 
 
@@ -81,12 +869,28 @@ def create_thread(title):
     if not title or " " in title:
         print("ERROR: Invalid title")
         return
-    response = send_command(f"CRT {current_user} {title}")
+    response = send_command("CRT", title)
     print(response)
 
 
+def conditional_command(key, command, *fields):
+    # Sends the command with "if-version" of the copy we already have, so
+    # an unchanged listing or thread comes back as a bare NOT_MODIFIED.
+    # Returns (reply text, version or None if the server sent an error).
+    version, text = read_cache.get(key, (0, None))
+    response = send_command(command, *fields, version)
+    if response == "NOT_MODIFIED":
+        return text, version
+    header, _, body = response.partition("\n")
+    if not header.startswith("VERSION "):
+        return response, None
+    return body, int(header.split()[1])
+
+
 def list_threads():
-    response = send_command("LST")
+    response, version = conditional_command("LST", "LST")
+    if version is not None:
+        read_cache["LST"] = (version, response)
     print(response)
 
 
@@ -99,16 +903,71 @@ def post_message(args):
     if not title or " " in title:
         print("ERROR: Invalid title")
         return
-    response = send_command(f"MSG {current_user} {title} {message}")
+    response = send_command("MSG", title, message)
     print(response)
 
 
-def read_thread(title):
-    if not title or " " in title:
-        print("ERROR: Invalid title")
+def read_thread(args):
+    # RDT <title> [from N]: fetched a page at a time, from message N on
+    parts = args.split()
+    if len(parts) not in (1, 3) or \
+            (len(parts) == 3 and (parts[1] != "from" or not parts[2].isdigit())):
+        print("Input with: RDT <thread> [from N]")
         return
-    response = send_command(f"RDT {title}")
-    print(f"\n---Thread: {title}\n{response}\n---")
+    title = parts[0]
+    first = max(int(parts[2]), 1) if len(parts) == 3 else 1
+    pages = []
+    version = None
+    while True:
+        command = ("RDT", title, first, RDT_PAGE_SIZE)
+        if first == 1 and not pages:
+            # A full read: the first page doubles as a conditional
+            # request and NOT_MODIFIED means the cached copy is current
+            response, version = conditional_command(title, *command)
+            if version is not None and read_cache.get(title, (0,))[0] == version:
+                print(f"\n---Thread: {title}\n{read_cache[title][1]}\n---")
+                return
+        else:
+            response = send_command(*command)
+        header, _, content = response.partition("\n")
+        if not header.startswith("PAGE "):
+            print(response)
+            return
+        _, _, last, total = header.split()
+        pages.append(content)
+        if int(last) >= int(total):
+            break
+        first = int(last) + 1
+    content = "".join(pages)
+    if not content:
+        content = "No new messages" if first > 1 else "Thread is empty"
+    elif version is not None:
+        read_cache[title] = (version, content)
+    print(f"\n---Thread: {title}\n{content}\n---")
+
+
+def search_threads(args):
+    # SRC <terms> [from N]: ranked matches across all threads, one page
+    parts = args.split()
+    first = ""
+    if len(parts) >= 3 and parts[-2] == "from":
+        if not parts[-1].isdigit():
+            print("Input with: SRC <terms> [from N]")
+            return
+        first = parts.pop()
+        parts.pop()
+    response = send_command("SRC", " ".join(parts), first)
+    header, _, content = response.partition("\n")
+    if not header.startswith("RESULTS "):
+        print(response)
+        return
+    _, first, last, total = header.split()
+    if int(total) == 0:
+        print("No matching messages")
+    elif int(last) < int(first):
+        print(f"No results past {total}")
+    else:
+        print(f"\n---Results {first}-{last} of {total}\n{content}\n---")
 
 
 def edit_message(args):
@@ -130,7 +989,7 @@ def edit_message(args):
     if not new_msg:
         print("ERROR: New message required")
         return
-    response = send_command(f"EDT {current_user} {title} {msg_num} {new_msg}")
+    response = send_command("EDT", title, msg_num, new_msg)
     print(response)
 
 
@@ -150,16 +1009,52 @@ def delete_message(args):
     except ValueError:
         print("ERROR: Invalid message number")
         return
-    response = send_command(f"DLT {current_user} {title} {msg_num}")
+    response = send_command("DLT", title, msg_num)
     print(response)
 
 
+def subscribe_thread(title):
+    if not title or " " in title:
+        print("ERROR: Invalid title")
+        return
+    print(send_command("SUB", title))
+
+
+def unsubscribe_thread(title):
+    if not title or " " in title:
+        print("ERROR: Invalid title")
+        return
+    print(send_command("UNSUB", title))
+
+
+def show_push(title, deltas):
+    # Runs on the receiver thread, while the prompt waits for input
+    lines = []
+    for delta in deltas:
+        op, _, rest = delta.partition(" ")
+        if op == "MSG":
+            lines.append(rest)
+        elif op == "EDT":
+            lines.append(f"{rest} (edited)")
+        elif op == "DLT":
+            number, _, user = rest.partition(" ")
+            lines.append(f"Message {number} deleted by {user}")
+        elif op == "UPD":
+            user, _, fname = rest.partition(" ")
+            lines.append(f"{user} uploaded {fname}")
+        elif op == "RMV":
+            lines.append(f"Thread removed by {rest}")
+    if lines:
+        print(f"\n---Thread: {title}\n" + "\n".join(lines) + "\n---")
+        print(f"{current_user}> ", end="", flush=True)
+
+
 def remove_thread(args):
     title = args.strip()
     if not title or " " in title:
         print("ERROR: Invalid title")
         return
-    response = send_command(f"RMV {current_user} {title}")
+    response = send_command("RMV", title)
     print(response)
 
 
@@ -172,27 +1067,131 @@ def upload_file(args):
     if not os.path.exists(fname):
         print(f"{fname} not found")
         return
+    if transfer_queue is not None:
+        # The server checks the thread and file name as the upload starts
+        return queue_transfer(f"Upload '{fname}' to '{title}'", send_file,
+                              title, fname)
     print(f"Upload '{fname}' to '{title}'")
-    response = send_command(f"UPD {current_user} {title} {fname}")
+    response = send_command("UPD", title, fname)
     if not response.startswith("Upload ready"):
         print("Upload rejected:" + response)
         return
-    try:
-        with socket(AF_INET, SOCK_STREAM) as tcp:
-            tcp.connect(SERVER_ADDRESS)
-            tcp.sendall(f"UPD:{current_user}#{title}#{fname}\n".encode())
+    send_file(title, fname)
+
+
+def send_file(title, fname):
+    size = os.path.getsize(fname)
+    if TRANSFER_STREAMS > 1 and size > CHUNK_SIZE:
+        return upload_chunked(title, fname, size)
+    flags, digest = 0, b""
+    if VERIFY_UPLOADS:
+        flags, digest = FLAG_CHECKSUM, file_digest(fname)
+    for attempt in range(1, TRANSFER_RETRIES + 1):
+        try:
+            status, offset, confirm = upload_attempt(
+                title, fname, size, flags, digest)
+        except OSError as e:
+            print(f"Upload interrupted: {e} (attempt {attempt})")
+        else:
+            # A rejected resume (e.g. stale data failing the checksum) has
+            # been discarded by the server, so the next attempt starts over
+            if status == STATUS_OK or not offset:
+                print(f"Server: " + confirm)
+                return
+            print(f"Server: {confirm}, restarting upload")
+        retry_pause(attempt)
+    print("Upload failed: too many retries")
+
+
+def upload_attempt(title, fname, size, flags, digest):
+    codec = COMPRESSION if COMPRESSION and compressible(fname) else 0
+    with open_transfer() as tcp:
+        send_transfer_header(tcp, OP_UPLOAD, flags | FLAG_RESUME | codec,
+                             size, digest=digest,
+                             names=(current_user, title, fname))
+        # The server answers with how much of a previous attempt it kept,
+        # and the codec it accepted
+        status, codec, _, offset, message = read_transfer_reply(tcp)
+        if status != STATUS_OK:
+            return status, offset, message
+        if offset == size and size:
+            print(f"'{fname}' already on server, nothing to send")
+        else:
+            if offset:
+                print(f"Resuming '{fname}' from byte {offset}")
             with open(fname, "rb") as f:
-                while True:
-                    data = f.read(1024)
-                    if not data:
-                        break
-                    tcp.sendall(data)
-            print(f"Sent '{fname}'")
-            tcp.shutdown(SHUT_WR)
-            confirm = tcp.recv(1024).decode()
-            print(f"Server: " + confirm)
-    except Exception as e:
-        print("Upload failed: " + str(e))
+                sent = send_body(tcp, f, offset, size - offset, codec)
+            print(f"Sent '{fname}' ({size - offset} bytes"
+                  f"{f', {sent} compressed' if codec else ''})")
+        status, _, _, _, message = read_transfer_reply(tcp)
+        return status, offset, message
+
+
+def upload_chunked(title, fname, size):
+    # The manifest lists a SHA-256 per chunk; the server answers with the
+    # chunks it already holds from an earlier run, only the rest are sent.
+    # With the whole file's SHA-256 too, content the server already stores
+    # is attached without sending any chunk.
+    names = (current_user, title, fname)
+    chunks = []
+    whole = hashlib.sha256()
+    with open(fname, "rb") as f:
+        for offset in range(0, size, CHUNK_SIZE):
+            block = f.read(CHUNK_SIZE)
+            whole.update(block)
+            chunks.append((offset, len(block), hashlib.sha256(block).digest()))
+    manifest = {"size": size, "chunk_size": CHUNK_SIZE,
+                "chunks": [d.hex() for _, _, d in chunks]}
+    if VERIFY_UPLOADS:
+        manifest["sha256"] = whole.hexdigest()
+    manifest = json.dumps(manifest).encode()
+    codec = COMPRESSION if COMPRESSION and compressible(fname) else 0
+    try:
+        with open_transfer() as tcp:
+            send_transfer_header(tcp, OP_MANIFEST, codec, size=len(manifest),
+                                 names=names)
+            tcp.sendall(manifest)
+            status, codec, reply_size, _, message = read_transfer_reply(tcp)
+            if status != STATUS_OK:
+                print("Upload rejected: " + message)
+                return
+            reply = json.loads(recv_exact(tcp, reply_size))
+    except (OSError, ValueError) as e:
+        print(f"Upload failed: {e}")
+        return
+    if reply.get("stored"):
+        print(f"'{fname}' already on server, nothing to send")
+        print("Server: UPLOAD_SUCCESS")
+        return
+    done = set(reply["done"])
+    pending = [c for i, c in enumerate(chunks) if i not in done]
+    if done:
+        print(f"Resuming '{fname}': {len(done)} of {len(chunks)} chunks "
+              f"already on server")
+
+    def send_chunk(tcp, chunk):
+        offset, length, digest = chunk
+        send_transfer_header(tcp, OP_CHUNK, codec, size=length, offset=offset,
+                             digest=digest, names=names)
+        with open(fname, "rb") as f:
+            send_body(tcp, f, offset, length, codec)
+        status, _, _, _, message = read_transfer_reply(tcp)
+        if status != STATUS_OK:
+            raise ConnectionError(message)
+
+    start = time.monotonic()
+    if run_streams(pending, send_chunk):
+        print("Upload failed: run UPD again to resume")
+        return
+    print(f"Sent '{fname}' ({size} bytes, {TRANSFER_STREAMS} streams, "
+          f"{time.monotonic() - start:.1f}s)")
+    try:
+        with open_transfer() as tcp:
+            send_transfer_header(tcp, OP_COMMIT, names=names)
+            _, _, _, _, message = read_transfer_reply(tcp)
+            print("Server: " + message)
+    except OSError as e:
+        print(f"Upload failed: {e}")
 
 
 def download_file(args):
@@ -204,31 +1203,151 @@ def download_file(args):
     if os.path.exists(fname):
         print(f"Local file {fname} already exists")
         return
-    response = send_command(f"DWN {current_user} {title} {fname}")
+    if transfer_queue is not None:
+        return queue_transfer(f"Download '{fname}' from '{title}'",
+                              fetch_file, title, fname)
+    response = send_command("DWN", title, fname)
     if not response.startswith("Download ready"):
         print("Rejected: " + response)
         return
+    fetch_file(title, fname)
+
+
+def fetch_file(title, fname):
+    if TRANSFER_STREAMS > 1 and download_chunked(title, fname):
+        return
+    tmp_name = f"{fname}.part"
+    for attempt in range(1, TRANSFER_RETRIES + 1):
+        try:
+            status, offset, message = download_attempt(title, fname, tmp_name)
+        except OSError as e:
+            print(f"Download interrupted: {e} (attempt {attempt})")
+        else:
+            if status == STATUS_OK:
+                print(message)
+                return
+            if not offset:
+                print("Download failed: " + message)
+                return
+            # Our partial copy does not fit the server's file, start over
+            os.remove(tmp_name)
+        retry_pause(attempt)
+    print("Download failed: too many retries")
+
+
+def download_attempt(title, fname, tmp_name):
+    # Asks only for the bytes missing from a previous attempt's .part file
+    offset = os.path.getsize(tmp_name) if os.path.exists(tmp_name) else 0
+    with open_transfer() as tcp:
+        send_transfer_header(tcp, OP_DOWNLOAD, COMPRESSION, offset=offset,
+                             names=(current_user, title, fname))
+        # The reply flags say whether the server compressed the body
+        status, codec, size, _, message = read_transfer_reply(tcp)
+        if status != STATUS_OK:
+            return status, offset, message
+        if offset:
+            print(f"Resuming '{fname}' from byte {offset}")
+        with open(tmp_name, "ab") as f:
+            received = receive_to_file(tcp, f, size, fname, codec)
+    os.replace(tmp_name, fname)
+    return status, offset, (f"Received '{fname}' ({offset + size} bytes"
+                            f"{f', {received} compressed' if codec else ''})")
+
+
+def download_chunked(title, fname):
+    # Returns False when the file is small enough for a single stream
+    names = (current_user, title, fname)
     try:
-        with socket(AF_INET, SOCK_STREAM) as tcp:
-            tcp.connect(SERVER_ADDRESS)
-            tcp.sendall(f"DWN:{title}#{fname}\n".encode())
-            with open(fname, "wb") as f:
-                while True:
-                    data = tcp.recv(1024)
-                    if not data:
-                        break
-                    f.write(data)
-                    print(f"Received '{fname}'")
-    except Exception as e:
-        print("Download failed: " + str(e))
+        with open_transfer() as tcp:
+            send_transfer_header(tcp, OP_STAT, names=names)
+            status, _, size, _, message = read_transfer_reply(tcp)
+    except OSError as e:
+        print(f"Download failed: {e}")
+        return True
+    if status != STATUS_OK:
+        print("Download failed: " + message)
+        return True
+    if size <= CHUNK_SIZE:
+        return False
+    # Each stream writes its ranges straight into place in a preallocated
+    # .part file, so there is no reassembly step
+    tmp_name = f"{fname}.part"
+    with open(tmp_name, "wb") as f:
+        f.truncate(size)
+    fd = os.open(tmp_name, os.O_WRONLY | getattr(os, "O_BINARY", 0))
+
+    def fetch_range(tcp, job):
+        offset, length = job
+        send_transfer_header(tcp, OP_DOWNLOAD, COMPRESSION, size=length,
+                             offset=offset, names=names)
+        status, codec, reply_size, _, message = read_transfer_reply(tcp)
+        if status != STATUS_OK or reply_size != length:
+            raise ConnectionError(message or "Short range from server")
+        if codec:
+            def consume(piece):
+                nonlocal offset
+                write_at(fd, piece, offset)
+                offset += len(piece)
+            receive_compressed(tcp, length, codec, consume)
+            return
+        buffer = bytearray(min(TRANSFER_BUFFER, length))
+        view = memoryview(buffer)
+        received = 0
+        while received < length:
+            n = tcp.recv_into(buffer, min(length - received, len(buffer)))
+            if not n:
+                raise ConnectionError("Connection closed by server")
+            write_at(fd, view[:n], offset + received)
+            received += n
+
+    start = time.monotonic()
+    try:
+        failed = run_streams([(offset, min(CHUNK_SIZE, size - offset))
+                              for offset in range(0, size, CHUNK_SIZE)],
+                             fetch_range)
+    finally:
+        os.close(fd)
+    if failed:
+        os.remove(tmp_name)
+        print("Download failed: too many retries")
+        return True
+    os.replace(tmp_name, fname)
+    print(f"Received '{fname}' ({size} bytes, {TRANSFER_STREAMS} streams, "
+          f"{time.monotonic() - start:.1f}s)")
+    return True
 
 
 def main():
-    global is_client_running, current_user, udp_socket
-    udp_socket = socket(AF_INET, SOCK_DGRAM)
-    udp_socket.bind(('', 0))
-    udp_socket.settimeout(1.0)
+    global is_client_running, current_user, channel
+    global SERVER_ADDRESS, TRANSFER_STREAMS, CHUNK_SIZE, COMPRESSION
+    global BINARY_COMMANDS
+    parser = argparse.ArgumentParser(description="Forum client")
+    parser.add_argument("server_ip")
+    parser.add_argument("server_port", type=int)
+    parser.add_argument("--streams", type=int, default=TRANSFER_STREAMS,
+                        help="parallel TCP connections for large transfers")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE,
+                        help="bytes per chunk when using several streams")
+    parser.add_argument("--compress", choices=sorted(CODECS),
+                        help="compress transfers of files that are not "
+                             "compressed already")
+    parser.add_argument("--text-commands", action="store_true",
+                        help="send commands as text even if the server "
+                             "takes binary ones")
+    parser.add_argument("--session", action="store_true",
+                        help="carry all transfers over one connection and "
+                             "run them in the background")
+    args = parser.parse_args()
+    SERVER_ADDRESS = (args.server_ip, args.server_port)
+    TRANSFER_STREAMS = max(1, args.streams)
+    CHUNK_SIZE = max(1, args.chunk_size)
+    COMPRESSION = CODECS.get(args.compress, 0)
+    BINARY_COMMANDS = not args.text_commands
+    channel = CommandChannel(SERVER_ADDRESS)
+    channel.on_push = show_push
     auth_user()
+    if args.session:
+        start_session()
     cmd_list = {
         'XIT': (0, exit_forum),
         'CRT': (1, create_thread),
@@ -239,19 +1358,25 @@ def main():
         'DLT': (2, delete_message),
         'RMV': (1, remove_thread),
         'UPD': (2, upload_file),
-        'DWN': (2, download_file)
+        'DWN': (2, download_file),
+        'SRC': (1, search_threads),
+        'SUB': (1, subscribe_thread),
+        'UNSUB': (1, unsubscribe_thread)
     }
     print("\n====== Input with CMD below ======")
     print("1. /XIT (no arguments) - Exit forum")
     print("2. /CRT <threadtitle> - Create thread title")
     print("3. /LST (no arguments) - List thread title")
     print("4. /MSG <threadtitle> <msg> - Post message")
-    print("5. /RDT <threadtitle> - Read thread content")
+    print("5. /RDT <threadtitle> [from N] - Read thread content")
     print("6. /EDT <threadtitle> <msg_num> <msg> - Edit message")
     print("7. /DLT <threadtitle> <msg_num> - Delete message")
     print("8. /RMV <threadtitle> - Remove thread")
     print("9. /UPD <threadtitle> <filename> - Upload file")
     print("X. /DWN <threadtitle> <filename> - Download file")
+    print("S. /SRC <terms> [from N] - Search messages")
+    print("P. /SUB <threadtitle> - Show new posts as they arrive")
+    print("U. /UNSUB <threadtitle> - Stop showing new posts")
     print("===================================\n")
     is_client_running = True
     try:
@@ -280,9 +1405,11 @@ def main():
     except KeyboardInterrupt:
         print("\nClosing client...")
     finally:
-        if udp_socket:
-            udp_socket.close()
-            udp_socket = None
+        if session is not None:
+            session.close()
+        if channel:
+            channel.close()
+            channel = None
             print("Connection closed...")
 
 
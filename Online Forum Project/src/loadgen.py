@@ -0,0 +1,471 @@
+"""
+"loadgen.py"
+Forum Server Load Generator
+Usage: python3 loadgen.py [--server HOST:PORT | --spawn] [--processes 4] [--users 200]
+                          [--duration 30] [--mix RDT=40,MSG=25,...] [--think 0.5]
+                          [--file-sizes 4K,64K] [--loss 0.05] [--delay 20]
+                          [--output results.json]
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from socket import *
+from threading import Thread, Lock, Condition
+import argparse
+import heapq
+import json
+import os
+import random
+import selectors
+import subprocess
+import sys
+import tempfile
+import time
+
+import client
+
+DEFAULT_MIX = "RDT=40,MSG=25,LST=10,EDT=8,DLT=5,CRT=4,UPD=4,DWN=4"
+COMMANDS = ("LST", "RDT", "MSG", "EDT", "DLT", "CRT", "UPD", "DWN")
+
+
+def parse_size(text):
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    text = text.strip().upper()
+    if text[-1:] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(","):
+        command, _, weight = item.partition("=")
+        command = command.strip().upper()
+        if command not in COMMANDS:
+            raise argparse.ArgumentTypeError(f"unknown command {command}")
+        mix[command] = float(weight or 1)
+    return mix
+
+
+def parse_address(text):
+    host, _, port = text.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+class LossyRelay:
+    """
+    UDP shim between the simulated users and the server. Every datagram,
+    both ways, is dropped with probability `loss` or else held back for
+    `delay` seconds plus up to `jitter`. Each user gets its own upstream
+    socket, so the server still sees one address (one session) per user.
+    """
+
+    def __init__(self, server, loss, delay, jitter, seed):
+        self.server = server
+        self.loss = loss
+        self.delay = delay
+        self.jitter = jitter
+        self.rng = random.Random(seed)
+        self.sock = socket(AF_INET, SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.address = self.sock.getsockname()
+        self.upstream = {}  # {user address: socket towards the server}
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ)
+        self.pending = []  # heap of (due, n, socket, datagram, address)
+        self.cond = Condition()
+        self.queued = 0
+        self.dropped = 0
+        self.forwarded = 0
+        Thread(target=self.pump, daemon=True).start()
+        Thread(target=self.deliver, daemon=True).start()
+
+    def pump(self):
+        while True:
+            for key, _ in self.selector.select():
+                sock = key.fileobj
+                try:
+                    data, addr = sock.recvfrom(65535)
+                except OSError:
+                    continue
+                if sock is self.sock:
+                    up = self.upstream.get(addr)
+                    if up is None:
+                        up = socket(AF_INET, SOCK_DGRAM)
+                        up.bind(("127.0.0.1", 0))
+                        self.upstream[addr] = up
+                        self.selector.register(up, selectors.EVENT_READ, addr)
+                    self.schedule(up, data, self.server)
+                else:
+                    self.schedule(self.sock, data, key.data)
+
+    def schedule(self, sock, data, addr):
+        if self.rng.random() < self.loss:
+            self.dropped += 1
+            return
+        due = time.monotonic() + self.delay + self.rng.random() * self.jitter
+        with self.cond:
+            self.queued += 1
+            heapq.heappush(self.pending, (due, self.queued, sock, data, addr))
+            self.cond.notify()
+
+    def deliver(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                wait = self.pending[0][0] - time.monotonic()
+                if wait > 0:
+                    self.cond.wait(wait)
+                    continue
+                _, _, sock, data, addr = heapq.heappop(self.pending)
+            try:
+                sock.sendto(data, addr)
+                self.forwarded += 1
+            except OSError:
+                pass
+
+
+class SimUser:
+    """
+    One scripted client: logs in (registering on first use), owns a
+    public thread that everyone posts to and a private one for its EDT
+    and DLT, then runs commands from the mix until the deadline.
+    """
+
+    def __init__(self, name, address, shared, args, seed):
+        self.name = name
+        self.channel = client.CommandChannel(address)
+        self.channel.verbose = False
+        self.shared = shared
+        self.args = args
+        self.rng = random.Random(seed)
+        self.private = f"{name}p"
+        self.private_count = 0  # our messages in the private thread
+        self.posted = 0
+        self.stats = {}  # {command: {"latencies": [...], ...}}
+
+    def record(self, command, elapsed, reply):
+        stats = self.stats.setdefault(
+            command, {"latencies": [], "errors": 0, "timeouts": 0})
+        stats["latencies"].append(elapsed)
+        if reply == "ERROR: No response":
+            stats["timeouts"] += 1
+        elif reply.startswith("ERROR"):
+            stats["errors"] += 1
+
+    def send(self, command, text):
+        start = time.perf_counter()
+        reply = self.channel.request(text)
+        self.record(command, time.perf_counter() - start, reply)
+        return reply
+
+    def timed(self, command, action):
+        # A whole UPD/DWN: the UDP pre-check plus the TCP transfer
+        start = time.perf_counter()
+        try:
+            reply = action()
+        except OSError as e:
+            reply = f"ERROR: {e}"
+        self.record(command, time.perf_counter() - start, reply)
+
+    def login(self):
+        password = f"pw{self.name}"
+        reply = self.send("LOGIN", f"LOGIN {self.name}")
+        if reply == "NEW_USER":
+            reply = self.send("REGISTER", f"REGISTER {self.name} {password}")
+        elif reply == "PASSWORD_REQUIRED":
+            reply = self.send("AUTH", f"AUTH {self.name} {password}")
+        return not reply.startswith("ERROR")
+
+    def setup(self):
+        public = f"{self.name}s"
+        self.send("CRT", f"CRT {self.name} {public}")
+        self.send("CRT", f"CRT {self.name} {self.private}")
+        if not self.send("MSG", f"MSG {self.name} {self.private} first")\
+                .startswith("ERROR"):
+            self.private_count = 1
+        with self.shared["lock"]:
+            self.shared["titles"].append(public)
+
+    def pick_title(self):
+        with self.shared["lock"]:
+            return self.rng.choice(self.shared["titles"])
+
+    def run_command(self, command):
+        self.posted += 1
+        if command == "LST":
+            self.send("LST", "LST")
+        elif command == "RDT":
+            self.send("RDT", f"RDT {self.pick_title()}")
+        elif command == "MSG":
+            self.send("MSG", f"MSG {self.name} {self.pick_title()} "
+                             f"load message {self.posted}")
+        elif command == "EDT":
+            if self.private_count:
+                self.send("EDT", f"EDT {self.name} {self.private} 1 "
+                                 f"edited {self.posted}")
+        elif command == "DLT":
+            if not self.send("MSG", f"MSG {self.name} {self.private} "
+                                    f"to delete").startswith("ERROR"):
+                self.private_count += 1
+            if self.private_count > 1 and not self.send(
+                    "DLT", f"DLT {self.name} {self.private} "
+                           f"{self.private_count}").startswith("ERROR"):
+                self.private_count -= 1
+        elif command == "CRT":
+            title = f"{self.name}c{self.posted}"
+            if not self.send("CRT", f"CRT {self.name} {title}")\
+                    .startswith("ERROR"):
+                with self.shared["lock"]:
+                    self.shared["titles"].append(title)
+        elif command == "UPD":
+            self.timed("UPD", self.upload)
+        elif command == "DWN":
+            with self.shared["lock"]:
+                files = list(self.shared["files"])
+            if files:
+                self.timed("DWN", lambda: self.download(*self.rng.choice(files)))
+            else:
+                self.timed("UPD", self.upload)
+
+    def upload(self):
+        title = f"{self.name}s"
+        fname = f"f{self.posted}.bin"
+        payload = self.shared["payloads"][
+            self.rng.randrange(len(self.shared["payloads"]))]
+        reply = self.channel.request(f"UPD {self.name} {title} {fname}")
+        if not reply.startswith("Upload ready"):
+            return reply
+        with client.open_transfer() as tcp:
+            client.send_transfer_header(tcp, client.OP_UPLOAD,
+                                        size=len(payload),
+                                        names=(self.name, title, fname))
+            status, _, _, _, message = client.read_transfer_reply(tcp)
+            if status != client.STATUS_OK:
+                return message
+            tcp.sendall(payload)
+            status, _, _, _, message = client.read_transfer_reply(tcp)
+        if status == client.STATUS_OK:
+            with self.shared["lock"]:
+                self.shared["files"].append((title, fname))
+        return message
+
+    def download(self, title, fname):
+        reply = self.channel.request(f"DWN {self.name} {title} {fname}")
+        if not reply.startswith("Download ready"):
+            return reply
+        with client.open_transfer() as tcp:
+            client.send_transfer_header(tcp, client.OP_DOWNLOAD,
+                                        names=(self.name, title, fname))
+            status, _, size, _, message = client.read_transfer_reply(tcp)
+            if status != client.STATUS_OK:
+                return message
+            buffer = bytearray(client.TRANSFER_BUFFER)
+            while size:
+                received = tcp.recv_into(buffer, min(size, len(buffer)))
+                if not received:
+                    raise ConnectionError("Download truncated")
+                size -= received
+        return "Downloaded"
+
+    def run(self, start, deadline):
+        time.sleep(max(0.0, start - time.monotonic()))
+        if not self.login():
+            return
+        self.setup()
+        commands = list(self.args.mix)
+        weights = [self.args.mix[c] for c in commands]
+        while time.monotonic() < deadline:
+            self.run_command(self.rng.choices(commands, weights)[0])
+            if self.args.think:
+                time.sleep(self.rng.expovariate(1 / self.args.think))
+        self.send("XIT", f"XIT {self.name}")
+        self.channel.close()
+
+
+def worker(index, user_count, args, run_id):
+    # One process: its users are threads sharing a title pool and a relay
+    client.SERVER_ADDRESS = args.server
+    address = args.server
+    relay = None
+    if args.loss or args.delay:
+        relay = LossyRelay(args.server, args.loss, args.delay / 1000,
+                           args.jitter / 1000, args.seed + index)
+        address = relay.address
+    rng = random.Random(args.seed * 1000 + index)
+    shared = {"lock": Lock(), "titles": [], "files": [],
+              "payloads": [rng.randbytes(size) for size in args.file_sizes]}
+    now = time.monotonic()
+    deadline = now + args.ramp + args.duration
+    users = [SimUser(f"lg{run_id}p{index}u{i}", address, shared, args,
+                     rng.random())
+             for i in range(user_count)]
+    threads = [Thread(target=user.run, daemon=True,
+                      args=(now + rng.random() * args.ramp, deadline))
+               for user in users]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(args.ramp + args.duration + 60)
+    stats = {}
+    for user in users:
+        for command, s in user.stats.items():
+            merged = stats.setdefault(
+                command, {"latencies": [], "errors": 0, "timeouts": 0})
+            merged["latencies"] += s["latencies"]
+            merged["errors"] += s["errors"]
+            merged["timeouts"] += s["timeouts"]
+    return {"commands": stats,
+            "retransmits": sum(u.channel.retransmits for u in users),
+            "timeouts": sum(u.channel.timeouts for u in users),
+            "busy": sum(u.channel.busy for u in users),
+            "dropped": relay.dropped if relay else 0}
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def summarise(results, elapsed):
+    commands = {}
+    for result in results:
+        for command, s in result["commands"].items():
+            merged = commands.setdefault(
+                command, {"latencies": [], "errors": 0, "timeouts": 0})
+            merged["latencies"] += s["latencies"]
+            merged["errors"] += s["errors"]
+            merged["timeouts"] += s["timeouts"]
+    summary = {}
+    for command, s in sorted(commands.items()):
+        latencies = sorted(s["latencies"])
+        summary[command] = {
+            "count": len(latencies),
+            "errors": s["errors"],
+            "timeouts": s["timeouts"],
+            "ops_per_sec": round(len(latencies) / elapsed, 1),
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+            "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+            "max_ms": round(latencies[-1] * 1000, 2),
+        }
+    total = sum(s["count"] for s in summary.values())
+    return {"elapsed_s": round(elapsed, 2),
+            "commands_total": total,
+            "throughput_ops_per_sec": round(total / elapsed, 1),
+            "retransmits": sum(r["retransmits"] for r in results),
+            "timeouts": sum(r["timeouts"] for r in results),
+            "busy": sum(r["busy"] for r in results),
+            "relay_dropped": sum(r["dropped"] for r in results),
+            "commands": summary}
+
+
+def print_summary(summary):
+    print(f"{'command':>8} {'count':>7} {'ops/s':>8} {'p50 ms':>8} "
+          f"{'p95 ms':>8} {'p99 ms':>8} {'errors':>7} {'timeouts':>8}")
+    for command, s in summary["commands"].items():
+        print(f"{command:>8} {s['count']:>7} {s['ops_per_sec']:>8} "
+              f"{s['p50_ms']:>8} {s['p95_ms']:>8} {s['p99_ms']:>8} "
+              f"{s['errors']:>7} {s['timeouts']:>8}")
+    print(f"{summary['commands_total']} commands in {summary['elapsed_s']}s, "
+          f"{summary['throughput_ops_per_sec']} ops/s, "
+          f"{summary['retransmits']} retransmits, "
+          f"{summary['timeouts']} timeouts, "
+          f"{summary['busy']} BUSY waits, "
+          f"{summary['relay_dropped']} datagrams dropped by the shim")
+
+
+def spawn_server(workdir, *server_args):
+    # A throwaway server.py in an empty directory, on a free port
+    with socket(AF_INET, SOCK_STREAM) as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "server.py")
+    proc = subprocess.Popen([sys.executable, script, str(port), *server_args],
+                            cwd=workdir,
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+    with socket(AF_INET, SOCK_DGRAM) as sock:
+        sock.settimeout(0.2)
+        for _ in range(50):
+            sock.sendto(b"LST", ("127.0.0.1", port))
+            try:
+                sock.recvfrom(1024)
+                break
+            except timeout:
+                continue
+    return proc, ("127.0.0.1", port)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Forum server load generator")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--server", type=parse_address,
+                        help="HOST:PORT of a running server.py")
+    target.add_argument("--spawn", action="store_true",
+                        help="start a server.py in a scratch directory")
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--users", type=int, default=200,
+                        help="simulated users, spread over the processes")
+    parser.add_argument("--duration", type=float, default=30,
+                        help="seconds of load after the ramp-up")
+    parser.add_argument("--ramp", type=float, default=2,
+                        help="seconds over which users log in")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help="relative command weights")
+    parser.add_argument("--think", type=float, default=0.5,
+                        help="mean seconds between a user's commands")
+    parser.add_argument("--file-sizes", default="4K,64K",
+                        type=lambda t: [parse_size(n) for n in t.split(",")],
+                        help="attachment sizes for UPD, picked at random")
+    parser.add_argument("--loss", type=float, default=0.0,
+                        help="UDP datagram loss probability in the shim")
+    parser.add_argument("--delay", type=float, default=0.0,
+                        help="one-way UDP delay in ms added by the shim")
+    parser.add_argument("--jitter", type=float, default=0.0,
+                        help="extra random one-way delay, up to this many ms")
+    parser.add_argument("--seed", type=int, default=9331)
+    parser.add_argument("--output", help="write the results here as JSON")
+    args = parser.parse_args()
+
+    proc = None
+    workdir = None
+    if args.spawn:
+        workdir = tempfile.TemporaryDirectory()
+        proc, args.server = spawn_server(workdir.name)
+    run_id = os.urandom(2).hex()
+    shares = [args.users // args.processes + (i < args.users % args.processes)
+              for i in range(args.processes)]
+    print(f"{args.users} users in {args.processes} processes against "
+          f"{args.server[0]}:{args.server[1]} for {args.duration}s "
+          f"(loss {args.loss:.0%}, delay {args.delay} ms)")
+    start = time.monotonic()
+    try:
+        with ProcessPoolExecutor(max_workers=args.processes) as pool:
+            futures = [pool.submit(worker, i, n, args, run_id)
+                       for i, n in enumerate(shares) if n]
+            results = [f.result() for f in futures]
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait()
+            workdir.cleanup()
+    summary = summarise(results, time.monotonic() - start)
+    summary["config"] = {
+        "users": args.users, "processes": args.processes,
+        "duration_s": args.duration, "ramp_s": args.ramp,
+        "mix": args.mix, "think_s": args.think,
+        "file_sizes": args.file_sizes, "loss": args.loss,
+        "delay_ms": args.delay, "jitter_ms": args.jitter, "seed": args.seed}
+    print_summary(summary)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
+
+# python loadgen.py --spawn --users 200 --processes 4 --duration 30
+# python loadgen.py --server 127.0.0.1:8888 --loss 0.05 --delay 20 --output results.json
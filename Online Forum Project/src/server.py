@@ -1,492 +1,4117 @@
 """
 "server.py"
 Forum Application Server
-Usage: python3 server.py SERVER_PORT
+Usage: python3 server.py SERVER_PORT [--engine threads|asyncio] [--workers N]
+                        [--log-level LEVEL] [--stats-file FILE]
 """
 
 from socket import *
-from threading import Thread, Lock
+from threading import Thread, Lock, Condition, Event, BoundedSemaphore, \
+    get_ident
 from concurrent.futures import ThreadPoolExecutor
-import sys
+from contextlib import contextmanager
+from collections import OrderedDict, Counter
+from bisect import bisect_left
+from logging.handlers import QueueHandler, QueueListener
+import argparse
+import heapq
+import math
+import array
+import asyncio
 import time
 import os
 import re
+import json
+import struct
+import hashlib
+import shutil
+import hmac
+import sqlite3
+import logging
+import queue
+import sys
+import pickle
+import signal
+import tempfile
+import zlib
+import lzma
+import multiprocessing
 
-if len(sys.argv) != 2:
-    print("=== Usage: python3 server.py SERVER_PORT ===")
-    exit(1)
 # Server configuration
 serverHost = "127.0.0.1"
-serverPort = int(sys.argv[1])
+serverPort = None
 
 # Locks for shared data, Thread synchronization
-user_lock = Lock()
-thread_lock = Lock()
+dirty_lock = Lock()
+uploads_lock = Lock()
+compact_lock = Lock()
+compact_requested = Event()
 executor = ThreadPoolExecutor(max_workers=5)
+COMMAND_WORKERS = 32  # asyncio engine: threads running forum commands
+TRANSFER_WORKERS = 16  # asyncio engine: threads running file transfers
+STREAM_WORKERS = 64  # threads running session streams, more are told BUSY
+MAX_SESSIONS = 64  # transfer sessions open at once, more are told BUSY
 # Data structures
-user_credentials = {}  # {username: password}
-active_users = {}  # {username: client_address}
-thread_metadata = {}  # {title: {"owner": str, "messages": list, "files": list}}
+credentials = None  # CredentialStore, opened in start_server()
+thread_metadata = {}  # {title: {"owner": str, "messages": list, "files": dict}}
+uploads_in_progress = set()  # attachment names currently being received
+chunked_uploads = {}  # {attachment name: ChunkedUpload}, see OP_MANIFEST
+admins = set()  # usernames allowed to run STATS from a remote address
+search_cache = True  # keep each thread's search postings next to its snapshot
+# --workers: this process owns the titles and users hashing to `shard`
+shard = 0
+shard_count = 1
+peers = None  # ShardPeers, links to the other workers
+# Logging: silent until setup_logging(), so importing the module is quiet
+log = logging.getLogger("forum")
+log.addHandler(logging.NullHandler())
+log_listener = None
+log_level = "INFO"
 # Sockets, File handling
 udpSocket = None
 tcpSocket = None
 CREDENTIALS_FILE = "credentials.txt"
+PASSWORD_ITERATIONS = 100000  # PBKDF2-SHA256 rounds for new password hashes
+VERIFY_CACHE_SIZE = 1024  # recent successful AUTHs kept to skip re-hashing
+WAL_PREFIX = "forum.wal"
+BLOB_DIR = "blobs"  # attachment contents, one file per SHA-256
+THREAD_DIR = "threads"  # one directory per thread, see thread_path()
+COMPACT_INTERVAL = 30  # seconds between background snapshot compactions
+COMPACT_BYTES = 4 * 1024 * 1024  # log size that triggers an early compaction
+SESSION_IDLE_TIMEOUT = 1800  # seconds without a request before logout
+SESSION_SWEEP_INTERVAL = 60  # seconds between idle session sweeps
+REPLY_CACHE_SIZE = 4096  # (client id, seq) replies kept for retransmits
+REPLY_CACHE_BYTES = 16 * 1024 * 1024  # and at most this many bytes of them
+FRAGMENT_SIZE = 1200  # reply bytes per datagram, stays under a 1500 MTU
+REPLY_COMPRESS_SIZE = 4096  # replies to REQZ from this size are compressed
+REPLY_ZLIB = b"\0z"  # marks a compressed reply, no text reply starts with NUL
+RESPONSE_CACHE_BYTES = 32 * 1024 * 1024  # rendered RDT/LST replies kept
+MAX_BATCH = 64  # commands per BATCH request
+SEARCH_PAGE_SIZE = 20  # SRC results per reply unless "count K" is given
+SEARCH_MAX_TERMS = 16
+PUSH_COALESCE = 0.05  # seconds a thread's changes wait to share one push
+PUSH_RTO = 0.5  # seconds before an unacknowledged push is resent, doubling
+PUSH_RETRIES = 4  # resends before a silent subscriber is dropped
+RATE_LIMIT = 100  # commands per second per user (per IP before login), 0: off
+RATE_BURST = 200  # commands a user may send at once after a quiet spell
+MAX_RATE_BUCKETS = 65536  # refilled buckets are pruned past this many
+MAX_QUEUED_DATAGRAMS = 1024  # datagrams waiting for a worker before BUSY
+BUSY_RETRY_AFTER = 0.2  # seconds a client is told to wait on a full queue
+BUSY_REPLY = "BUSY, retry after "
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500,
+                   1000)  # histogram bucket upper bounds, milliseconds
+STATS_INTERVAL = 10  # seconds between --stats-file dumps
+SHARD_FRAME = struct.Struct("!I")  # length of a message between workers
+SHARD_CALL_TIMEOUT = 10  # seconds to wait on another worker
+COMMANDS = {"LOGIN", "AUTH", "REGISTER", "XIT", "CRT", "LST", "MSG", "RDT",
+            "EDT", "DLT", "RMV", "UPD", "DWN", "BATCH", "STATS", "SRC",
+            "SUB", "UNSUB", "SES"}
+# Each command's opcode, how many fields it has and the options after
+# them. Text commands separate fields with spaces, the last one taking
+# the rest of the line, and give options as trailing "<name> <number>"
+# pairs; binary commands carry every option as a field, "" when absent.
+COMMAND_FORMS = {
+    "LOGIN": (1, 1, ("binary",)),  # binary: the newest version the client speaks
+    "AUTH": (2, 2, ()),
+    "REGISTER": (3, 2, ()),
+    "XIT": (4, 0, ()),
+    "CRT": (5, 1, ()),
+    "LST": (6, 0, ("if-version",)),
+    "MSG": (7, 2, ()),
+    "RDT": (8, 1, ("from", "count", "if-version")),
+    "SRC": (9, 1, ("from", "count")),
+    "EDT": (10, 3, ()),
+    "DLT": (11, 2, ()),
+    "RMV": (12, 1, ()),
+    "SUB": (13, 1, ()),
+    "UNSUB": (14, 1, ()),
+    "UPD": (15, 2, ()),
+    "DWN": (16, 2, ()),
+    "SES": (17, 0, ()),
+    "STATS": (18, 0, ()),
+}
+BINARY_OPCODES = {form[0]: name for name, form in COMMAND_FORMS.items()}
+# Text forms that start with the sender's name, which the session knows
+TEXT_WITH_USER = {"XIT", "CRT", "MSG", "EDT", "DLT", "RMV", "UPD", "DWN",
+                  "SUB", "UNSUB"}
+PUBLIC_COMMANDS = {"LOGIN", "AUTH", "REGISTER", "STATS"}  # need no login
+# Binary commands (agreed at LOGIN): BINARY_REQUEST, then BINARY_COMMAND
+# and each field as a BINARY_FIELD length and UTF-8 bytes. Replies are
+# BINARY_REPLY and the reply bytes, split like RSPF when long.
+BINARY_MAGIC = b"\0B"  # no text datagram starts with NUL
+BINARY_VERSION = 1
+BINARY_REQUEST = struct.Struct("!2sBB8sI")  # magic, version, flags, client id, seq
+BINARY_COMMAND = struct.Struct("!xBB")  # NUL, opcode, field count
+BINARY_FIELD = struct.Struct("!H")
+BINARY_REPLY = struct.Struct("!2sBIHH")  # magic, version, seq, fragment, count
+BINARY_ZLIB = 0x01  # request flag: long replies may be compressed, as REQZ
+# TCP transfer header: magic, version, op/status, flags, body size,
+# byte offset, length of the NUL-separated names that follow, SHA-256
+TRANSFER_HEADER = struct.Struct("!2sBBBQQH32s")
+TRANSFER_MAGIC = b"FT"
+TRANSFER_VERSION = 2
+OP_UPLOAD = 1
+OP_DOWNLOAD = 2
+OP_MANIFEST = 3  # start or resume a parallel upload, body is a JSON manifest
+OP_CHUNK = 4  # one chunk of a parallel upload, at its offset in the file
+OP_COMMIT = 5  # all chunks sent, publish the attachment
+OP_STAT = 6  # size of an attachment, for parallel ranged downloads
+OP_SESSION = 7  # open a MuxSession, the digest field holds the SES token
+STATUS_OK = 0
+STATUS_ERROR = 1
+FLAG_CHECKSUM = 0x01
+FLAG_RESUME = 0x02  # keep the .part file of a dropped upload and resume it
+FLAG_ZLIB = 0x04  # body sent as compressed frames, see send_compressed()
+FLAG_LZMA = 0x08
+CODECS = FLAG_ZLIB | FLAG_LZMA
+ZLIB_LEVEL = 1  # ~5x on logs at ~90 MB/s
+LZMA_PRESET = 1  # ~7x on logs at ~12 MB/s, for slow links
+COMPRESS_FRAME = struct.Struct("!I")  # length of a compressed frame, 0 ends
+MAX_COMPRESS_FRAME = 4 * 1024 * 1024
+COMPRESS_SAMPLE = 64 * 1024  # bytes test-compressed to decide if worth it
+COMPRESS_MIN_SAVING = 0.1
+# Formats that are compressed already, not worth compressing again
+COMPRESSED_TYPES = {
+    ".gz", ".tgz", ".bz2", ".xz", ".lzma", ".zst", ".zip", ".7z", ".rar",
+    ".jar", ".apk", ".docx", ".xlsx", ".pptx", ".odt", ".epub", ".pdf",
+    ".png", ".jpg", ".jpeg", ".gif", ".webp", ".heic", ".mp3", ".aac",
+    ".ogg", ".flac", ".mp4", ".m4a", ".mkv", ".mov", ".avi", ".webm"}
+TRANSFER_CHUNK = 1024 * 1024
+TRANSFER_TIMEOUT = 60  # seconds a transfer connection may stall
+MAX_TRANSFERS = 64  # transfer connections at once, more are told BUSY
+TRANSFER_RETRY_AFTER = 1  # seconds, told to a transfer turned away
+BANDWIDTH_LIMIT = 0  # bytes/s shared by all transfers, 0 for no limit
+USER_BANDWIDTH = 0  # bytes/s cap on one user's transfers, 0 for no cap
+BANDWIDTH_QUANTUM = 64 * 1024  # bytes a throttled transfer moves at a time
+BANDWIDTH_BURST = 0.1  # seconds of a user's rate it may save up
+MUX_FRAME = struct.Struct("!IBI")  # session frame: stream id, kind, length
+MUX_DATA = 0
+MUX_CLOSE = 1  # the sender is done with the stream
+MUX_CHUNK = 256 * 1024  # largest frame payload, so streams take turns
+MUX_WINDOW = 1024 * 1024  # bytes buffered per stream before reading stalls
+MUX_STREAMS = 256  # streams open at once on one session
+MUX_IDLE_TIMEOUT = 60  # seconds a session may go without a frame
+SESSION_SECRET = os.urandom(32)  # keys SES tokens, --workers children share it
+PARTIAL_UPLOAD_TTL = 24 * 3600  # seconds an abandoned .part file is kept
+MAX_UPLOAD_SIZE = 8 * 1024 ** 3
+MAX_MANIFEST_SIZE = 4 * 1024 * 1024
+TOKEN = re.compile(r"\w+")
+MSG_LINE = re.compile(r"^\d+ (.+?): (.*)$")
+BLOB_NAME = re.compile(r"[0-9a-f]{64}")
+UPLOAD_LINE = re.compile(r"^(\S+) uploaded (.+?)(?: ([0-9a-f]{64}))?$")
+
+
+def hash_password(password, iterations=PASSWORD_ITERATIONS):
+    salt = os.urandom(16)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations)
+    return f"pbkdf2_sha256${iterations}${salt.hex()}${digest.hex()}"
+
+
+def check_password(record, password):
+    # Records without the pbkdf2 prefix are plaintext from an old
+    # credentials.txt, still accepted until the user next logs in
+    if not record.startswith("pbkdf2_sha256$"):
+        return hmac.compare_digest(record.encode(), password.encode())
+    _, iterations, salt, digest = record.split("$")
+    check = hashlib.pbkdf2_hmac("sha256", password.encode(),
+                                bytes.fromhex(salt), int(iterations))
+    return hmac.compare_digest(check.hex(), digest)
+
+
+class CredentialStore:
+    """
+    Usernames and salted password hashes in an append-only file, one
+    "username record" line per change; a later line for the same name
+    wins. Registering appends one line instead of rewriting the file, and
+    inserts are atomic under self.lock. Recent successful AUTHs are
+    cached under an HMAC keyed by a secret that never leaves the process,
+    so a repeated AUTH skips the slow PBKDF2 check.
+    """
+
+    def __init__(self, fname, cache_size=VERIFY_CACHE_SIZE):
+        self.fname = fname
+        self.lock = Lock()
+        self.verified = OrderedDict()  # {(username, HMAC): None}, LRU
+        self.cache_secret = os.urandom(32)
+        self.cache_size = cache_size
+        self.records = {}  # {username: record}
+        self.file = None
+
+    def load(self):
+        if os.path.exists(self.fname):
+            with open(self.fname, "r") as f:
+                self.records = dict(line.split(" ", 1)
+                                    for line in f.read().splitlines() if line)
+        self.file = open(self.fname, "a")
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, username):
+        return username in self.records
+
+    def lookup(self, username):
+        return self.records.get(username)
+
+    def store(self, username, record, new):
+        # Caller holds self.lock; False if `new` and the name is taken
+        if new and username in self.records:
+            return False
+        self.file.write(f"{username} {record}\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.records[username] = record
+        return True
+
+    def register(self, username, password):
+        record = hash_password(password)
+        with timed(self.lock, "credentials"):
+            return self.store(username, record, new=True)
+
+    def verify(self, username, password):
+        record = self.lookup(username)
+        if record is None:
+            return False
+        key = self.cache_key(username, record, password)
+        with timed(self.lock, "credentials"):
+            if key in self.verified:
+                self.verified.move_to_end(key)
+                return True
+        # Failures are not cached: every wrong guess pays for PBKDF2
+        if not check_password(record, password):
+            return False
+        with timed(self.lock, "credentials"):
+            if not record.startswith("pbkdf2_sha256$") and \
+                    self.lookup(username) == record:
+                # Upgrade a plaintext entry now that we know the password
+                record = hash_password(password)
+                self.store(username, record, new=False)
+                key = self.cache_key(username, record, password)
+            self.verified[key] = None
+            while len(self.verified) > self.cache_size:
+                self.verified.popitem(last=False)
+        return True
+
+    def cache_key(self, username, record, password):
+        # Keyed by the process's secret, so a copy of the cache is no
+        # faster to guess passwords against than the PBKDF2 records
+        return username, hmac.new(self.cache_secret,
+                                  f"{record}\0{password}".encode(),
+                                  hashlib.sha256).digest()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+
+class SqliteCredentialStore(CredentialStore):
+    """
+    The same store in an SQLite database: nothing is loaded at startup
+    and the primary key makes concurrent registrations of one name
+    atomic. An empty database imports the text file on first open.
+    """
+
+    def __init__(self, db_name, import_fname=CREDENTIALS_FILE):
+        super().__init__(db_name)
+        self.import_fname = import_fname
+        self.db = None
+        self.db_lock = Lock()  # the connection is shared by all workers
+
+    def load(self):
+        self.db = sqlite3.connect(self.fname, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS users "
+                        "(name TEXT PRIMARY KEY, record TEXT NOT NULL)")
+        empty = self.db.execute("SELECT 1 FROM users LIMIT 1").fetchone() \
+            is None
+        if empty and os.path.exists(self.import_fname):
+            with open(self.import_fname, "r") as f:
+                rows = [line.split(" ", 1)
+                        for line in f.read().splitlines() if line]
+            with self.db:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO users VALUES (?, ?)", rows)
+            log.info(f"*Imported {len(rows)} users from '{self.import_fname}'")
+
+    def __len__(self):
+        with self.db_lock:
+            return self.db.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def __contains__(self, username):
+        return self.lookup(username) is not None
+
+    def lookup(self, username):
+        with self.db_lock:
+            row = self.db.execute("SELECT record FROM users WHERE name = ?",
+                                  (username,)).fetchone()
+        return row[0] if row else None
+
+    def store(self, username, record, new):
+        try:
+            with self.db_lock, self.db:
+                self.db.execute(
+                    "INSERT INTO users VALUES (?, ?)" if new else
+                    "INSERT OR REPLACE INTO users VALUES (?, ?)",
+                    (username, record))
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def close(self):
+        if self.db:
+            self.db.close()
+
+
+def load_credentials(db_name=None):
+    global credentials
+    if db_name:
+        credentials = SqliteCredentialStore(db_name)
+    else:
+        credentials = CredentialStore(CREDENTIALS_FILE)
+    log.info(f"Loading credentials from '{credentials.fname}'...")
+    credentials.load()
+    log.info(f"*Loaded {len(credentials)} user credentials")
+
+
+class WriteAheadLog:
+    """
+    Append-only log of thread mutations, one JSON record per line.
+    Every record gets a log sequence number (LSN); callers wait in sync()
+    and one of them fsyncs on behalf of everyone queued behind it.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.cond = Condition()
+        self.file = None
+        self.segment = 0
+        self.sealed = []
+        self.lsn = 0
+        self.synced = 0
+        self.syncing = False
+        self.size = 0
+
+    def segment_name(self, number):
+        return f"{self.prefix}.{number:06d}"
+
+    def replay(self, fnames):
+        head = self.prefix + "."
+        numbers = sorted(int(fname[len(head):]) for fname in fnames
+                         if fname.startswith(head) and fname[len(head):].isdigit())
+        for number in numbers:
+            self.segment = max(self.segment, number)
+            self.sealed.append(number)
+            with open(self.segment_name(number), "r", encoding="utf-8") as f:
+                for line in f:
+                    # A torn write can only be at the tail of a segment
+                    if not line.endswith("\n"):
+                        break
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    self.lsn = max(self.lsn, record["lsn"])
+                    yield record
+
+    def open(self, min_lsn=0):
+        with self.cond:
+            self.lsn = max(self.lsn, min_lsn)
+            self.synced = self.lsn
+            self.segment += 1
+            self.file = open(self.segment_name(self.segment), "a",
+                             encoding="utf-8")
+            self.size = 0
+
+    def append(self, record):
+        with self.cond:
+            self.lsn += 1
+            record["lsn"] = self.lsn
+            line = json.dumps(record) + "\n"
+            self.file.write(line)
+            self.size += len(line)
+            return self.lsn
+
+    def sync(self, lsn):
+        with self.cond:
+            while self.synced < lsn:
+                if self.syncing:
+                    self.cond.wait()
+                    continue
+                self.syncing = True
+                target = self.lsn
+                self.file.flush()
+                fd = self.file.fileno()
+                self.cond.release()
+                try:
+                    os.fsync(fd)
+                finally:
+                    self.cond.acquire()
+                    self.syncing = False
+                    self.cond.notify_all()
+                self.synced = max(self.synced, target)
+
+    def rotate(self):
+        with self.cond:
+            while self.syncing:
+                self.cond.wait()
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.synced = self.lsn
+            self.sealed.append(self.segment)
+            self.segment += 1
+            self.file = open(self.segment_name(self.segment), "a",
+                             encoding="utf-8")
+            self.size = 0
+            return self.sealed[-1]
+
+    def close(self):
+        with self.cond:
+            while self.syncing:
+                self.cond.wait()
+            if self.file:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.file.close()
+                self.file = None
+
+    def drop(self, upto):
+        with self.cond:
+            dropped = [n for n in self.sealed if n <= upto]
+            self.sealed = [n for n in self.sealed if n > upto]
+        for number in dropped:
+            os.remove(self.segment_name(number))
+
+
+class RWLock:
+    """
+    Shared/exclusive lock. Waiting writers block new readers so a steady
+    stream of RDTs cannot starve a MSG on the same thread.
+    """
+
+    def __init__(self):
+        self.cond = Condition(Lock())
+        self.readers = 0
+        self.writer = False
+        self.writers_waiting = 0
+
+    def acquire_read(self):
+        with self.cond:
+            while self.writer or self.writers_waiting:
+                self.cond.wait()
+            self.readers += 1
+
+    def release_read(self):
+        with self.cond:
+            self.readers -= 1
+            if self.readers == 0:
+                self.cond.notify_all()
+
+    def acquire_write(self):
+        with self.cond:
+            self.writers_waiting += 1
+            while self.writer or self.readers:
+                self.cond.wait()
+            self.writers_waiting -= 1
+            self.writer = True
+
+    def release_write(self):
+        with self.cond:
+            self.writer = False
+            self.cond.notify_all()
+
+
+class LockManager:
+    """
+    One RWLock per thread title. The registry lock is only held to add or
+    drop a title (CRT/RMV) and to look a lock up, never across disk I/O.
+    """
+
+    def __init__(self):
+        self.registry = Lock()
+        self.locks = {}  # {title: RWLock}
+
+    def reset(self, titles):
+        with self.registry:
+            self.locks = {title: RWLock() for title in titles}
+
+    def add(self, title):
+        # Caller holds self.registry
+        self.locks[title] = RWLock()
+
+    def drop(self, title):
+        # Caller holds self.registry and the title's write lock
+        del self.locks[title]
+
+    def acquire(self, title, write):
+        while True:
+            with self.registry:
+                lock = self.locks.get(title)
+            if lock is None:
+                return None
+            start = time.perf_counter()
+            if write:
+                lock.acquire_write()
+            else:
+                lock.acquire_read()
+            metrics.lock_wait("thread", time.perf_counter() - start)
+            # The title may have been removed (or re-created) while we waited
+            if self.locks.get(title) is lock:
+                return lock
+            if write:
+                lock.release_write()
+            else:
+                lock.release_read()
+
+    @contextmanager
+    def reading(self, title):
+        lock = self.acquire(title, write=False)
+        try:
+            yield thread_metadata.get(title) if lock else None
+        finally:
+            if lock:
+                lock.release_read()
+
+    @contextmanager
+    def writing(self, title):
+        lock = self.acquire(title, write=True)
+        try:
+            yield thread_metadata.get(title) if lock else None
+        finally:
+            if lock:
+                lock.release_write()
+
+
+class SessionTable:
+    """
+    Logged-in users indexed both ways: by_user answers "is this user
+    active", by_addr answers "who sent this datagram" without a scan.
+    Both maps only change together under self.lock; lookups are plain
+    dict reads. With --workers every worker keeps a full copy: the worker
+    owning a username makes the change and `replicate` copies it to the
+    others before the client hears back.
+    """
+
+    def __init__(self, idle_timeout):
+        self.lock = Lock()
+        self.idle_timeout = idle_timeout
+        self.by_user = {}  # {username: client_address}
+        self.by_addr = {}  # {client_address: username}
+        self.last_seen = {}  # {username: time.monotonic()}
+        self.lookups = 0
+        self.expired = 0
+        self.lookup_rate = 0.0
+        self.rate_mark = (time.monotonic(), 0)
+        self.replicate = None  # replicate(op, username, client_address)
+
+    def lookup(self, client_addr):
+        self.lookups += 1
+        user = self.by_addr.get(client_addr)
+        if user is not None:
+            self.last_seen[user] = time.monotonic()
+        return user
+
+    def active_elsewhere(self, username, client_addr):
+        # Address of the user's session if it belongs to another client
+        addr = self.by_user.get(username)
+        return addr if addr is not None and addr != client_addr else None
+
+    def login(self, username, client_addr):
+        with timed(self.lock, "session"):
+            addr = self.active_elsewhere(username, client_addr)
+            if addr is not None:
+                return addr
+            # One session per client address
+            previous = self.by_addr.get(client_addr)
+            if previous is not None and previous != username:
+                self._remove(previous)
+            self._add(username, client_addr)
+        if self.replicate:
+            self.replicate("login", username, client_addr)
+        return None
+
+    def logout(self, username):
+        with timed(self.lock, "session"):
+            if username not in self.by_user:
+                return False
+            self._remove(username)
+        if self.replicate:
+            self.replicate("logout", username, None)
+        return True
+
+    def apply(self, op, username, client_addr):
+        # A login or logout already decided by the worker owning `username`
+        with timed(self.lock, "session"):
+            if username in self.by_user:
+                self._remove(username)
+            if op == "login":
+                previous = self.by_addr.get(client_addr)
+                if previous is not None:
+                    self._remove(previous)
+                self._add(username, client_addr)
+
+    def _add(self, username, client_addr):
+        self.by_user[username] = client_addr
+        self.by_addr[client_addr] = username
+        self.last_seen[username] = time.monotonic()
+
+    def _remove(self, username):
+        addr = self.by_user.pop(username)
+        self.by_addr.pop(addr, None)
+        self.last_seen.pop(username, None)
+
+    def seen_since(self, mark):
+        return [user for user, seen in list(self.last_seen.items())
+                if seen >= mark]
+
+    def touch(self, users):
+        # Activity other workers saw, so the owner does not expire them
+        now = time.monotonic()
+        for user in users:
+            if user in self.last_seen:
+                self.last_seen[user] = now
+
+    def expire_idle(self, owns=None):
+        now = time.monotonic()
+        with timed(self.lock, "session"):
+            idle = [user for user, seen in self.last_seen.items()
+                    if now - seen > self.idle_timeout and
+                    (owns is None or owns(user))]
+            for user in idle:
+                self._remove(user)
+            self.expired += len(idle)
+            mark_time, mark_lookups = self.rate_mark
+            if now > mark_time:
+                self.lookup_rate = (self.lookups - mark_lookups) / (now - mark_time)
+            self.rate_mark = (now, self.lookups)
+        if self.replicate:
+            for user in idle:
+                self.replicate("logout", user, None)
+        return idle
+
+    def stats(self):
+        return {"active_sessions": len(self.by_user),
+                "lookups": self.lookups,
+                "lookups_per_sec": round(self.lookup_rate, 1),
+                "expired_sessions": self.expired}
+
+
+class ReplyCache:
+    """
+    Replies to enveloped requests ("REQ <client id> <seq> <command>"),
+    keyed by (client id, seq). A retransmitted request gets the stored
+    reply instead of running the command a second time; one that arrives
+    while the original is still running is dropped, the client will
+    retransmit again. Oldest entries are evicted beyond `capacity`
+    replies or `max_bytes` of reply datagrams.
+    """
+
+    def __init__(self, capacity, max_bytes):
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        self.replies = OrderedDict()  # {(client id, seq): [datagrams]}
+        self.running = set()  # keys whose command has not finished yet
+        self.bytes = 0
+        self.hits = 0
+
+    def begin(self, key):
+        # (True, reply) for a duplicate, reply is None if still running;
+        # (False, None) when the caller should run the command
+        with self.lock:
+            if key in self.replies:
+                self.hits += 1
+                self.replies.move_to_end(key)
+                return True, self.replies[key]
+            if key in self.running:
+                self.hits += 1
+                return True, None
+            self.running.add(key)
+            return False, None
+
+    def finish(self, key, reply):
+        with self.lock:
+            self.running.discard(key)
+            if reply is None:
+                return
+            self.replies[key] = reply
+            self.bytes += sum(len(d) for d in reply)
+            while len(self.replies) > self.capacity or \
+                    self.bytes > self.max_bytes:
+                _, old = self.replies.popitem(last=False)
+                self.bytes -= sum(len(d) for d in old)
+
+
+class ResponseCache:
+    """
+    Rendered RDT and LST replies, keyed by request and tagged with the
+    version they were rendered at: a thread's LSN, or listing_version for
+    LST. A lookup only hits when the version still matches, and every
+    write drops the title's entries in apply_record(). Least recently used
+    entries are evicted once the cached text passes `max_bytes`.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        self.entries = OrderedDict()  # {key: (title, version, text)}
+        self.by_title = {}  # {title: set of keys}, None for the listing
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] != version:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, key, title, version, text):
+        with self.lock:
+            self._remove(key)
+            self.entries[key] = (title, version, text)
+            self.by_title.setdefault(title, set()).add(key)
+            self.bytes += len(text)
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+
+    def invalidate(self, title):
+        with self.lock:
+            for key in list(self.by_title.get(title, ())):
+                self._remove(key)
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        title, _, text = entry
+        self.bytes -= len(text)
+        keys = self.by_title[title]
+        keys.discard(key)
+        if not keys:
+            del self.by_title[title]
+
+
+def tokenize(text):
+    return TOKEN.findall(text.lower())
+
+
+class SearchIndex:
+    """
+    Inverted index behind SRC. Postings are kept per thread,
+    {title: {token: {message id: count}}}, with {token: titles} on top to
+    find the threads holding a token and per-token message counts for
+    IDF. Message ids never change while a message exists (DLT does not
+    renumber them), and apply_record() keeps the index in step with every
+    mutation, live or replayed.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.clear()
+
+    def clear(self):
+        self.threads = {}
+        self.titles = {}  # {token: set of titles}
+        self.df = Counter()  # {token: messages containing it}
+        self.messages = 0
+
+    def add(self, title, msg_id, text):
+        counts = Counter(tokenize(text))
+        with self.lock:
+            thread = self.threads.setdefault(title, {})
+            for token, count in counts.items():
+                thread.setdefault(token, {})[msg_id] = count
+                self.titles.setdefault(token, set()).add(title)
+                self.df[token] += 1
+            self.messages += 1
+
+    def remove(self, title, msg_id, text):
+        with self.lock:
+            thread = self.threads.get(title, {})
+            for token in set(tokenize(text)):
+                ids = thread.get(token)
+                if ids is None or ids.pop(msg_id, None) is None:
+                    continue
+                self.df[token] -= 1
+                if not self.df[token]:
+                    del self.df[token]
+                if not ids:
+                    del thread[token]
+                    self.titles[token].discard(title)
+                    if not self.titles[token]:
+                        del self.titles[token]
+            self.messages -= 1
+
+    def drop(self, title):
+        with self.lock:
+            thread = self.threads.pop(title, {})
+            ids = set()
+            for token, postings in thread.items():
+                ids.update(postings)
+                self.df[token] -= len(postings)
+                if not self.df[token]:
+                    del self.df[token]
+                self.titles[token].discard(title)
+                if not self.titles[token]:
+                    del self.titles[token]
+            self.messages -= len(ids)
+
+    def search(self, tokens, limit):
+        # Messages holding every token, ranked by TF-IDF; returns the total
+        # and the best `limit` as (score, title, message id)
+        with self.lock:
+            tokens = sorted(set(tokens), key=lambda t: self.df.get(t, 0))
+            if not tokens or tokens[0] not in self.df:
+                return 0, []
+            idf = {t: math.log(1 + self.messages / self.df[t])
+                   for t in tokens}
+            hits = []
+            # Walk the rarest token's postings, the shortest list
+            for title in self.titles[tokens[0]]:
+                thread = self.threads[title]
+                lists = [thread.get(token) for token in tokens]
+                if None in lists:
+                    continue
+                for msg_id in lists[0]:
+                    score = 0.0
+                    for token, postings in zip(tokens, lists):
+                        count = postings.get(msg_id)
+                        if count is None:
+                            break
+                        score += (1 + math.log(count)) * idf[token]
+                    else:
+                        hits.append((score, title, msg_id))
+        return len(hits), heapq.nsmallest(
+            limit, hits, key=lambda hit: (-hit[0], hit[1], hit[2]))
+
+    def export(self, title, meta):
+        # The thread's postings by message number, saved with its snapshot
+        numbers = {entry["id"]: number for number, entry
+                   in enumerate(meta["messages"], 1)}
+        with self.lock:
+            return {token: [[numbers[msg_id], count]
+                            for msg_id, count in postings.items()
+                            if msg_id in numbers]
+                    for token, postings in self.threads.get(title, {}).items()}
+
+    def load(self, title, postings):
+        # Saved postings of a freshly parsed thread, whose message ids are
+        # its message numbers
+        with self.lock:
+            thread = self.threads.setdefault(title, {})
+            ids = set()
+            for token, pairs in postings.items():
+                thread[token] = dict(map(tuple, pairs))
+                self.titles.setdefault(token, set()).add(title)
+                self.df[token] += len(pairs)
+                ids.update(thread[token])
+            self.messages += len(ids)
+
+
+class PushNotifier:
+    """
+    SUB subscriptions and the pushes that spare subscribers from polling
+    RDT. log_mutation() hands every change to publish(), and a pusher
+    thread sends each subscribed thread's changes to the address its
+    subscribers' sessions have in active_users, as one datagram:
+        PSH <push id> <title>
+        MSG <number> <user>: <message>     (one delta line per change,
+        EDT <number> <user>: <message>      numbered as the thread
+        DLT <number> <user>                 stood after it)
+        UPD <user> <file>
+        RMV <user>
+    Changes made within PUSH_COALESCE of a thread's previous push wait for
+    the next one, so a busy thread costs a subscriber one datagram per
+    interval rather than one per post. The client answers each push with
+    "PSHACK <title> <push id>"; until then it is resent with a doubling
+    timeout, and a subscriber that misses PUSH_RETRIES resends is dropped.
+    """
+
+    def __init__(self):
+        self.cond = Condition()
+        self.subscribers = {}  # {title: {username: client_address}}
+        self.queued = {}  # {title: [delta line, ...]} for the next push
+        self.queued_lsn = {}  # {title: LSN of its last queued change}
+        self.due = {}  # {title: time.monotonic() its next push goes out}
+        self.last_push = {}  # {title: time of its previous push}
+        self.pending = {}  # {(push id, address): [datagram, title, user,
+                           #  resends, deadline]}
+        self.next_id = 0
+        self.send = None  # sendto(datagram, address), set by the UDP engine
+        self.pushed = 0
+        self.resent = 0
+        self.acked = 0
+        self.dropped = 0
+        self.coalesced = 0  # changes that rode along in another's push
+
+    def subscribe(self, title, username, client_addr):
+        with self.cond:
+            self.subscribers.setdefault(title, {})[username] = client_addr
+
+    def unsubscribe(self, title, username):
+        with self.cond:
+            return self._unsubscribe(title, username)
+
+    def _unsubscribe(self, title, username):
+        users = self.subscribers.get(title)
+        if users is None or users.pop(username, None) is None:
+            return False
+        if not users:
+            del self.subscribers[title]
+            self.last_push.pop(title, None)
+        return True
+
+    def publish(self, record):
+        # Caller holds the thread's write lock, so the message numbers in
+        # the deltas are those of the change itself
+        op, title = record["op"], record["t"]
+        if title not in self.subscribers or op == "CRT":
+            return
+        if op == "MSG":
+            number = len(thread_metadata[title]["messages"])
+            line = f"MSG {number} {record['u']}: {record['c']}"
+        elif op == "EDT":
+            line = f"EDT {record['n']} {record['u']}: {record['c']}"
+        elif op == "DLT":
+            line = f"DLT {record['n']} {record['u']}"
+        elif op == "UPD":
+            line = f"UPD {record['u']} {record['f']}"
+        else:
+            line = f"RMV {record['u']}"
+        now = time.monotonic()
+        with self.cond:
+            lines = self.queued.setdefault(title, [])
+            if lines:
+                self.coalesced += 1
+            else:
+                self.due[title] = max(
+                    now, self.last_push.get(title, 0) + PUSH_COALESCE)
+            lines.append(line)
+            self.queued_lsn[title] = record["lsn"]
+            self.cond.notify()
+
+    def ack(self, title, push_id, client_addr):
+        with self.cond:
+            if self.pending.pop((push_id, client_addr), None) is not None:
+                self.acked += 1
+
+    def run(self):
+        while True:
+            with self.cond:
+                now = time.monotonic()
+                wake = min(list(self.due.values()) +
+                           [entry[4] for entry in self.pending.values()],
+                           default=now + 60)
+                if wake > now:
+                    self.cond.wait(wake - now)
+                    continue
+                ready = [title for title, due in self.due.items()
+                         if due <= now]
+                batches = []
+                for title in ready:
+                    del self.due[title]
+                    self.last_push[title] = now
+                    batches.append((title, self.queued.pop(title),
+                                    self.queued_lsn.pop(title)))
+                resends = self.expire(now)
+            for title, lines, lsn in batches:
+                # Only changes that are on disk are announced
+                wal.sync(lsn)
+                self.push(title, lines)
+            for datagram, client_addr in resends:
+                self.send_to(datagram, client_addr)
+
+    def expire(self, now):
+        # Pushes whose timer ran out: resent, or given up together with
+        # the subscriber. Caller holds self.cond
+        resends = []
+        for key, entry in list(self.pending.items()):
+            datagram, title, username, count, deadline = entry
+            if deadline > now:
+                continue
+            if count >= PUSH_RETRIES:
+                del self.pending[key]
+                self.dropped += 1
+                if self._unsubscribe(title, username):
+                    log.info(f"*Dropped {username} from {title}: pushes "
+                             f"not acknowledged")
+                continue
+            entry[3] += 1
+            entry[4] = now + PUSH_RTO * 2 ** entry[3]
+            self.resent += 1
+            resends.append((datagram, key[1]))
+        return resends
+
+    def push(self, title, lines):
+        datagrams = []
+        with self.cond:
+            users = dict(self.subscribers.get(title, {}))
+            for body in self.pack(lines):
+                self.next_id += 1
+                datagrams.append((self.next_id,
+                                  f"PSH {self.next_id} {title}\n{body}".encode()))
+        now = time.monotonic()
+        sends = []
+        for username, client_addr in users.items():
+            if active_users.get(username) != client_addr:
+                # Logged out, or logged in again from another client
+                self.unsubscribe(title, username)
+                continue
+            with self.cond:
+                for push_id, datagram in datagrams:
+                    self.pending[(push_id, client_addr)] = \
+                        [datagram, title, username, 0, now + PUSH_RTO]
+                    self.pushed += 1
+            sends += [(datagram, client_addr) for _, datagram in datagrams]
+        if lines[-1].startswith("RMV "):
+            with self.cond:
+                self.subscribers.pop(title, None)
+                self.last_push.pop(title, None)
+        for datagram, client_addr in sends:
+            self.send_to(datagram, client_addr)
+        log.debug("*Pushed %d change(s) in %s to %d subscriber(s)",
+                  len(lines), title, len(users))
+
+    @staticmethod
+    def pack(lines):
+        # Delta lines joined into bodies of up to FRAGMENT_SIZE bytes; a
+        # longer line goes alone
+        bodies, body = [], ""
+        for line in lines:
+            if body and len(body) + 1 + len(line) > FRAGMENT_SIZE:
+                bodies.append(body)
+                body = ""
+            body = f"{body}\n{line}" if body else line
+        bodies.append(body)
+        return bodies
+
+    def send_to(self, datagram, client_addr):
+        try:
+            self.send(datagram, client_addr)
+        except (OSError, TypeError) as e:
+            log.warning(f"*ERROR: Push to {client_addr} failed - {e}")
+
+    def stats(self):
+        with self.cond:
+            return {"threads": len(self.subscribers),
+                    "subscriptions": sum(map(len, self.subscribers.values())),
+                    "pending": len(self.pending),
+                    "pushed": self.pushed,
+                    "resent": self.resent,
+                    "acked": self.acked,
+                    "dropped": self.dropped,
+                    "coalesced": self.coalesced}
+
+
+class AdmissionControl:
+    """
+    Decides, before a datagram is queued for the executor, whether it runs
+    or is answered "BUSY, retry after <seconds>". Each user (each client
+    IP before login) has a token bucket refilled at `rate` commands per
+    second up to `burst`, and a BATCH costs one token per command in it.
+    Whatever the buckets allow, at most `max_queued` datagrams wait for a
+    worker, so a flood costs bounded memory and queueing delay instead of
+    stretching everyone's latency.
+    """
+
+    def __init__(self, rate, burst, max_queued):
+        self.lock = Lock()
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_queued = max_queued
+        self.buckets = {}  # {user or IP: [tokens, time.monotonic()]}
+        self.limited = 0  # turned away by a user's bucket
+        self.shed = 0  # turned away by the full queue
+
+    def check(self, key, cost, depth):
+        # Seconds the client should wait, or None to run the request
+        if self.max_queued and depth >= self.max_queued:
+            with self.lock:
+                self.shed += 1
+            return BUSY_RETRY_AFTER
+        if not self.rate:
+            return None
+        cost = min(cost, self.burst)
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                if len(self.buckets) >= MAX_RATE_BUCKETS:
+                    self.prune(now)
+                bucket = self.buckets[key] = [self.burst, now]
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens < cost:
+                bucket[0] = tokens
+                self.limited += 1
+                return (cost - tokens) / self.rate
+            bucket[0] = tokens - cost
+        return None
+
+    def prune(self, now):
+        # A bucket that has refilled is the same as no bucket. Caller
+        # holds self.lock
+        for key, (tokens, stamp) in list(self.buckets.items()):
+            if tokens + (now - stamp) * self.rate >= self.burst:
+                del self.buckets[key]
+
+    def sweep(self):
+        with self.lock:
+            self.prune(time.monotonic())
+
+    def stats(self):
+        return {"rate": self.rate, "burst": self.burst,
+                "max_queued": self.max_queued, "limited": self.limited,
+                "shed": self.shed, "buckets": len(self.buckets)}
+
+
+class BandwidthScheduler:
+    """
+    Fair shares of transfer bandwidth. While n users have transfers open,
+    each may move min(total / n, per_user) bytes per second, however many
+    connections it opens: all of a user's transfers draw on one token
+    bucket, and a transfer that overdraws it sleeps off the debt (see
+    ThrottledConn). A "user" is an account from bandwidth_account(): the
+    session's user, or the client IP for plain connections. Both limits
+    are bytes per second, 0 for none. At most
+    max_transfers connections are served at once; later ones are told
+    BUSY.
+    """
 
+    def __init__(self, total, per_user, max_transfers):
+        self.lock = Lock()
+        self.total = total
+        self.per_user = per_user
+        self.max_transfers = max_transfers
+        self.transfers = 0
+        self.users = {}  # {user: [open transfers, tokens, time.monotonic()]}
+        self.busy = 0  # connections turned away
+        self.throttled = 0.0  # seconds transfers spent waiting for tokens
 
-def load_credentials():
-    global user_credentials
-    print(f"Loading credentials from '{CREDENTIALS_FILE}'...")
-    with open(CREDENTIALS_FILE, "r") as f:
+    def limited(self):
+        return bool(self.total or self.per_user)
+
+    def enter(self):
+        with self.lock:
+            if self.max_transfers and self.transfers >= self.max_transfers:
+                self.busy += 1
+                return False
+            self.transfers += 1
+            return True
+
+    def leave(self):
+        with self.lock:
+            self.transfers -= 1
+
+    def join(self, user):
+        with self.lock:
+            entry = self.users.get(user)
+            if entry is None:
+                entry = self.users[user] = [0, 0.0, time.monotonic()]
+            entry[0] += 1
+
+    def part(self, user):
+        with self.lock:
+            entry = self.users[user]
+            entry[0] -= 1
+            if not entry[0]:
+                del self.users[user]
+
+    def share(self):
+        # Bytes per second for each user with open transfers
+        rates = [rate for rate in (self.per_user,
+                                   self.total / max(len(self.users), 1))
+                 if rate]
+        return min(rates) if rates else 0
+
+    def charge(self, user, nbytes):
+        with self.lock:
+            rate = self.share()
+            if not rate:
+                return
+            entry = self.users[user]
+            now = time.monotonic()
+            burst = max(BANDWIDTH_QUANTUM, rate * BANDWIDTH_BURST)
+            tokens = min(burst, entry[1] + (now - entry[2]) * rate) - nbytes
+            entry[1], entry[2] = tokens, now
+            wait = -tokens / rate if tokens < 0 else 0
+            self.throttled += wait
+        if wait:
+            time.sleep(wait)
+
+    def stats(self):
+        with self.lock:
+            return {"total_bytes_per_sec": self.total,
+                    "user_bytes_per_sec": self.per_user,
+                    "share_bytes_per_sec": round(self.share()),
+                    "max_transfers": self.max_transfers,
+                    "transfers": self.transfers,
+                    "users": len(self.users),
+                    "busy": self.busy,
+                    "throttled_sec": round(self.throttled, 1)}
+
+
+class Histogram:
+    """
+    Latency samples counted into the fixed LATENCY_BUCKETS, so memory
+    stays constant however many requests are timed. Percentiles are
+    read off the buckets: the upper bound of the bucket they fall in.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)  # last one: overflow
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, ms):
+        self.counts[bisect_left(LATENCY_BUCKETS, ms)] += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+
+    def percentile(self, p):
+        rank = sum(self.counts) * p / 100
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS + (self.max,), self.counts):
+            seen += count
+            if count and seen >= rank:
+                return round(min(bound, self.max), 3)
+        return 0.0
+
+    def snapshot(self):
+        count = sum(self.counts)
+        bounds = [str(b) for b in LATENCY_BUCKETS] + ["inf"]
+        return {"count": count,
+                "mean_ms": round(self.total / count, 3) if count else 0.0,
+                "p50_ms": self.percentile(50),
+                "p90_ms": self.percentile(90),
+                "p99_ms": self.percentile(99),
+                "max_ms": round(self.max, 3),
+                # Cumulative would repeat itself, only non-empty buckets
+                "buckets_ms": {f"le_{b}": c
+                               for b, c in zip(bounds, self.counts) if c}}
+
+
+class Metrics:
+    """
+    Server counters for STATS and --stats-file: per-command counts, errors
+    and latency, time spent waiting for locks, how many datagrams wait for
+    a command worker, and TCP transfer bytes. Each record is a few
+    additions under one short lock.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.started = time.monotonic()
+        self.commands = {}  # {command: [errors, Histogram]}
+        self.lock_waits = {}  # {"thread"|"session"|"credentials": Histogram}
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.rate_mark = (time.monotonic(), 0, 0)
+
+    def record(self, command, seconds, error):
+        with self.lock:
+            entry = self.commands.get(command)
+            if entry is None:
+                entry = self.commands[command] = [0, Histogram()]
+            entry[0] += error
+            entry[1].add(seconds * 1000)
+
+    def lock_wait(self, kind, seconds):
+        with self.lock:
+            histogram = self.lock_waits.get(kind)
+            if histogram is None:
+                histogram = self.lock_waits[kind] = Histogram()
+            histogram.add(seconds * 1000)
+
+    def queued(self, change):
+        with self.lock:
+            self.queue_depth += change
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+
+    def transferred(self, received=0, sent=0):
+        with self.lock:
+            self.bytes_in += received
+            self.bytes_out += sent
+
+    def snapshot(self):
+        # Transfer rates are averaged since the previous snapshot
+        now = time.monotonic()
+        with self.lock:
+            mark_time, mark_in, mark_out = self.rate_mark
+            elapsed = max(now - mark_time, 1e-9)
+            self.rate_mark = (now, self.bytes_in, self.bytes_out)
+            return {
+                "uptime_sec": round(now - self.started, 1),
+                "commands": {name: dict(histogram.snapshot(), errors=errors)
+                             for name, (errors, histogram)
+                             in sorted(self.commands.items())},
+                "lock_wait": {kind: histogram.snapshot()
+                              for kind, histogram
+                              in sorted(self.lock_waits.items())},
+                "executor": {"queue_depth": self.queue_depth,
+                             "max_queue_depth": self.max_queue_depth},
+                "tcp": {"bytes_in": self.bytes_in,
+                        "bytes_out": self.bytes_out,
+                        "in_bytes_per_sec":
+                            round((self.bytes_in - mark_in) / elapsed),
+                        "out_bytes_per_sec":
+                            round((self.bytes_out - mark_out) / elapsed),
+                        "window_sec": round(elapsed, 1)}}
+
+
+@contextmanager
+def timed(lock, kind):
+    # Holds `lock`, recording how long it took to get under `kind`
+    start = time.perf_counter()
+    with lock:
+        metrics.lock_wait(kind, time.perf_counter() - start)
+        yield
+
+
+class ShardPeers:
+    """
+    Links between the worker processes of --workers mode, each one the
+    owner of the titles and usernames that hash to it (shard_of()).
+    Workers talk over UNIX sockets in a private directory: length-prefixed
+    pickled messages on a stream socket, plus a datagram socket that hands
+    over TCP connections with their file descriptor.
+      FWD: a client's datagram for the owner, which answers the client
+           itself; its UDP socket shares our port, so the reply comes
+           from the address the client sent to
+      CALL/RET: a command run on the owner for us (BATCH items), the
+           owner's part of the listing or of SRC results, or a session
+           change to copy
+      SEEN: users active here, so their owner does not expire them
+    """
+
+    def __init__(self, directory, index, count):
+        self.directory = directory
+        self.index = index
+        self.count = count
+        self.udp = None  # the worker's UDP socket, set by udp_server()
+        self.links = {}  # {worker index: (stream socket, send Lock)}
+        self.links_lock = Lock()
+        self.calls = {}  # {call id: [Event, ok, result]}
+        self.calls_lock = Lock()
+        self.next_call = 0
+        self.seen_mark = time.monotonic()
+        # Forwarded work never waits on another worker, so it cannot
+        # deadlock against a worker waiting on us
+        self.pool = ThreadPoolExecutor(max_workers=COMMAND_WORKERS)
+        self.listener = socket(AF_UNIX, SOCK_STREAM)
+        self.listener.bind(self.path("link", index))
+        self.listener.listen(count)
+        self.handoff = socket(AF_UNIX, SOCK_DGRAM)
+        self.handoff.bind(self.path("tcp", index))
+
+    def path(self, kind, index):
+        return os.path.join(self.directory, f"{kind}-{index}.sock")
+
+    def start(self):
+        Thread(target=self.accept_links, daemon=True).start()
+        Thread(target=self.accept_transfers, daemon=True).start()
+
+    def close(self):
+        self.listener.close()
+        self.handoff.close()
+
+    def send(self, index, message):
+        with self.links_lock:
+            link = self.links.get(index)
+            if link is None:
+                sock = socket(AF_UNIX, SOCK_STREAM)
+                sock.connect(self.path("link", index))
+                link = self.links[index] = (sock, Lock())
+        sock, lock = link
+        data = pickle.dumps(message)
+        with lock:
+            sock.sendall(SHARD_FRAME.pack(len(data)) + data)
+
+    def accept_links(self):
+        while True:
+            conn, _ = self.listener.accept()
+            Thread(target=self.read_link, args=(conn,), daemon=True).start()
+
+    def read_link(self, conn):
+        # Messages from one worker, in the order it sent them
+        stream = conn.makefile("rb")
+        try:
+            while True:
+                header = stream.read(SHARD_FRAME.size)
+                if len(header) < SHARD_FRAME.size:
+                    return
+                size, = SHARD_FRAME.unpack(header)
+                self.dispatch(pickle.loads(stream.read(size)))
+        except OSError:
+            pass
+        finally:
+            stream.close()
+            conn.close()
+
+    def forward(self, data, client_addr):
+        # Passes a client datagram on to the worker owning its command,
+        # which answers the client itself; False if it is ours
+        owner = datagram_shard(data, client_addr)
+        if owner is None:
+            return False
+        try:
+            self.send(owner, ("FWD", data, client_addr))
+        except OSError as e:
+            # Dropped, the client retransmits
+            log.error(f"*ERROR: Worker {owner} unreachable - {e}")
+        return True
+
+    def dispatch(self, message):
+        kind = message[0]
+        if kind == "FWD":
+            _, data, client_addr = message
+            enqueue(self.pool, process_udp_request_sync, self.udp, data,
+                    client_addr)
+        elif kind == "CALL":
+            _, caller, call_id, name, args = message
+            if name == "session":
+                # In line: copies must land in the order the owner made them
+                sessions.apply(*args)
+                self.send(caller, ("RET", call_id, True, None))
+            else:
+                self.pool.submit(self.answer, caller, call_id, name, args)
+        elif kind == "RET":
+            _, call_id, ok, result = message
+            with self.calls_lock:
+                waiter = self.calls.pop(call_id, None)
+            if waiter:
+                waiter[1:] = [ok, result]
+                waiter[0].set()
+        elif kind == "SEEN":
+            sessions.touch(message[1])
+
+    def answer(self, caller, call_id, name, args):
+        try:
+            if name == "listing":
+                result = local_listing()
+            elif name == "search":
+                result = local_search(*args)
+            else:
+                result = process_udp_request(*args)
+            ok = True
+        except Exception as e:
+            log.error(f"*ERROR: {name} call from worker {caller} - {e}")
+            ok, result = False, str(e)
+        self.send(caller, ("RET", call_id, ok, result))
+
+    def call_many(self, indexes, name, *args):
+        # Sends the call to every worker in `indexes`, then waits for all
+        waiters = []
+        for index in indexes:
+            waiter = [Event(), False, None]
+            with self.calls_lock:
+                self.next_call += 1
+                call_id = self.next_call
+                self.calls[call_id] = waiter
+            self.send(index, ("CALL", self.index, call_id, name, args))
+            waiters.append((index, call_id, waiter))
+        results = []
+        for index, call_id, waiter in waiters:
+            if not waiter[0].wait(SHARD_CALL_TIMEOUT):
+                with self.calls_lock:
+                    self.calls.pop(call_id, None)
+                raise RuntimeError(f"Worker {index} did not answer {name}")
+            if not waiter[1]:
+                raise RuntimeError(f"Worker {index}: {waiter[2]}")
+            results.append(waiter[2])
+        return results
+
+    def call(self, index, name, *args):
+        return self.call_many([index], name, *args)[0]
+
+    def others(self):
+        return [i for i in range(self.count) if i != self.index]
+
+    def replicate(self, op, username, client_addr):
+        self.call_many(self.others(), "session", op, username, client_addr)
+
+    def listing(self):
+        # Titles in worker order; the listing's version is the sum of the
+        # workers' listing versions, which grows with any CRT or RMV
+        parts = self.call_many(self.others(), "listing")
+        parts.insert(self.index, local_listing())
+        titles = [title for part_titles, _ in parts for title in part_titles]
+        return titles, sum(version for _, version in parts)
+
+    def search(self, tokens, limit):
+        # Every worker's best `limit` hits, merged; IDF is per worker
+        parts = self.call_many(self.others(), "search", tokens, limit)
+        parts.append(local_search(tokens, limit))
+        hits = sorted((hit for _, part_hits in parts for hit in part_hits),
+                      key=lambda hit: (-hit[0], hit[1], hit[2]))
+        return sum(total for total, _ in parts), hits[:limit]
+
+    def report_seen(self):
+        now = time.monotonic()
+        by_owner = {}
+        for user in sessions.seen_since(self.seen_mark):
+            owner = shard_of(user)
+            if owner != self.index:
+                by_owner.setdefault(owner, []).append(user)
+        self.seen_mark = now
+        for owner, users in by_owner.items():
+            self.send(owner, ("SEEN", users))
+
+    def hand_over(self, index, conn, request, addr):
+        # Passes a TCP connection, and the request already read off it, to
+        # the worker owning the request's thread
+        # socket.send_fds() would drop the address of an unconnected socket
+        self.handoff.sendmsg(
+            [pickle.dumps((request, addr))],
+            [(SOL_SOCKET, SCM_RIGHTS, array.array("i", [conn.fileno()]))],
+            0, self.path("tcp", index))
+        return True
+
+    def accept_transfers(self):
+        while True:
+            data, fds, _, _ = recv_fds(self.handoff, 65536, 1)
+            if not fds:
+                continue
+            request, addr = pickle.loads(data)
+            conn = socket(fileno=fds[0])
+            Thread(target=file_transfer, args=(conn, addr, request),
+                   daemon=True).start()
+
+
+wal = WriteAheadLog(WAL_PREFIX)
+thread_locks = LockManager()
+sessions = SessionTable(SESSION_IDLE_TIMEOUT)
+active_users = sessions.by_user  # {username: client_address}
+dirty_threads = set()  # titles changed since their last snapshot
+reply_cache = ReplyCache(REPLY_CACHE_SIZE, REPLY_CACHE_BYTES)
+response_cache = ResponseCache(RESPONSE_CACHE_BYTES)
+search_index = SearchIndex()
+pushes = PushNotifier()
+admission = AdmissionControl(RATE_LIMIT, RATE_BURST, MAX_QUEUED_DATAGRAMS)
+bandwidth = BandwidthScheduler(BANDWIDTH_LIMIT, USER_BANDWIDTH, MAX_TRANSFERS)
+listing_version = 0  # LSN of the last CRT or RMV, the version of LST
+metrics = Metrics()
+mux_sessions = set()  # open transfer sessions, for STATS
+session_slots = BoundedSemaphore(MAX_SESSIONS)
+stream_slots = BoundedSemaphore(STREAM_WORKERS)
+# Session streams run here, never queued: a stream only gets in with one
+# of the stream_slots
+stream_pool = ThreadPoolExecutor(max_workers=STREAM_WORKERS)
+
+
+def new_thread(owner, lsn=0):
+    # "lines" keeps every entry in file order (messages and upload notices),
+    # "messages" holds the same message dicts so message N is messages[N - 1]
+    # and "files" maps each attachment name to its blob (None until hashed).
+    # Each message gets an "id" that, unlike its number, DLT leaves alone.
+    return {"owner": owner, "messages": [], "files": {}, "lines": [],
+            "lsn": lsn, "next_id": 1}
+
+
+def parse_thread(fname):
+    with open(fname, "r") as f:
+        # Snapshot header is "owner lsn"; legacy thread files only have owner
+        owner, _, lsn = f.readline().strip().partition(" ")
+        meta = new_thread(owner, int(lsn) if lsn.isdigit() else 0)
         for line in f:
-            line = line.strip()
-            if line:
-                name, pwd = line.split(" ", 1)
-                user_credentials[name] = pwd
-    print(f"*Loaded {len(user_credentials)} user credentials")
+            line = line.rstrip("\n")
+            msg_match = MSG_LINE.match(line)
+            if msg_match:
+                entry = {"user": msg_match.group(1),
+                         "content": msg_match.group(2),
+                         "id": meta["next_id"]}
+                meta["next_id"] += 1
+                meta["messages"].append(entry)
+            else:
+                upd_match = UPLOAD_LINE.match(line)
+                if upd_match:
+                    entry = {"user": upd_match.group(1),
+                             "file": upd_match.group(2)}
+                    meta["files"][entry["file"]] = upd_match.group(3)
+                else:
+                    entry = {"raw": line}
+            meta["lines"].append(entry)
+    return meta
+
+
+def render_messages(meta, first=1, last=None, blobs=False):
+    # Messages first..last; other lines go with the message they follow,
+    # and trailing ones with the page that reaches the end of the thread.
+    # Snapshots (blobs=True) also record which blob each upload refers to
+    total = len(meta["messages"])
+    last = total if last is None else min(last, total)
+    tail = last == total and (first <= last or first == 1)
+    out = []
+    msg_num = 0
+    for entry in meta["lines"]:
+        if "content" in entry:
+            msg_num += 1
+            if first <= msg_num <= last:
+                out.append(f"{msg_num} {entry['user']}: {entry['content']}\n")
+        elif msg_num < first - 1 or (msg_num >= last and not tail):
+            continue
+        elif "file" in entry:
+            blob = blobs and meta["files"].get(entry["file"])
+            out.append(f"{entry['user']} uploaded {entry['file']}"
+                       f"{' ' + blob if blob else ''}\n")
+        else:
+            out.append(f"{entry['raw']}\n")
+    return "".join(out)
+
+
+def thread_path(title, *names):
+    # threads/<title>/ holds the snapshot ("thread"), the attachments
+    # ("files/", links into the blob store) and the .part and .manifest
+    # files of uploads in progress ("uploads/")
+    return os.path.join(THREAD_DIR, title, *names)
+
+
+def attachment_path(title, fname):
+    return thread_path(title, "files", fname)
 
 
-def save_credentials():
-    global user_credentials
-    with open(CREDENTIALS_FILE, "w") as f:
-        for user, pwd in user_credentials.items():
-            f.write(f"{user} {pwd}\n")
-    print(f"*Credentials saved to '{CREDENTIALS_FILE}'...")
+def partial_path(title, fname):
+    return thread_path(title, "uploads", fname)
+
+
+def make_thread_dirs(title):
+    os.makedirs(thread_path(title, "files"), exist_ok=True)
+    os.makedirs(thread_path(title, "uploads"), exist_ok=True)
+
+
+def has_control(text):
+    # Snapshots keep one message or upload per line, so a line break (or
+    # any other control character) in stored text would split it on reload
+    return any(c < " " or c == "\x7f" for c in text)
+
+
+def valid_name(name):
+    # Titles and file names become path components under THREAD_DIR
+    return bool(name) and name not in (".", "..") and \
+        not any(c in name for c in "/\\") and not has_control(name)
+
+
+def write_snapshot(title, meta):
+    os.makedirs(thread_path(title), exist_ok=True)
+    if search_cache:
+        # Written first: an index newer than its snapshot is not trusted
+        index_name = thread_path(title, "index")
+        with open(f"{index_name}.tmp", "w") as f:
+            json.dump({"lsn": meta["lsn"],
+                       "postings": search_index.export(title, meta)}, f)
+        os.replace(f"{index_name}.tmp", index_name)
+    path = thread_path(title, "thread")
+    tmp_name = f"{path}.tmp"
+    with open(tmp_name, "w") as f:
+        f.write(f"{meta['owner']} {meta['lsn']}\n")
+        f.write(render_messages(meta, blobs=True))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_name, path)
+
+
+def apply_record(record):
+    # Shared by live mutations and log replay. Caller holds the title's
+    # write lock, plus the registry lock for CRT/RMV
+    global listing_version
+    op, title = record["op"], record["t"]
+    with dirty_lock:
+        dirty_threads.add(title)
+    response_cache.invalidate(title)
+    if op in ("CRT", "RMV"):
+        listing_version = record["lsn"]
+        response_cache.invalidate(None)
+    if op == "RMV":
+        thread_metadata.pop(title, None)
+        search_index.drop(title)
+        return
+    if op == "CRT":
+        thread_metadata[title] = new_thread(record["u"])
+        search_index.drop(title)
+    meta = thread_metadata[title]
+    if op == "MSG":
+        entry = {"user": record["u"], "content": record["c"],
+                 "id": meta["next_id"]}
+        meta["next_id"] += 1
+        meta["messages"].append(entry)
+        meta["lines"].append(entry)
+        search_index.add(title, entry["id"], entry["content"])
+    elif op == "EDT":
+        entry = meta["messages"][record["n"] - 1]
+        search_index.remove(title, entry["id"], entry["content"])
+        entry["content"] = record["c"]
+        search_index.add(title, entry["id"], entry["content"])
+    elif op == "DLT":
+        entry = meta["messages"].pop(record["n"] - 1)
+        search_index.remove(title, entry["id"], entry["content"])
+        lines = meta["lines"]
+        for index in range(len(lines) - 1, -1, -1):
+            if lines[index] is entry:
+                del lines[index]
+                break
+    elif op == "UPD":
+        meta["files"][record["f"]] = record.get("b")
+        meta["lines"].append({"user": record["u"], "file": record["f"]})
+    meta["lsn"] = record["lsn"]
+
+
+def log_mutation(record):
+    # Caller holds the locks apply_record() needs and must wal.sync() the
+    # LSN after releasing them, before replying. The title is marked dirty
+    # before the record can land in a segment, so the compaction that
+    # seals and drops that segment also snapshots the thread
+    with dirty_lock:
+        dirty_threads.add(record["t"])
+    lsn = wal.append(record)
+    apply_record(record)
+    pushes.publish(record)
+    if wal.size > COMPACT_BYTES:
+        compact_requested.set()
+    return lsn
+
+
+def compact_threads():
+    with compact_lock:
+        with dirty_lock:
+            if not dirty_threads and wal.size == 0 and not wal.sealed:
+                return
+        sealed = wal.rotate()
+        with dirty_lock:
+            titles = list(dirty_threads)
+            dirty_threads.clear()
+        try:
+            for title in titles:
+                with thread_locks.reading(title) as meta:
+                    if meta is not None:
+                        write_snapshot(title, meta)
+                        continue
+                with thread_locks.registry:
+                    if title not in thread_metadata and \
+                            os.path.isdir(thread_path(title)):
+                        shutil.rmtree(thread_path(title))
+        except OSError:
+            with dirty_lock:
+                dirty_threads.update(titles)
+            raise
+        wal.drop(sealed)
+    log.info(f"*Compacted {len(titles)} thread(s) into snapshots")
+
+
+def compactor():
+    while True:
+        compact_requested.wait(COMPACT_INTERVAL)
+        compact_requested.clear()
+        try:
+            compact_threads()
+        except OSError as e:
+            log.error(f"*ERROR: Compaction failed - {e}")
+
+
+def log_segments(fnames):
+    # {prefix: segment file names} for forum.wal and every forum.wal-<worker>
+    pattern = re.compile(re.escape(WAL_PREFIX) + r"(-\d+)?\.\d+")
+    logs = {}
+    for fname in fnames:
+        if pattern.fullmatch(fname):
+            logs.setdefault(fname.rsplit(".", 1)[0], []).append(fname)
+    return logs
+
+
+def fold_logs(fnames, keep=None):
+    # Replays every log but `keep` (forum.wal, and forum.wal-<worker> left
+    # by a --workers run) into the thread snapshots and deletes it, so each
+    # title can be loaded from its snapshot by whichever process owns it
+    global wal, thread_metadata
+    logs = log_segments(fnames)
+    logs.pop(keep, None)
+    current = wal
+    for prefix, segments in sorted(logs.items()):
+        if not any(os.path.getsize(fname) for fname in segments):
+            for fname in segments:
+                os.remove(fname)
+            continue
+        wal = WriteAheadLog(prefix)
+        thread_metadata = {}
+        load_threads()
+        compact_threads()
+        wal.close()
+        os.remove(wal.segment_name(wal.segment))
+    wal = current
+    thread_metadata = {}
+    search_index.clear()
+
+
+def thread_titles():
+    os.makedirs(THREAD_DIR, exist_ok=True)
+    return [entry.name for entry in os.scandir(THREAD_DIR) if entry.is_dir()]
+
+
+def sweep_partial_uploads(titles):
+    # Drop .part files of uploads nobody came back to resume
+    now = time.time()
+    for title in titles:
+        try:
+            entries = list(os.scandir(partial_path(title, "")))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            if now - entry.stat().st_mtime > PARTIAL_UPLOAD_TTL:
+                os.remove(entry.path)
+                log.info(f"*Removed abandoned upload {entry.path}")
+
+
+def old_snapshot(fname):
+    # The thread of an old flat-layout snapshot, or None if `fname` is not
+    # one: an "owner [lsn]" header, then only message and upload lines
+    try:
+        with open(fname, "r", encoding="utf-8") as f:
+            header = f.readline().rstrip("\n")
+            body = [line.rstrip("\n") for line in f]
+    except (OSError, UnicodeDecodeError):
+        return None
+    owner, _, lsn = header.partition(" ")
+    if not owner or owner != owner.strip() or \
+            (lsn and not (lsn.isascii() and lsn.isdigit())):
+        return None
+    if not all(MSG_LINE.match(line) or UPLOAD_LINE.match(line)
+               for line in body):
+        return None
+    return parse_thread(fname)
+
+
+def migrate_layout():
+    # Moves a store from the old flat layout (snapshot "<title>" and
+    # attachments "<title>-<file>" in the working directory) under
+    # THREAD_DIR. Everything is hard-linked into a staging directory that
+    # is renamed into place, so an interrupted migration simply reruns.
+    # Needs the credentials loaded: other files in the directory are only
+    # taken for snapshots when a known user or the old log vouches for them
+    if os.path.isdir(THREAD_DIR):
+        return
+    fnames = os.listdir()
+    attachments = set()
+    logged = set()  # titles the old write-ahead log mentions
+    for prefix in log_segments(fnames):
+        for record in WriteAheadLog(prefix).replay(fnames):
+            logged.add(record["t"])
+            if record["op"] == "UPD":
+                attachments.add((record["t"], record["f"]))
+    # Old thread files were told apart by having no "." or "_" in the name
+    titles = []
+    for title in fnames:
+        if "." in title or "_" in title or not valid_name(title) or \
+                not os.path.isfile(title):
+            continue
+        meta = old_snapshot(title)
+        if meta is None or \
+                (meta["owner"] not in credentials and title not in logged):
+            continue
+        titles.append(title)
+        attachments.update((title, fname) for fname in meta["files"])
+    if not titles:
+        return
+    staging = f"{THREAD_DIR}.new"
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    moved = []
+    for title in titles:
+        os.makedirs(os.path.join(staging, title))
+        os.link(title, os.path.join(staging, title, "thread"))
+        moved.append(title)
+    for title, fname in attachments:
+        old_name = f"{title}-{fname}"
+        if title in titles and valid_name(fname) and \
+                os.path.isfile(old_name):
+            os.makedirs(os.path.join(staging, title, "files"), exist_ok=True)
+            os.link(old_name, os.path.join(staging, title, "files", fname))
+            moved.append(old_name)
+    os.rename(staging, THREAD_DIR)
+    # Uploads in progress to the moved threads cannot resume across the move
+    moved += [fname for fname in fnames
+              if fname.endswith((".part", ".manifest")) and
+              any(fname.startswith(f"{title}-") for title in titles)]
+    for fname in moved:
+        os.remove(fname)
+    log.info(f"*Moved {len(titles)} thread(s) and their attachments "
+                 f"into {THREAD_DIR}/")
+
+
+def blob_path(blob):
+    return os.path.join(BLOB_DIR, blob)
+
+
+def file_blob(fname):
+    hasher = hashlib.sha256()
+    with open(fname, "rb") as f:
+        for block in iter(lambda: f.read(TRANSFER_CHUNK), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def share_blob(ref_name, blob):
+    # Makes the attachment file ref_name a hard link of its blob, storing
+    # it as the blob if the content is new. A blob's link count is its
+    # reference count: one for the store, one per attachment using it,
+    # shared by every worker process.
+    path = blob_path(blob)
+    tmp_name = f"{path}.{os.getpid()}-{get_ident()}"
+    while True:
+        try:
+            os.link(ref_name, path)
+            return
+        except FileExistsError:
+            pass
+        try:
+            if os.path.samefile(ref_name, path):
+                return
+            os.link(path, tmp_name)
+        except FileNotFoundError:
+            continue  # released meanwhile, store this copy instead
+        os.replace(tmp_name, ref_name)
+        return
+
+
+def link_blob(blob, ref_name, size):
+    # Attaches an already stored blob without its bytes being sent again;
+    # False if there is no such blob
+    try:
+        if os.path.getsize(blob_path(blob)) != size:
+            return False
+        os.link(blob_path(blob), ref_name)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def release_blob(ref_name, blob):
+    # Drops one reference; the blob goes with the last attachment using it
+    if os.path.exists(ref_name):
+        os.remove(ref_name)
+    if blob is None:
+        return
+    try:
+        if os.stat(blob_path(blob)).st_nlink == 1:
+            os.remove(blob_path(blob))
+    except FileNotFoundError:
+        pass
+
+
+def adopt_attachments():
+    # Attachments stored before the blob store (or whose snapshot predates
+    # it) are hashed once and moved into it
+    adopted = 0
+    for title, meta in thread_metadata.items():
+        for fname, blob in meta["files"].items():
+            ref_name = attachment_path(title, fname)
+            if blob is None and os.path.isfile(ref_name):
+                blob = file_blob(ref_name)
+                share_blob(ref_name, blob)
+                meta["files"][fname] = blob
+                with dirty_lock:
+                    dirty_threads.add(title)
+                adopted += 1
+    if adopted:
+        log.info(f"*Moved {adopted} attachment(s) into the blob store")
+
+
+def index_thread(title, meta):
+    # Search postings of a loaded snapshot: the saved ones when they are
+    # from the same LSN, otherwise built again; 1 if it had to be rebuilt
+    if search_cache:
+        try:
+            with open(thread_path(title, "index")) as f:
+                saved = json.load(f)
+            if saved["lsn"] == meta["lsn"]:
+                search_index.load(title, saved["postings"])
+                return 0
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+    for entry in meta["messages"]:
+        search_index.add(title, entry["id"], entry["content"])
+    return 1
 
 
 def load_threads():
-    global thread_metadata
-    print("Loading existing threads...")
-    for fname in os.listdir():
-        if ("." in fname or "_" in fname):
+    global thread_metadata, listing_version
+    log.info("Loading existing threads...")
+    # One directory per thread; attachments come from the snapshot, so no
+    # thread's files are listed
+    titles = thread_titles()
+    if peers is None:
+        sweep_partial_uploads(titles)
+    search_index.clear()
+    indexed = 0
+    for title in titles:
+        path = thread_path(title, "thread")
+        if owns(title) and os.path.isfile(path):
+            meta = thread_metadata[title] = parse_thread(path)
+            indexed += index_thread(title, meta)
+    if indexed:
+        log.info(f"*Indexed {indexed} thread(s) for search")
+    fnames = os.listdir()
+    # Replay the log tail on top of the snapshots, skipping records a
+    # snapshot already contains
+    replayed = 0
+    for record in wal.replay(fnames):
+        if not owns(record["t"]):
+            continue
+        meta = thread_metadata.get(record["t"])
+        if meta is None and record["op"] != "CRT":
+            continue
+        if meta is not None and record["lsn"] <= meta["lsn"]:
             continue
-        if os.path.isfile(fname):
-            with open(fname, "r") as f:
-                owner = f.readline().strip()
-            thread_metadata[fname] = {
-                "owner": owner, "messages": [], "files": []}
-    print(f"*Loaded {len(thread_metadata)} threads")
+        apply_record(record)
+        replayed += 1
+    os.makedirs(BLOB_DIR, exist_ok=True)
+    adopt_attachments()
+    max_lsn = max((meta["lsn"] for meta in thread_metadata.values()),
+                  default=0)
+    wal.open(max_lsn)
+    listing_version = wal.lsn
+    thread_locks.reset(thread_metadata)
+    log.info(f"*Loaded {len(thread_metadata)} threads, "
+             f"replayed {replayed} log record(s)")
+
+
+def shard_of(key):
+    # Stable across processes, unlike hash()
+    return zlib.crc32(key.encode()) % shard_count
+
+
+def owns(key):
+    return shard_count == 1 or shard_of(key) == shard
+
+
+def command_shard(command, fields, req_user):
+    # The other worker owning the user or thread a command is about, or
+    # None when this one can answer it
+    if peers is None:
+        return None
+    if command == "XIT":
+        key = req_user
+    elif command in ("LOGIN", "AUTH", "REGISTER", "RDT", "CRT", "MSG", "EDT",
+                     "DLT", "RMV", "UPD", "SUB", "UNSUB") and fields:
+        # The username or thread title
+        key = fields[0]
+    else:
+        return None
+    if not key or owns(key):
+        return None
+    return shard_of(key)
 
 
 def get_username(client_address):
-    with user_lock:
-        for user, addr in active_users.items():
-            if addr == client_address:
-                return user
-    return None
+    return sessions.lookup(client_address)
 
 
-def login_user(args, client_addr):
-    username = args
+def session_reaper():
+    while True:
+        time.sleep(SESSION_SWEEP_INTERVAL)
+        if peers is not None:
+            peers.report_seen()
+        for user in sessions.expire_idle(owns):
+            log.info(f"*Session of {user} expired after idling")
+        admission.sweep()
+        stats = sessions.stats()
+        if stats["lookups_per_sec"]:
+            log.info(f"*Sessions: {stats['active_sessions']} active, "
+                     f"{stats['lookups_per_sec']} lookups/s")
+
+
+def login_user(req_user, client_addr, username, binary=""):
     if not username:
-        print("*ERROR: Username empty")
+        log.info("*ERROR: Username empty")
         return "ERROR: Username empty"
-    with user_lock:
-        if username in active_users and active_users[username] != client_addr:
-            addr = active_users[username]
-            print(f"*ERROR: User {username} already active at {addr}")
-            return f"ERROR: User {username} already active at {addr}"
-    if username in user_credentials:
-        return "PASSWORD_REQUIRED"
-    return "NEW_USER"
-
-
-def auth_user(args, client_addr):
-    username, password = args.split(" ", 1)
-    if user_credentials.get(username) != password:
-        print("*ERROR: Invalid password")
+    addr = sessions.active_elsewhere(username, client_addr)
+    if addr is not None:
+        log.info(f"*ERROR: User {username} already active at {addr}")
+        return f"ERROR: User {username} already active at {addr}"
+    reply = "PASSWORD_REQUIRED" if username in credentials else "NEW_USER"
+    if binary:
+        # The binary version both sides speak, the client switches to it
+        # once logged in
+        reply += f" binary {min(int(binary), BINARY_VERSION)}"
+    return reply
+
+
+def auth_user(req_user, client_addr, username, password):
+    if not credentials.verify(username, password):
+        log.info("*ERROR: Invalid password")
         return "ERROR: Invalid password"
-    with user_lock:
-        if username in active_users and active_users[username] != client_addr:
-            print(f"*ERROR: User {username} already active")
-            return f"ERROR: User {username} already active"
-        active_users[username] = client_addr
+    if sessions.login(username, client_addr) is not None:
+        log.info(f"*ERROR: User {username} already active")
+        return f"ERROR: User {username} already active"
     return "Login successful"
 
 
-def reg_user(args, client_addr):
-    username, password = args.split(" ", 1)
+def reg_user(req_user, client_addr, username, password):
     if " " in username:
-        print("*ERROR: Username can not have spaces")
+        log.info("*ERROR: Username can not have spaces")
         return "ERROR: Username can not have spaces"
-    if username in user_credentials:
-        print("*ERROR: Username already exists")
+    if has_control(username):
+        log.info("*ERROR: Invalid username")
+        return "ERROR: Invalid username"
+    if username in credentials or \
+            not credentials.register(username, password):
+        log.info("*ERROR: Username already exists")
         return "ERROR: Username already exists"
-    user_credentials[username] = password
-    save_credentials()
-    with user_lock:
-        active_users[username] = client_addr
+    log.info(f"*Registered {username}")
+    sessions.login(username, client_addr)
     return "Registration successful"
 
 
-def exit_forum(req_user):
-    with user_lock:
-        if req_user not in active_users:
-            print(f"*ERROR: Logout failed for {req_user}")
-            return "ERROR: Logout failed"
-        del active_users[req_user]
-    print(f"*Goodbye {req_user}!")
+def exit_forum(req_user, client_addr):
+    if not sessions.logout(req_user):
+        log.info(f"*ERROR: Logout failed for {req_user}")
+        return "ERROR: Logout failed"
+    log.info(f"*Goodbye {req_user}!")
     return f"Goodbye {req_user}!"
 
 
-def create_thread(args, req_user):
-    _, threadtitle = args.split(" ", 1)
+def create_thread(req_user, client_addr, threadtitle):
     threadtitle = threadtitle.strip()
     if not threadtitle:
-        print("*ERROR: Empty title")
+        log.info("*ERROR: Empty title")
         return "ERROR: Empty title"
     if " " in threadtitle:
-        print("*ERROR: Title have to be single word")
+        log.info("*ERROR: Title have to be single word")
         return "ERROR: Title have to be single word"
-    with thread_lock:
+    if not valid_name(threadtitle):
+        log.info("*ERROR: Invalid title")
+        return "ERROR: Invalid title"
+    with thread_locks.registry:
         if threadtitle in thread_metadata:
-            print(f"*ERROR: Thread {threadtitle} already created")
+            log.info(f"*ERROR: Thread {threadtitle} already created")
             return f"ERROR: Thread {threadtitle} already created"
-        with open(threadtitle, "w") as f:
-            f.write(f"{req_user}\n")
-        thread_metadata[threadtitle] = {
-            "owner": req_user, "messages": [], "files": []}
-    print(f"*Thread '{threadtitle}' created by '{req_user}'")
+        lsn = log_mutation({"op": "CRT", "t": threadtitle, "u": req_user})
+        thread_locks.add(threadtitle)
+    wal.sync(lsn)
+    log.info(f"*Thread '{threadtitle}' created by '{req_user}'")
     return f"Thread {threadtitle} created"
 
 
-def list_threads():
-    with thread_lock:
-        if not thread_metadata:
-            print("*ERROR: No threads")
-            return "ERROR: No threads"
-        return "All threads showed below:\n" + "\n".join(thread_metadata.keys())
+def local_listing():
+    with thread_locks.registry:
+        return list(thread_metadata), listing_version
+
+
+def list_threads(req_user=None, client_addr=None, known=""):
+    # LST [if-version V]: NOT_MODIFIED, or "VERSION <v>" and the listing.
+    # V is the version the client already has, 0 when it has none.
+    known = int(known) if known else None
+    if peers is not None:
+        titles, version = peers.listing()
+        response = response_cache.get("LST", version)
+    else:
+        with thread_locks.registry:
+            version = listing_version
+            response = response_cache.get("LST", version)
+            if response is None:
+                titles = list(thread_metadata)
+    if known and known == version:
+        return "NOT_MODIFIED"
+    if response is None:
+        if titles:
+            response = "All threads showed below:\n" + "\n".join(titles)
+        else:
+            response = "ERROR: No threads"
+        response_cache.put("LST", None, version, response)
+    if response.startswith("ERROR"):
+        log.info("*ERROR: No threads")
+    return response if known is None else f"VERSION {version}\n{response}"
 
 
-def post_message(args, req_user):
-    msg_parts = args.split(" ", 2)
-    if len(msg_parts) != 3:
-        print("*ERROR: Invalid MSG input")
-        return "*ERROR: Invalid MSG input"
-    _, threadtitle, message = msg_parts
+def post_message(req_user, client_addr, threadtitle, message):
     if not threadtitle or " " in threadtitle:
-        print("*ERROR: Invalid title")
+        log.info("*ERROR: Invalid title")
         return "ERROR: Invalid title"
     if not message:
-        print("*ERROR: Empty message")
+        log.info("*ERROR: Empty message")
         return "ERROR: Empty message"
-    with thread_lock:
-        if threadtitle not in thread_metadata:
-            print(f"*ERROR: Thread {threadtitle} not found")
+    if has_control(message):
+        log.info("*ERROR: Message has control characters")
+        return "ERROR: Message can not contain control characters"
+    with thread_locks.writing(threadtitle) as meta:
+        if meta is None:
+            log.info(f"*ERROR: Thread {threadtitle} not found")
             return f"ERROR: Thread {threadtitle} not found"
-        msg_count = 0
-        with open(threadtitle, "r") as f:
-            lines = f.readlines()
-        for line in lines[1:]:
-            msg_line = line.strip()
-            if re.match(r"^\d+ .+?: ", msg_line):
-                msg_count += 1
-        next_msg_num = msg_count + 1
-        with open(threadtitle, "a") as f:
-            f.write(f"{next_msg_num} {req_user}: {message}\n")
-    print(f"*{message} posted by {req_user}")
+        lsn = log_mutation({"op": "MSG", "t": threadtitle,
+                            "u": req_user, "c": message})
+    wal.sync(lsn)
+    log.info(f"*{message} posted by {req_user}")
     return "Message posted"
 
 
-def read_thread(args):
-    threadtitle = args.strip()
+def read_thread(req_user, client_addr, threadtitle, first="", count="",
+                known=""):
+    # RDT <title> [from N] [count K] [if-version V]; a paged read starts
+    # with "PAGE <first> <last> <total>" so the client knows where to
+    # continue. With if-version the reply is NOT_MODIFIED when the thread
+    # is still at version V, otherwise "VERSION <v>" and the content.
+    known = int(known) if known else None
     if not threadtitle:
-        print("*ERROR: Title required")
+        log.info("*ERROR: Title required")
         return "ERROR: Title required"
     if " " in threadtitle:
-        print("*ERROR: Title must be single word")
+        log.info("*ERROR: Title must be single word")
         return "ERROR: Title must be single word"
-    with thread_lock:
-        if threadtitle not in thread_metadata:
-            print(f"*ERROR: Thread {threadtitle} not found")
+    paging = {}
+    for name, value in (("from", first), ("count", count)):
+        if value:
+            if int(value) < 1:
+                return "ERROR: Usage RDT <title> [from N] [count K]"
+            paging[name] = int(value)
+    with thread_locks.reading(threadtitle) as meta:
+        if meta is None:
+            log.info(f"*ERROR: Thread {threadtitle} not found")
             return f"ERROR: Thread {threadtitle} not found"
-        with open(threadtitle, "r") as f:
-            lines = f.readlines()
-    if len(lines) <= 1:
-        print("*Thread is empty")
-        return "Thread is empty"
-    content = "".join(lines[1:])
-    print(f"*Sending contents of '{threadtitle}'")
-    return content
-
-
-def edit_message(args, req_user):
-    edt_parts = args.split(" ", 3)
-    if len(edt_parts) != 4:
-        print("*ERROR: Invalid EDT input")
-        return "ERROR: Invalid EDT input"
-    _, threadtitle, msg_num_str, new_msg = edt_parts
+        version = meta["lsn"]
+        if known and known == version:
+            log.debug("*'%s' not modified since version %s", threadtitle, version)
+            return "NOT_MODIFIED"
+        key = ("RDT", threadtitle, paging.get("from"), paging.get("count"))
+        response = response_cache.get(key, version)
+        if response is None:
+            response = render_read(meta, paging)
+            response_cache.put(key, threadtitle, version, response)
+    log.debug("*Sending contents of '%s'", threadtitle)
+    return response if known is None else f"VERSION {version}\n{response}"
+
+
+def render_read(meta, paging):
+    if paging:
+        first = paging.get("from", 1)
+        total = len(meta["messages"])
+        last = total
+        if "count" in paging:
+            last = min(total, first + paging["count"] - 1)
+        content = render_messages(meta, first, last)
+        return f"PAGE {first} {max(last, first - 1)} {total}\n{content}"
+    return render_messages(meta) or "Thread is empty"
+
+
+def search_threads(req_user, client_addr, terms, first="", count=""):
+    # SRC <terms> [from N] [count K]: "RESULTS <first> <last> <total>" and
+    # one "<title> <number> <user>: <message>" line per hit, best first
+    tokens = tokenize(terms)
+    try:
+        first = int(first or 1)
+        count = int(count or SEARCH_PAGE_SIZE)
+    except ValueError:
+        first = count = 0
+    if not tokens or first < 1 or count < 1:
+        return "ERROR: Usage SRC <terms> [from N] [count K]"
+    if len(set(tokens)) > SEARCH_MAX_TERMS:
+        return f"ERROR: At most {SEARCH_MAX_TERMS} search terms"
+    last = first + count - 1
+    if peers is not None:
+        total, hits = peers.search(tokens, last)
+    else:
+        total, hits = local_search(tokens, last)
+    hits = hits[first - 1:]
+    lines = [f"RESULTS {first} {first + len(hits) - 1} {total}"]
+    lines += [f"{title} {number} {user}: {content}"
+              for _, title, number, user, content in hits]
+    log.debug("*SRC %s: %d hit(s)", tokens, total)
+    return "\n".join(lines)
+
+
+def local_search(tokens, limit):
+    # This process's best `limit` hits as (score, title, message number,
+    # user, content), numbered as the thread stands now
+    total, hits = search_index.search(tokens, limit)
+    found = []
+    for score, title, msg_id in hits:
+        with thread_locks.reading(title) as meta:
+            if meta is None:
+                continue
+            messages = meta["messages"]
+            index = bisect_left(messages, msg_id, key=lambda e: e["id"])
+            if index < len(messages) and messages[index]["id"] == msg_id:
+                entry = messages[index]
+                found.append((score, title, index + 1, entry["user"],
+                              entry["content"]))
+    return total, found
+
+
+def edit_message(req_user, client_addr, threadtitle, msg_num_str, new_msg):
     if not threadtitle or " " in threadtitle:
-        print("*ERROR: Invalid threadtitle")
+        log.info("*ERROR: Invalid threadtitle")
         return "ERROR: Invalid threadtitle"
     try:
         msg_num = int(msg_num_str)
         if msg_num < 1:
             raise ValueError
     except ValueError:
-        print("*ERROR: No message number")
+        log.info("*ERROR: No message number")
         return "ERROR: No message number"
-    with thread_lock:
-        if threadtitle not in thread_metadata:
-            print(f"*ERROR: Thread {threadtitle} can not be found")
+    if has_control(new_msg):
+        log.info("*ERROR: Message has control characters")
+        return "ERROR: Message can not contain control characters"
+    with thread_locks.writing(threadtitle) as meta:
+        if meta is None:
+            log.info(f"*ERROR: Thread {threadtitle} can not be found")
             return f"ERROR: Thread {threadtitle} can not be found"
-        lines = []
-        with open(threadtitle, "r") as f:
-            lines = f.readlines()
-        msg_count = 0
-        line_index = -1
-        for index, line in enumerate(lines[1:]):
-            msg_index = index + 1
-            msg_line = line.strip()
-            if re.match(r"^\d+ .+?: ", msg_line):
-                msg_count += 1
-                if msg_count == msg_num:
-                    line_index = msg_index
-                    break
-        if line_index == -1:
-            print("*ERROR: No message number")
+        messages = meta["messages"]
+        if msg_num > len(messages):
+            log.info("*ERROR: No message number")
             return "ERROR: No message number"
-        line_content = lines[line_index].strip()
-        if f"{msg_num} {req_user}:" not in line_content:
-            print("*ERROR: You can only edit your own message")
+        entry = messages[msg_num - 1]
+        if entry["user"] != req_user:
+            log.info("*ERROR: You can only edit your own message")
             return "ERROR: You can only edit your own message"
-        lines[line_index] = f"{msg_num} {req_user}: {new_msg}\n"
-        with open(threadtitle, "w") as f:
-            f.writelines(lines)
-        print(f"*Message updated {msg_num} to {threadtitle}")
-        return "Message updated"
-
-
-def delete_message(args, req_user):
-    parts = args.split(" ", 2)
-    if len(parts) != 3:
-        print("*ERROR: Invalid DLT input")
-        return "ERROR: Invalid DLT input"
-    _, threadtitle, msg_num_str = parts
+        lsn = log_mutation({"op": "EDT", "t": threadtitle, "u": req_user,
+                            "n": msg_num, "c": new_msg})
+    wal.sync(lsn)
+    log.info(f"*Message updated {msg_num} to {threadtitle}")
+    return "Message updated"
+
+
+def delete_message(req_user, client_addr, threadtitle, msg_num_str):
     if not threadtitle or " " in threadtitle:
-        print("*ERROR: Invalid thread title")
+        log.info("*ERROR: Invalid thread title")
         return "ERROR: Invalid thread title"
     try:
         msg_num = int(msg_num_str)
         if msg_num < 1:
             raise ValueError
     except ValueError:
-        print("*ERROR: No message number")
+        log.info("*ERROR: No message number")
         return "ERROR: No message number"
-    with thread_lock:
-        if threadtitle not in thread_metadata:
-            print(f"*ERROR: Thread {threadtitle} not exist")
+    with thread_locks.writing(threadtitle) as meta:
+        if meta is None:
+            log.info(f"*ERROR: Thread {threadtitle} not exist")
             return f"ERROR: Thread {threadtitle} not exist"
-        lines = []
-        with open(threadtitle, "r") as f:
-            lines = f.readlines()
-        msg_count = 0
-        line_index = -1
-        for index, line in enumerate(lines[1:]):
-            msg_index = index + 1
-            msg_line = line.strip()
-            if re.match(r"^\d+ .+?: ", msg_line):
-                msg_count += 1
-                if msg_count == msg_num:
-                    line_index = msg_index
-                    break
-        if line_index == -1:
-            print("*ERROR: No message number")
+        messages = meta["messages"]
+        if msg_num > len(messages):
+            log.info("*ERROR: No message number")
             return "ERROR: No message number"
-        line_content = lines[line_index].strip()
-        if f"{msg_num} {req_user}:" not in line_content:
-            print("*ERROR: You can only delete your own message")
+        entry = messages[msg_num - 1]
+        if entry["user"] != req_user:
+            log.info("*ERROR: You can only delete your own message")
             return "ERROR: You can only delete your own message"
-        del lines[line_index]
-        for i in range(line_index, len(lines)):
-            parts = lines[i].split(": ", 1)
-            if len(parts) == 2:
-                user_part = parts[0].split(" ", 1)[-1]
-                lines[i] = f"{i - 1} {user_part}: {parts[1]}"
-        with open(threadtitle, "w") as f:
-            f.writelines(lines)
-        print(f"*Deleted message {msg_num} from {threadtitle}")
-        return "Message deleted"
-
-
-def remove_thread(args, req_user):
-    try:
-        _, threadtitle = args.split(" ", 1)
-    except ValueError:
-        print("*ERROR: Invalid RMV input")
-        return "ERROR: Invalid RMV input"
-    with thread_lock:
-        if threadtitle not in thread_metadata:
-            print(f"*ERROR: Thread {threadtitle} not exist")
+        lsn = log_mutation({"op": "DLT", "t": threadtitle, "u": req_user,
+                            "n": msg_num})
+    wal.sync(lsn)
+    log.info(f"*Deleted message {msg_num} from {threadtitle}")
+    return "Message deleted"
+
+
+def subscribe_thread(req_user, client_addr, threadtitle):
+    # SUB <title>: pushes of the thread's changes to this client
+    if not threadtitle or " " in threadtitle:
+        log.info("*ERROR: Invalid SUB input")
+        return "ERROR: Invalid SUB input"
+    with thread_locks.reading(threadtitle) as meta:
+        if meta is None:
+            log.info(f"*ERROR: Thread {threadtitle} not exist")
+            return f"ERROR: Thread {threadtitle} not exist"
+        pushes.subscribe(threadtitle, req_user, client_addr)
+    log.info(f"*{req_user} subscribed to {threadtitle}")
+    return f"Subscribed to {threadtitle}"
+
+
+def unsubscribe_thread(req_user, client_addr, threadtitle):
+    if not threadtitle:
+        log.info("*ERROR: Invalid UNSUB input")
+        return "ERROR: Invalid UNSUB input"
+    if not pushes.unsubscribe(threadtitle, req_user):
+        log.info(f"*ERROR: {req_user} not subscribed to {threadtitle}")
+        return f"ERROR: Not subscribed to {threadtitle}"
+    log.info(f"*{req_user} unsubscribed from {threadtitle}")
+    return f"Unsubscribed from {threadtitle}"
+
+
+def session_token(username, ip):
+    # Opens a transfer session for `username` from `ip` while it is logged in
+    return hmac.new(SESSION_SECRET, f"{username} {ip}".encode(),
+                    hashlib.sha256).digest()
+
+
+def session_ticket(req_user, client_addr):
+    log.info(f"*Transfer session token for {req_user}")
+    return f"SESSION {session_token(req_user, client_addr[0]).hex()}"
+
+
+def remove_thread(req_user, client_addr, threadtitle):
+    with thread_locks.writing(threadtitle) as meta:
+        if meta is None:
+            log.info(f"*ERROR: Thread {threadtitle} not exist")
             return f"ERROR: Thread {threadtitle} not exist"
-        with open(threadtitle, "r") as f:
-            creator = f.readline().strip()
-        if creator != req_user:
-            print("*ERROR: You can only remove your own thread")
+        if meta["owner"] != req_user:
+            log.info("*ERROR: You can only remove your own thread")
             return "ERROR: You can only remove your own thread"
-        rmv_count = 0
-        files_found = False
-        prefix = f"{threadtitle}-"
-        for fname in os.listdir('.'):
-            if fname.startswith(prefix) and os.path.isfile(fname):
-                files_found = True
-                os.remove(fname)
-                rmv_count += 1
-                print(f"*Removed file: {fname}")
-        if files_found == True:
-            os.remove(threadtitle)
-            del thread_metadata[threadtitle]
-            print(
-                f"*Thread {threadtitle} and {rmv_count} related file(s) removed")
-        return "Thread and related files removed"
+        for fname, blob in meta["files"].items():
+            release_blob(attachment_path(threadtitle, fname), blob)
+            log.info(f"*Removed file: {fname} from {threadtitle}")
+        # The thread directory is deleted by the next compaction
+        with thread_locks.registry:
+            lsn = log_mutation({"op": "RMV", "t": threadtitle,
+                                "u": req_user})
+            thread_locks.drop(threadtitle)
+        log.info(f"*Thread {threadtitle} and {len(meta['files'])} related "
+                 f"file(s) removed")
+    wal.sync(lsn)
+    return "Thread and related files removed"
 
 
-def process_udp_request(data, client_addr):
-    message = data.decode().strip()
-    parts = message.split(" ", 1)
-    command = parts[0].upper()
-    args = parts[1] if len(parts) > 1 else ""
-    req_user = get_username(client_addr)
-    print(f"@UDP - {command} from {client_addr} by (User: {req_user})")
-    if command == "LOGIN":
-        return login_user(args, client_addr)
-    elif command == "AUTH":
-        return auth_user(args, client_addr)
-    elif command == "REGISTER":
-        return reg_user(args, client_addr)
-    elif command == "XIT":
-        return exit_forum(req_user)
-    elif command == "CRT":
-        return create_thread(args, req_user)
-    elif command == "LST":
-        return list_threads()
-    elif command == "MSG":
-        return post_message(args, req_user)
-    elif command == "RDT":
-        return read_thread(args)
-    elif command == "EDT":
-        return edit_message(args, req_user)
-    elif command == "DLT":
-        return delete_message(args, req_user)
-    elif command == "RMV":
-        return remove_thread(args, req_user)
-    elif command == "UPD":
-        _, threadtitle, filename = args.split(" ", 2)
-        if threadtitle not in thread_metadata:
+def server_stats(req_user, client_addr):
+    # Open to local clients and to the users named with --admin
+    if req_user not in admins and not client_addr[0].startswith("127."):
+        log.info("*ERROR: STATS denied")
+        return "ERROR: STATS is for administrators"
+    return json.dumps(collect_stats())
+
+
+def upload_ready(req_user, client_addr, threadtitle, filename):
+    if not valid_name(filename):
+        return f"ERROR: Invalid file name '{filename}'"
+    with thread_locks.reading(threadtitle) as meta:
+        if meta is None:
             return f"ERROR: Thread '{threadtitle}' not exist"
-        if filename in thread_metadata[threadtitle]["files"]:
+        if filename in meta["files"]:
             return f"ERROR: File '{filename}' already exists"
-        return "Upload ready"
-    elif command == "DWN":
-        print(f"*Download ready {args}")
-        return f"Download ready {args}"
+    return "Upload ready"
+
+
+def download_ready(req_user, client_addr, threadtitle, filename):
+    log.debug("*Download ready %s %s", threadtitle, filename)
+    return f"Download ready {req_user} {threadtitle} {filename}"
+
+
+# Every handler is called as handler(req_user, client_addr, *fields), the
+# fields of COMMAND_FORMS whether the command came as text or binary
+COMMAND_HANDLERS = {
+    "LOGIN": login_user,
+    "AUTH": auth_user,
+    "REGISTER": reg_user,
+    "XIT": exit_forum,
+    "CRT": create_thread,
+    "LST": list_threads,
+    "MSG": post_message,
+    "RDT": read_thread,
+    "SRC": search_threads,
+    "EDT": edit_message,
+    "DLT": delete_message,
+    "RMV": remove_thread,
+    "SUB": subscribe_thread,
+    "UNSUB": unsubscribe_thread,
+    "UPD": upload_ready,
+    "DWN": download_ready,
+    "SES": session_ticket,
+    "STATS": server_stats,
+}
+
+
+def decode_command(data):
+    # (command, fields) for a text or binary command; fields is None when
+    # they do not fit the command's form
+    if data[:1] == b"\0":
+        return binary_fields(data)
+    command, _, args = data.decode().strip().partition(" ")
+    command = command.upper()
+    form = COMMAND_FORMS.get(command)
+    return command, text_fields(command, form, args) if form else None
+
+
+def option_number(value):
+    # Option values reach int() in the handlers; str.isdigit() alone also
+    # passes digits like "²" that int() rejects
+    return value.isascii() and value.isdigit()
+
+
+def text_fields(command, form, args):
+    _, count, options = form
+    values = {}
+    if options:
+        words = args.split()
+        while len(words) >= 2 and words[-2] in options and \
+                words[-2] not in values and option_number(words[-1]):
+            value = words.pop()
+            values[words.pop()] = value
+        if values:
+            args = " ".join(words)
+    if command in TEXT_WITH_USER:
+        # Who sent it is known from the session
+        args = args.partition(" ")[2]
+    fields = args.split(" ", count - 1) if count else []
+    if len(fields) != count:
+        return None
+    return fields + [values.get(name, "") for name in options]
+
+
+def binary_fields(data):
+    # Indexes the bytes directly, unpack_from() per field costs more than
+    # the rest of the decode
+    end = len(data)
+    if end < BINARY_COMMAND.size:
+        return "", None
+    command = BINARY_OPCODES.get(data[1], "")
+    count = data[2]
+    pos = BINARY_COMMAND.size
+    fields = []
+    try:
+        for _ in range(count):
+            start = pos + BINARY_FIELD.size
+            pos = start + (data[pos] << 8 | data[pos + 1])
+            if pos > end:
+                return command, None
+            fields.append(data[start:pos].decode())
+    except (IndexError, UnicodeDecodeError):
+        return command, None
+    if not command:
+        return command, None
+    _, positional, options = COMMAND_FORMS[command]
+    if count != positional + len(options):
+        return command, None
+    for value in fields[positional:]:
+        if value and not option_number(value):
+            return command, None
+    return command, fields
+
+
+def process_udp_request(data, client_addr):
+    start = time.perf_counter()
+    command, fields = decode_command(data)
+    req_user = get_username(client_addr)
+    log.debug("@UDP - %s from %s by (User: %s)", command, client_addr, req_user)
+    owner = command_shard(command, fields, req_user)
+    if owner is not None:
+        response = peers.call(owner, "command", data, client_addr)
     else:
-        print("*ERROR: Unknown command")
+        response = run_command(command, fields, req_user, data, client_addr)
+    metrics.record(command if command in COMMANDS else "OTHER",
+                   time.perf_counter() - start, response.startswith("ERROR"))
+    return response
+
+
+def run_command(command, fields, req_user, data, client_addr):
+    if command == "BATCH":
+        # Each command in it is checked for a session on its own
+        body = data.split(b" ", 1)[1] if b" " in data.strip() else b""
+        return run_batch(body, client_addr)
+    if req_user is None and command not in PUBLIC_COMMANDS:
+        log.info("*ERROR: Not logged in")
+        return "ERROR: Not logged in"
+    handler = COMMAND_HANDLERS.get(command)
+    if handler is None:
+        log.info("*ERROR: Unknown command")
         return "ERROR: Unknown command"
+    if fields is None:
+        log.info(f"*ERROR: Invalid {command} input")
+        return f"ERROR: Invalid {command} input"
+    return handler(req_user, client_addr, *fields)
+
+
+def collect_stats():
+    stats = metrics.snapshot()
+    if peers is not None:
+        stats["worker"] = shard
+    stats["threads"] = len(thread_metadata)
+    stats["search_index"] = {"tokens": len(search_index.df),
+                             "messages": search_index.messages}
+    stats["sessions"] = sessions.stats()
+    stats["push"] = pushes.stats()
+    stats["admission"] = admission.stats()
+    stats["bandwidth"] = bandwidth.stats()
+    stats["transfer_sessions"] = {
+        "open": len(mux_sessions),
+        "streams": sum(len(s.streams) for s in list(mux_sessions))}
+    stats["reply_cache"] = {"entries": len(reply_cache.replies),
+                            "bytes": reply_cache.bytes,
+                            "hits": reply_cache.hits}
+    stats["response_cache"] = {"entries": len(response_cache.entries),
+                               "bytes": response_cache.bytes,
+                               "hits": response_cache.hits,
+                               "misses": response_cache.misses}
+    return stats
+
+
+def stats_dumper(fname, interval):
+    # Rewrites `fname` every `interval` seconds; readers never see a
+    # half-written file
+    while True:
+        time.sleep(interval)
+        try:
+            with open(fname + ".tmp", "w") as f:
+                json.dump(collect_stats(), f, indent=1)
+            os.replace(fname + ".tmp", fname)
+        except OSError as e:
+            log.error(f"*ERROR: Stats dump failed - {e}")
+
+
+def split_batch(body):
+    # "<length>:<bytes>" items back to back, lengths in bytes
+    items = []
+    pos = 0
+    while pos < len(body):
+        colon = body.index(b":", pos)
+        size = int(body[pos:colon])
+        start = colon + 1
+        if size < 0 or start + size > len(body):
+            raise ValueError("Truncated batch item")
+        items.append(body[start:start + size])
+        pos = start + size
+    return items
+
+
+def run_batch(body, client_addr):
+    # BATCH <length>:<command>... runs the commands in order as this client,
+    # so a LOGIN early in the batch covers the rest. The reply is "BATCH "
+    # then one "<length>:OK <reply>" or "<length>:ERR <reply>" per command.
+    try:
+        commands = split_batch(body)
+    except ValueError:
+        return "ERROR: Malformed batch"
+    if not commands or len(commands) > MAX_BATCH:
+        return f"ERROR: A batch holds 1 to {MAX_BATCH} commands"
+    items = []
+    for command in commands:
+        if command.split(b" ", 1)[0].upper() == b"BATCH":
+            response = "ERROR: Nested BATCH"
+        else:
+            response = process_udp_request(command, client_addr)
+        status = "ERR" if response.startswith("ERROR") else "OK"
+        item = f"{status} {response}"
+        items.append(f"{len(item.encode())}:{item}")
+    log.debug("*Batch of %d command(s) done", len(commands))
+    return "BATCH " + "".join(items)
 
 
 def udp_server():
     udpSocket = socket(AF_INET, SOCK_DGRAM)
+    if peers is not None:
+        udpSocket.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
     udpSocket.bind(("", serverPort))
-    print(f"@UDP Server listening on port {serverPort}...")
+    pushes.send = udpSocket.sendto
+    if peers is not None:
+        peers.udp = udpSocket
+        peers.start()
+    log.info(f"@UDP Server listening on port {serverPort}...")
     try:
         while True:
-            data, clientAddress = udpSocket.recvfrom(4096)
+            data, clientAddress = udpSocket.recvfrom(65535)
+            busy = admit(data, clientAddress)
+            if busy is not None:
+                udpSocket.sendto(busy, clientAddress)
+                continue
+            if peers is not None and peers.forward(data, clientAddress):
+                continue
             # response = process_udp_request(data, clientAddress)
             # if response:
             # udpSocket.sendto(response.encode(), clientAddress)
-            executor.submit(process_udp_request_sync,
-                            udpSocket, data, clientAddress)
+            enqueue(executor, process_udp_request_sync,
+                    udpSocket, data, clientAddress)
     except KeyboardInterrupt:
-        print("@UDP server shutting down")
+        log.info("@UDP server shutting down")
     finally:
         if udpSocket:
             udpSocket.close()
-            print("@UDP socket closed.")
+            log.info("@UDP socket closed.")
+
+
+def admit(data, client_addr):
+    # The BUSY reply for a datagram that admission control turns away, or
+    # None to queue it. Enveloped requests get it as "RSP <seq> BUSY, ..."
+    # and the client resends the same seq after the pause; the command has
+    # not run, so nothing is cached for it.
+    if data.startswith(b"PSHACK "):
+        return None
+    seq, command = None, data
+    if data.startswith(BINARY_MAGIC):
+        try:
+            seq = BINARY_REQUEST.unpack_from(data)[4]
+        except struct.error:
+            return None
+        command = b""
+    elif data.startswith((b"REQ ", b"REQZ ")):
+        parts = data.split(b" ", 3)
+        if len(parts) == 4:
+            seq, command = parts[2], parts[3]
+    cost = 1
+    if command[:6].upper() == b"BATCH ":
+        try:
+            cost = max(len(split_batch(command[6:])), 1)
+        except ValueError:
+            pass
+    user = sessions.by_addr.get(client_addr)
+    retry = admission.check(user or client_addr[0], cost,
+                            metrics.queue_depth)
+    if retry is None:
+        return None
+    log.debug("@UDP - BUSY for %s (%s), retry after %.3fs", client_addr,
+              user, retry)
+    reply = f"{BUSY_REPLY}{retry:.3f}"
+    if isinstance(seq, int):
+        return fragment_reply(seq, reply, binary=True)[0]
+    return reply.encode() if seq is None else \
+        b"RSP " + seq + b" " + reply.encode()
+
+
+def enqueue(pool, fn, *args):
+    # pool.submit() that counts the call in the executor queue depth until
+    # a worker picks it up
+    metrics.queued(1)
+
+    def run():
+        metrics.queued(-1)
+        return fn(*args)
+    return pool.submit(run)
+
+
+def fragment_reply(seq, response, compress=False, binary=False):
+    # "RSP <seq> <reply>" when it fits one datagram, otherwise numbered
+    # "RSPF <seq> <index> <count> <bytes>" pieces for the client to join.
+    # Clients that sent REQZ get long replies zlib-compressed. Binary
+    # requests get the same pieces behind a BINARY_REPLY header.
+    body = response.encode()
+    if compress and len(body) >= REPLY_COMPRESS_SIZE:
+        packed = REPLY_ZLIB + zlib.compress(body, ZLIB_LEVEL)
+        if len(packed) < len(body):
+            body = packed
+    if binary:
+        count = max(-(-len(body) // FRAGMENT_SIZE), 1)
+        return [BINARY_REPLY.pack(BINARY_MAGIC, BINARY_VERSION, seq, i, count)
+                + body[i * FRAGMENT_SIZE:(i + 1) * FRAGMENT_SIZE]
+                for i in range(count)]
+    if len(body) <= FRAGMENT_SIZE:
+        return [f"RSP {seq} ".encode() + body]
+    count = -(-len(body) // FRAGMENT_SIZE)
+    return [f"RSPF {seq} {i} {count} ".encode() +
+            body[i * FRAGMENT_SIZE:(i + 1) * FRAGMENT_SIZE]
+            for i in range(count)]
+
+
+def datagram_shard(data, client_addr):
+    # command_shard() for a datagram as received, enveloped or bare. Push
+    # acknowledgements go to the worker that sent the push
+    if data.startswith(b"PSHACK "):
+        title = data.split(b" ", 2)[1].decode(errors="replace")
+        return None if owns(title) else shard_of(title)
+    if data.startswith(BINARY_MAGIC):
+        data = data[BINARY_REQUEST.size:]
+    elif data.startswith((b"REQ ", b"REQZ ")):
+        parts = data.split(b" ", 3)
+        if len(parts) < 4:
+            return None
+        data = parts[3]
+    try:
+        command, fields = decode_command(data)
+    except UnicodeDecodeError:
+        return None
+    req_user = get_username(client_addr) if command == "XIT" else None
+    return command_shard(command, fields, req_user)
+
+
+def handle_datagram(data, clientAddress):
+    # Shared by both engines, returns the reply datagrams; none for a
+    # duplicate whose original is still running. Bare commands without
+    # the REQ envelope are still answered, just without duplicate checks.
+    # REQZ is REQ from a client that takes compressed replies. Binary
+    # requests carry the same client id and seq in BINARY_REQUEST.
+    if data.startswith(b"PSHACK "):
+        try:
+            _, title, push_id = data.decode().split(" ")
+            pushes.ack(title, int(push_id), clientAddress)
+        except ValueError:
+            pass
+        return []
+    binary = data.startswith(BINARY_MAGIC)
+    if binary:
+        try:
+            _, version, flags, client_id, seq = \
+                BINARY_REQUEST.unpack_from(data)
+        except struct.error:
+            return [b"ERROR: Malformed request"]
+        if version != BINARY_VERSION:
+            return fragment_reply(seq, "ERROR: Unsupported binary version",
+                                  binary=True)
+        command = data[BINARY_REQUEST.size:]
+        compress = bool(flags & BINARY_ZLIB)
+    elif not data.startswith((b"REQ ", b"REQZ ")):
+        return [process_udp_request(data, clientAddress).encode()]
+    else:
+        try:
+            envelope, client_id, seq, command = data.split(b" ", 3)
+            seq = int(seq)
+        except ValueError:
+            return [b"ERROR: Malformed request"]
+        compress = envelope == b"REQZ"
+    key = (client_id, seq)
+    duplicate, reply = reply_cache.begin(key)
+    if duplicate:
+        log.debug("@UDP - Retransmit %s from %s, %s", seq, clientAddress,
+              "cached reply" if reply else "still running")
+        return reply or []
+    try:
+        reply = fragment_reply(seq, process_udp_request(command, clientAddress),
+                               compress, binary)
+    finally:
+        reply_cache.finish(key, reply)
+    return reply
+
 
 def process_udp_request_sync(socket, data, clientAddress):
-    response = process_udp_request(data, clientAddress)
-    socket.sendto(response.encode(), clientAddress)
+    for datagram in handle_datagram(data, clientAddress):
+        socket.sendto(datagram, clientAddress)
+
 
 def tcp_server():
     tcpSocket = socket(AF_INET, SOCK_STREAM)
+    if peers is not None:
+        tcpSocket.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
     tcpSocket.bind(("", serverPort))
     tcpSocket.listen(5)
-    print(f"@TCP Server listening on port {serverPort}...")
+    log.info(f"@TCP Server listening on port {serverPort}...")
+    try:
+        while True:
+            conn, addr = tcpSocket.accept()
+            transfer_thread = Thread(
+                target=file_transfer, args=(conn, addr), daemon=True)
+            transfer_thread.start()
+    finally:
+        tcpSocket.close()
+        log.info("@TCP socket closed.")
+
+
+def recv_exact(conn, size):
+    data = bytearray()
+    while len(data) < size:
+        part = conn.recv(size - len(data))
+        if not part:
+            raise ConnectionError("Connection closed mid-transfer")
+        data += part
+    return bytes(data)
+
+
+def read_transfer_header(conn):
+    # None when the client closes the connection between requests
+    first = conn.recv(TRANSFER_HEADER.size)
+    if not first:
+        return None
+    magic, version, op, flags, size, offset, names_len, digest = \
+        TRANSFER_HEADER.unpack(
+            first + recv_exact(conn, TRANSFER_HEADER.size - len(first)))
+    if magic != TRANSFER_MAGIC or version != TRANSFER_VERSION:
+        raise ValueError("Unsupported transfer header")
+    names = recv_exact(conn, names_len).decode().split("\0")
+    return op, flags, size, offset, digest, names
+
+
+def send_transfer_header(conn, op, flags=0, size=0, offset=0, digest=b"",
+                         names=()):
+    payload = "\0".join(names).encode()
+    conn.sendall(TRANSFER_HEADER.pack(TRANSFER_MAGIC, TRANSFER_VERSION, op,
+                                      flags, size, offset, len(payload),
+                                      digest)
+                 + payload)
+
+
+def reject_transfer(conn, message):
+    log.warning(f"@TCP ERROR - {message}")
+    send_transfer_header(conn, STATUS_ERROR, names=[f"ERROR: {message}"])
+
+
+def hash_prefix(fname, size, hasher):
+    with open(fname, "rb") as f:
+        while size:
+            block = f.read(min(size, TRANSFER_CHUNK))
+            if not block:
+                break
+            hasher.update(block)
+            size -= len(block)
+
+
+def pick_codec(flags):
+    # The client offers codecs in the request flags, zlib is cheaper
+    return FLAG_ZLIB if flags & FLAG_ZLIB else flags & FLAG_LZMA
+
+
+def compressible(fname, offset=0):
+    # Skips formats that are compressed already, by extension and by how
+    # well a sample from `offset` compresses
+    if os.path.splitext(fname)[1].lower() in COMPRESSED_TYPES:
+        return False
+    with open(fname, "rb") as f:
+        f.seek(offset)
+        sample = f.read(COMPRESS_SAMPLE)
+    return len(zlib.compress(sample, 1)) <= \
+        len(sample) * (1 - COMPRESS_MIN_SAVING)
+
+
+def compressor(codec):
+    if codec == FLAG_LZMA:
+        return lzma.LZMACompressor(preset=LZMA_PRESET)
+    return zlib.compressobj(ZLIB_LEVEL)
+
+
+def decompressor(codec):
+    if codec == FLAG_LZMA:
+        return lzma.LZMADecompressor()
+    return zlib.decompressobj()
+
+
+def inflate(decomp, data):
+    # Output of one frame in pieces of at most TRANSFER_CHUNK bytes, so a
+    # small frame cannot expand into a huge buffer
+    if isinstance(decomp, lzma.LZMADecompressor):
+        yield decomp.decompress(data, TRANSFER_CHUNK)
+        while not decomp.needs_input and not decomp.eof:
+            yield decomp.decompress(b"", TRANSFER_CHUNK)
+        return
+    while True:
+        out = decomp.decompress(data, TRANSFER_CHUNK)
+        data = decomp.unconsumed_tail
+        yield out
+        if not data and len(out) < TRANSFER_CHUNK:
+            return
+
+
+def send_compressed(conn, f, count, codec):
+    # The body as "<length><compressed bytes>" frames and an empty frame
+    # to end it; returns the bytes put on the wire
+    comp = compressor(codec)
+    sent = 0
+    while True:
+        block = f.read(min(count, TRANSFER_CHUNK))
+        count -= len(block)
+        data = comp.compress(block) if block else comp.flush()
+        if data:
+            conn.sendall(COMPRESS_FRAME.pack(len(data)) + data)
+            sent += COMPRESS_FRAME.size + len(data)
+        if not block:
+            break
+    conn.sendall(COMPRESS_FRAME.pack(0))
+    return sent + COMPRESS_FRAME.size
+
+
+def receive_compressed(conn, size, codec, consume):
+    # Reads frames until the empty one, passing exactly `size` decompressed
+    # bytes to consume(); returns the bytes read off the wire
+    decomp = decompressor(codec)
+    produced = received = 0
     while True:
-        conn, addr = tcpSocket.accept()
-        transfer_thread = Thread(
-            target=file_transfer, args=(conn, addr), daemon=True)
-        transfer_thread.start()
-        if tcpSocket:
-            tcpSocket.close()
-            print("@TCP socket closed.")
+        length, = COMPRESS_FRAME.unpack(recv_exact(conn, COMPRESS_FRAME.size))
+        received += COMPRESS_FRAME.size + length
+        if not length:
+            break
+        if length > MAX_COMPRESS_FRAME:
+            raise ConnectionError("Compressed frame too large")
+        for piece in inflate(decomp, recv_exact(conn, length)):
+            produced += len(piece)
+            if produced > size:
+                raise ConnectionError("Body longer than announced")
+            consume(piece)
+    if produced != size:
+        raise ConnectionError(
+            f"Body truncated, {size - produced} of {size} bytes missing")
+    return received
 
 
-def file_transfer(conn, addr):
-    print(f"@TCP - Connection from {addr}")
+def receive_body(conn, tmp_name, offset, size, hasher, codec=0):
+    buffer = bytearray(TRANSFER_CHUNK)
+    view = memoryview(buffer)
+    remaining = size - offset
+    with open(tmp_name, "r+b" if offset else "wb") as f:
+        f.seek(offset)
+        f.truncate()
+        if codec:
+            def consume(piece):
+                f.write(piece)
+                hasher.update(piece)
+            metrics.transferred(
+                received=receive_compressed(conn, remaining, codec, consume))
+            return
+        while remaining:
+            received = conn.recv_into(view[:min(remaining, TRANSFER_CHUNK)])
+            if not received:
+                raise ConnectionError(
+                    f"Upload truncated, {remaining} of {size} bytes missing")
+            f.write(view[:received])
+            if hasher:
+                hasher.update(view[:received])
+            remaining -= received
+    metrics.transferred(received=size - offset)
+
+
+def receive_upload(conn, flags, size, digest, uname, title, fname):
+    full_name = attachment_path(title, fname)
+    with thread_locks.reading(title) as meta:
+        if meta is None:
+            return reject_transfer(conn, "Thread not exist")
+        make_thread_dirs(title)
+    if os.path.exists(full_name):
+        return reject_transfer(conn, "File already exists in thread")
+    if size > MAX_UPLOAD_SIZE or size > shutil.disk_usage(".").free:
+        return reject_transfer(conn, f"File too large ({size} bytes)")
+    with uploads_lock:
+        chunked = chunked_uploads.get(full_name)
+        if full_name in uploads_in_progress or (chunked and chunked.active):
+            return reject_transfer(conn, "Upload already in progress")
+        uploads_in_progress.add(full_name)
+        # An abandoned parallel upload's .part is preallocated, not a prefix
+        if chunked or os.path.exists(f"{partial_path(title, fname)}.manifest"):
+            chunked_uploads.pop(full_name, None)
+            ChunkedUpload(partial_path(title, fname), 0, 0, []).discard()
+    # Received into a temp file and renamed only once complete, so a
+    # dropped connection never leaves a truncated attachment behind. With
+    # FLAG_RESUME the .part file is kept and the client is told how much
+    # of it the server already has.
+    tmp_name = f"{partial_path(title, fname)}.part"
     try:
-        header = b""
-        while b"\n" not in header:
-            part = conn.recv(1)
-            if not part:
-                return
-            header += part
-        header = header.decode().strip()
-        if header.startswith("UPD:"):
-            uname, title, fname = header[4:].split("#", 2)
-            print(uname)
-            full_name = f"{title}-{fname}"
-            if os.path.exists(full_name):
-                conn.sendall(b"ERROR: File already exists in thread")
+        if flags & FLAG_CHECKSUM:
+            # The digest is of the whole file, so content the store already
+            # has is attached without the client sending it: the reply
+            # offset tells it there is nothing left to send
+            blob = digest.hex()
+            with thread_locks.writing(title) as meta:
+                if meta is None:
+                    return reject_transfer(conn, "Thread not exist")
+                if link_blob(blob, full_name, size):
+                    lsn = log_mutation({"op": "UPD", "t": title, "u": uname,
+                                        "f": fname, "b": blob})
+                else:
+                    lsn = None
+            if lsn is not None:
+                wal.sync(lsn)
+                send_transfer_header(conn, STATUS_OK, size=size, offset=size)
+                log.info(f"@UPD - {fname} linked to {title} by {uname} "
+                         f"({size} bytes already stored)")
+                send_transfer_header(conn, STATUS_OK, size=size,
+                                     names=["UPLOAD_SUCCESS"])
+                return True
+        offset = 0
+        if flags & FLAG_RESUME and os.path.isfile(tmp_name):
+            offset = os.path.getsize(tmp_name)
+            if offset > size:
+                offset = 0
+        # Always hashed, the SHA-256 is the blob the attachment is stored as
+        hasher = hashlib.sha256()
+        if offset:
+            hash_prefix(tmp_name, offset, hasher)
+        # The reply flags name the codec the body will be compressed with
+        codec = pick_codec(flags)
+        send_transfer_header(conn, STATUS_OK, codec, size=size, offset=offset)
+        if offset:
+            log.info(f"@UPD - Resuming {fname} in {title} at byte {offset}")
+        try:
+            receive_body(conn, tmp_name, offset, size, hasher, codec)
+        except BaseException:
+            if not flags & FLAG_RESUME:
+                os.remove(tmp_name)
+            raise
+        if flags & FLAG_CHECKSUM and hasher.digest() != digest:
+            os.remove(tmp_name)
+            return reject_transfer(conn, "Checksum mismatch")
+        blob = hasher.hexdigest()
+        with thread_locks.writing(title) as meta:
+            if meta is None:
+                os.remove(tmp_name)
+                return reject_transfer(conn, "Thread not exist")
+            os.replace(tmp_name, full_name)
+            share_blob(full_name, blob)
+            lsn = log_mutation({"op": "UPD", "t": title, "u": uname,
+                                "f": fname, "b": blob})
+        wal.sync(lsn)
+    finally:
+        with uploads_lock:
+            uploads_in_progress.discard(full_name)
+    log.info(f"@UPD - {fname} saved to {title} by {uname} ({size} bytes)")
+    send_transfer_header(conn, STATUS_OK, size=size, names=["UPLOAD_SUCCESS"])
+    return True
+
+
+def write_at(fd, data, offset):
+    # Positional write, so parallel streams never share a file position
+    while data:
+        if hasattr(os, "pwrite"):
+            written = os.pwrite(fd, data, offset)
+        else:
+            os.lseek(fd, offset, os.SEEK_SET)
+            written = os.write(fd, data)
+        data = data[written:]
+        offset += written
+
+
+class ChunkedUpload:
+    """A parallel upload: the file is split into fixed-size chunks sent over
+    several connections and written in place into a preallocated .part
+    file. Which chunks have arrived intact is kept in a .manifest file next
+    to it, so a later run only resends the missing ones."""
+
+    def __init__(self, base, size, chunk_size, digests, done=(),
+                 sha256=None):
+        self.tmp_name = f"{base}.part"
+        self.manifest_name = f"{base}.manifest"
+        self.size = size
+        self.chunk_size = chunk_size
+        self.digests = digests  # hex SHA-256 per chunk, from the client
+        self.sha256 = sha256  # of the whole file, if the client sent it
+        self.done = set(done)
+        self.active = 0  # connections currently writing chunks
+        self.lock = Lock()
+
+    @classmethod
+    def load(cls, base):
+        try:
+            with open(f"{base}.manifest") as f:
+                m = json.load(f)
+            return cls(base, m["size"], m["chunk_size"], m["chunks"],
+                       m["done"], m.get("sha256"))
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def matches(self, size, chunk_size, digests, sha256):
+        return (self.size, self.chunk_size, self.digests, self.sha256) == \
+            (size, chunk_size, digests, sha256) and \
+            os.path.exists(self.tmp_name)
+
+    def save(self):
+        with self.lock:
+            m = {"size": self.size, "chunk_size": self.chunk_size,
+                 "chunks": self.digests, "done": sorted(self.done),
+                 "sha256": self.sha256}
+        with open(self.manifest_name + ".tmp", "w") as f:
+            json.dump(m, f)
+        os.replace(self.manifest_name + ".tmp", self.manifest_name)
+
+    def chunk_index(self, offset, length):
+        # Index of the chunk [offset, offset + length), None if misaligned
+        index, rest = divmod(offset, self.chunk_size)
+        if rest or index >= len(self.digests) or \
+                length != min(self.chunk_size, self.size - offset):
+            return None
+        return index
+
+    def complete(self):
+        return len(self.done) == len(self.digests)
+
+    def discard(self):
+        for name in (self.tmp_name, self.manifest_name):
+            if os.path.exists(name):
+                os.remove(name)
+
+
+def parse_manifest(body):
+    m = json.loads(body)
+    size, chunk_size, digests = m["size"], m["chunk_size"], m["chunks"]
+    sha256 = m.get("sha256")
+    if not (isinstance(size, int) and isinstance(chunk_size, int)
+            and chunk_size > 0 and size >= 0 and isinstance(digests, list)
+            and len(digests) == -(-size // chunk_size)
+            and all(isinstance(d, str) and len(d) == 64 for d in digests)
+            and (sha256 is None or BLOB_NAME.fullmatch(str(sha256)))):
+        raise ValueError("Invalid manifest")
+    return size, chunk_size, digests, sha256
+
+
+def receive_manifest(conn, flags, size, uname, title, fname):
+    full_name = attachment_path(title, fname)
+    if size > MAX_MANIFEST_SIZE:
+        return reject_transfer(conn, "Manifest too large")
+    body = recv_exact(conn, size)
+    with thread_locks.reading(title) as meta:
+        if meta is None:
+            return reject_transfer(conn, "Thread not exist")
+        make_thread_dirs(title)
+    if os.path.exists(full_name):
+        return reject_transfer(conn, "File already exists in thread")
+    try:
+        total, chunk_size, digests, sha256 = parse_manifest(body)
+    except (ValueError, KeyError, TypeError):
+        return reject_transfer(conn, "Invalid manifest")
+    if sha256 is not None:
+        # Content the store already has is attached right away
+        with uploads_lock:
+            if full_name in uploads_in_progress:
+                return reject_transfer(conn, "Upload already in progress")
+        with thread_locks.writing(title) as meta:
+            if meta is None:
+                return reject_transfer(conn, "Thread not exist")
+            if link_blob(sha256, full_name, total):
+                lsn = log_mutation({"op": "UPD", "t": title, "u": uname,
+                                    "f": fname, "b": sha256})
+            else:
+                lsn = None
+        if lsn is not None:
+            wal.sync(lsn)
+            log.info(f"@UPD - {fname} linked to {title} by {uname} "
+                     f"({total} bytes already stored)")
+            reply = json.dumps({"done": list(range(len(digests))),
+                                "stored": True}).encode()
+            send_transfer_header(conn, STATUS_OK, size=len(reply))
+            conn.sendall(reply)
+            return True
+    if total > MAX_UPLOAD_SIZE or total > shutil.disk_usage(".").free:
+        return reject_transfer(conn, f"File too large ({total} bytes)")
+    with uploads_lock:
+        if full_name in uploads_in_progress:
+            return reject_transfer(conn, "Upload already in progress")
+        upload = chunked_uploads.get(full_name) or \
+            ChunkedUpload.load(partial_path(title, fname))
+        if upload is None or \
+                not upload.matches(total, chunk_size, digests, sha256):
+            if upload is not None and upload.active:
+                return reject_transfer(conn, "Upload already in progress")
+            # A new file (or a changed one): start from an empty .part of
+            # the final size, sparse where the filesystem allows
+            upload = ChunkedUpload(partial_path(title, fname), total,
+                                   chunk_size, digests, sha256=sha256)
+            with open(upload.tmp_name, "wb") as f:
+                f.truncate(total)
+            upload.save()
+        chunked_uploads[full_name] = upload
+        done = sorted(upload.done)
+    if done:
+        log.info(f"@UPD - Resuming {fname} in {title}, {len(done)} of "
+                 f"{len(digests)} chunks already received")
+    reply = json.dumps({"done": done}).encode()
+    # The codec accepted here is the one OP_CHUNK bodies may use
+    send_transfer_header(conn, STATUS_OK, pick_codec(flags), size=len(reply))
+    conn.sendall(reply)
+    return True
+
+
+def receive_chunk(conn, flags, size, offset, uname, title, fname):
+    full_name = attachment_path(title, fname)
+    with uploads_lock:
+        upload = chunked_uploads.get(full_name)
+        if upload is not None:
+            upload.active += 1
+    if upload is None:
+        return reject_transfer(conn, "No parallel upload in progress")
+    try:
+        index = upload.chunk_index(offset, size)
+        if index is None:
+            return reject_transfer(conn, "Invalid chunk range")
+        hasher = hashlib.sha256()
+        codec = flags & CODECS
+        fd = os.open(upload.tmp_name, os.O_WRONLY | getattr(os, "O_BINARY", 0))
+        try:
+            received = 0
+            if codec:
+                def consume(piece):
+                    nonlocal received
+                    write_at(fd, piece, offset + received)
+                    hasher.update(piece)
+                    received += len(piece)
+                wire = receive_compressed(conn, size, pick_codec(codec),
+                                          consume)
+            else:
+                buffer = bytearray(min(TRANSFER_CHUNK, size) or 1)
+                view = memoryview(buffer)
+                while received < size:
+                    n = conn.recv_into(
+                        view[:min(size - received, len(buffer))])
+                    if not n:
+                        raise ConnectionError(
+                            f"Chunk at byte {offset} truncated")
+                    write_at(fd, view[:n], offset + received)
+                    hasher.update(view[:n])
+                    received += n
+                wire = size
+        finally:
+            os.close(fd)
+        metrics.transferred(received=wire)
+        if hasher.hexdigest() != upload.digests[index]:
+            return reject_transfer(conn, f"Checksum mismatch in chunk {index}")
+        with upload.lock:
+            upload.done.add(index)
+        upload.save()
+    finally:
+        with uploads_lock:
+            upload.active -= 1
+    send_transfer_header(conn, STATUS_OK, size=size, offset=offset)
+    return True
+
+
+def commit_upload(conn, uname, title, fname):
+    full_name = attachment_path(title, fname)
+    with uploads_lock:
+        upload = chunked_uploads.get(full_name)
+        if upload is None or upload.active or not upload.complete():
+            return reject_transfer(conn, "Upload incomplete")
+        chunked_uploads.pop(full_name)
+    # Chunks arrive out of order, so the blob is hashed once they are all in
+    blob = file_blob(upload.tmp_name)
+    if upload.sha256 is not None and blob != upload.sha256:
+        upload.discard()
+        return reject_transfer(conn, "Checksum mismatch")
+    with thread_locks.writing(title) as meta:
+        if meta is None or os.path.exists(full_name):
+            upload.discard()
+            return reject_transfer(conn, "Thread not exist" if meta is None
+                                   else "File already exists in thread")
+        os.replace(upload.tmp_name, full_name)
+        share_blob(full_name, blob)
+        lsn = log_mutation({"op": "UPD", "t": title, "u": uname, "f": fname,
+                            "b": blob})
+    wal.sync(lsn)
+    upload.discard()
+    log.info(f"@UPD - {fname} saved to {title} by {uname} "
+             f"({upload.size} bytes, {len(upload.digests)} chunks)")
+    send_transfer_header(conn, STATUS_OK, size=upload.size,
+                         names=["UPLOAD_SUCCESS"])
+    return True
+
+
+def send_stat(conn, title, fname):
+    try:
+        size = os.path.getsize(attachment_path(title, fname))
+    except OSError:
+        return reject_transfer(conn, "File not found")
+    send_transfer_header(conn, STATUS_OK, size=size)
+    return True
+
+
+def send_download(conn, flags, title, fname, offset, length):
+    # Sends bytes [offset, offset + length) of the attachment, or up to the
+    # end of the file when length is 0; compressed if the client offered a
+    # codec and the bytes are worth it
+    full_name = attachment_path(title, fname)
+    try:
+        f = open(full_name, "rb")
+    except FileNotFoundError:
+        return reject_transfer(conn, "File not found")
+    with f:
+        total = os.fstat(f.fileno()).st_size
+        if offset > total:
+            return reject_transfer(conn, "Invalid range")
+        count = total - offset
+        if length:
+            count = min(count, length)
+        codec = pick_codec(flags) if count else 0
+        if codec and not compressible(full_name, offset):
+            codec = 0
+        send_transfer_header(conn, STATUS_OK, codec, size=count,
+                             offset=offset)
+        if codec:
+            f.seek(offset)
+            sent = send_compressed(conn, f, count, codec)
+        elif count:
+            # Zero-copy where the OS supports it (os.sendfile)
+            sent = conn.sendfile(f, offset, count)
+        else:
+            sent = 0
+    metrics.transferred(sent=sent)
+    log.debug("@DWN - Sent %s bytes %d-%d of %d from %s", fname,
+              offset, offset + count, total, title)
+    return True
+
+
+def refuse_busy(conn):
+    try:
+        send_transfer_header(conn, STATUS_ERROR, names=[
+            f"{BUSY_REPLY}{TRANSFER_RETRY_AFTER}"])
+    except OSError:
+        pass
+    conn.close()
+
+
+def file_transfer(conn, addr, request=None, user=None, admitted=False):
+    # A connection may carry several requests one after another (a parallel
+    # transfer stream sends all its chunks on one); any rejection closes
+    # it, since the client may already have sent the request's body.
+    # `request` is one already read off conn by another worker. `user` is
+    # set for a stream of a transfer session, which acts for that user
+    # whatever the requests name; `admitted` when the session already
+    # took its bandwidth.enter() slot.
+    log.debug("@TCP - Connection from %s", addr)
+    if not admitted and not bandwidth.enter():
+        log.info(f"@TCP - BUSY, {bandwidth.transfers} transfers running")
+        refuse_busy(conn)
+        return
+    handed_off = False  # a session took the connection over
+    try:
+        conn.settimeout(TRANSFER_TIMEOUT)
+        while True:
+            if request is None:
+                try:
+                    request = read_transfer_header(conn)
+                except ValueError as e:
+                    return reject_transfer(conn, str(e))
+                if request is None:
+                    return
+            op, flags, size, offset, digest, names = request
+            if op == OP_SESSION and user is None:
+                handed_off = open_session(conn, addr, names, digest)
                 return
-            with open(full_name, "wb") as f:
-                while True:
-                    data = conn.recv(4096)
-                    if not data:
-                        break
-                    f.write(data)
-            with open(title, "a") as thread_file:
-                thread_file.write(f"{uname} uploaded {fname}\n")
-            thread_metadata[title]["files"].append(fname)
-            print(f"@UPD - {fname} saved to {title}")
-            conn.sendall(b"UPLOAD_SUCCESS")
-        elif header.startswith("DWN:"):
-            title, fname = header[4:].split("#", 1)
-            full_name = f"{title}-{fname}"
-            if os.path.exists(full_name):
-                with open(full_name, "rb") as f:
-                    while True:
-                        data = f.read(4096)
-                        if not data:
-                            break
-                        conn.sendall(data)
-                print(f"@DWN - Sent {full_name} from {title}")
+            if len(names) != 3:
+                return reject_transfer(conn, "Invalid transfer request")
+            if not (valid_name(names[1]) and valid_name(names[2])):
+                return reject_transfer(conn, "Invalid file name")
+            if user is not None:
+                names[0] = user
+            if peers is not None and op not in (OP_DOWNLOAD, OP_STAT) and \
+                    not owns(names[1]):
+                # Uploads change the thread, its owner takes the connection
+                if user is not None:
+                    return relay_stream(conn, shard_of(names[1]), request,
+                                        addr)
+                return peers.hand_over(shard_of(names[1]), conn, request, addr)
+            if bandwidth.limited() and not isinstance(conn, ThrottledConn):
+                conn = ThrottledConn(conn, bandwidth_account(addr, user))
+            request = None
+            if op == OP_UPLOAD:
+                ok = receive_upload(conn, flags, size, digest, *names)
+            elif op == OP_DOWNLOAD:
+                ok = send_download(conn, flags, names[1], names[2], offset,
+                                   size)
+            elif op == OP_MANIFEST:
+                ok = receive_manifest(conn, flags, size, *names)
+            elif op == OP_CHUNK:
+                ok = receive_chunk(conn, flags, size, offset, *names)
+            elif op == OP_COMMIT:
+                ok = commit_upload(conn, *names)
+            elif op == OP_STAT:
+                ok = send_stat(conn, names[1], names[2])
             else:
-                conn.sendall(b"FILE_NOT_FOUND")
+                ok = reject_transfer(conn, "Invalid transfer request")
+            if not ok:
+                return
     except Exception as e:
-        print(f"@TCP Error - {str(e)}")
+        log.error(f"@TCP Error - {str(e)}")
     finally:
-        conn.close()
+        if not handed_off:
+            conn.close()
+        bandwidth.leave()
 
 
-def start_server():
-    print("=== Starting server... ===")
-    load_credentials()
-    load_threads()
-    udpThread = Thread(target=udp_server, daemon=True)
-    udpThread.start()
-    tcpThread = Thread(target=tcp_server, daemon=True)
-    tcpThread.start()
-    print("Server started. Press Ctrl+C to shut down.")
+def bandwidth_account(addr, user):
+    # Who a transfer's bytes are charged to. A session stream's user was
+    # checked against the SES token; the name in a plain request is the
+    # client's say-so, so those connections share one account per IP
+    return user if user is not None else ("ip", addr[0])
+
+
+class ThrottledConn:
+    """
+    Socket-like wrapper that charges every byte a transfer moves to its
+    user's share of the bandwidth (BandwidthScheduler), BANDWIDTH_QUANTUM
+    bytes at a time, so the sleeps stay short and shares stay even.
+    Anything else goes straight to the wrapped connection.
+    """
+
+    def __init__(self, conn, user):
+        self.conn = conn
+        self.user = user
+        bandwidth.join(user)
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def recv(self, bufsize):
+        data = self.conn.recv(min(bufsize, BANDWIDTH_QUANTUM))
+        bandwidth.charge(self.user, len(data))
+        return data
+
+    def recv_into(self, buffer, nbytes=0):
+        nbytes = min(nbytes or len(buffer), BANDWIDTH_QUANTUM)
+        received = self.conn.recv_into(buffer, nbytes)
+        bandwidth.charge(self.user, received)
+        return received
+
+    def sendall(self, data):
+        view = memoryview(data)
+        for start in range(0, len(view), BANDWIDTH_QUANTUM):
+            piece = view[start:start + BANDWIDTH_QUANTUM]
+            bandwidth.charge(self.user, len(piece))
+            self.conn.sendall(piece)
+
+    def sendfile(self, file, offset=0, count=None):
+        sent = 0
+        while count is None or sent < count:
+            piece = BANDWIDTH_QUANTUM if count is None else \
+                min(BANDWIDTH_QUANTUM, count - sent)
+            bandwidth.charge(self.user, piece)
+            done = self.conn.sendfile(file, offset + sent, piece)
+            if not done:
+                break
+            sent += done
+        return sent
+
+    def close(self):
+        bandwidth.part(self.user)
+        self.conn.close()
+
+
+class MuxStream:
+    """
+    One transfer inside a MuxSession, with the blocking socket calls
+    file_transfer() makes. The session's reader feeds incoming DATA
+    frames into `buffer`; past MUX_WINDOW bytes it waits for the transfer
+    to catch up, which stalls the whole session, so the window stays
+    small. Sends go out as DATA frames of at most MUX_CHUNK bytes.
+    """
+
+    def __init__(self, session, stream_id):
+        self.session = session
+        self.id = stream_id
+        self.cond = Condition()
+        self.buffer = bytearray()
+        self.ended = False  # the peer closed the stream, or the session ended
+        self.closed = False
+        self.timeout = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def feed(self, data):
+        with self.cond:
+            self.cond.wait_for(lambda: len(self.buffer) < MUX_WINDOW or
+                               self.closed)
+            if not self.closed:
+                self.buffer += data
+                self.cond.notify_all()
+
+    def end(self):
+        with self.cond:
+            self.ended = True
+            self.cond.notify_all()
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def recv_into(self, buffer, nbytes=0):
+        nbytes = nbytes or len(buffer)
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.buffer or self.ended or
+                                      self.closed, self.timeout):
+                raise timeout("timed out")
+            n = min(nbytes, len(self.buffer))
+            buffer[:n] = self.buffer[:n]
+            del self.buffer[:n]
+            self.cond.notify_all()
+            return n
+
+    def recv(self, bufsize):
+        data = bytearray(min(bufsize, MUX_WINDOW))
+        return bytes(data[:self.recv_into(data)])
+
+    def sendall(self, data):
+        view = memoryview(data)
+        for start in range(0, len(view), MUX_CHUNK):
+            self.session.send(self.id, MUX_DATA,
+                              view[start:start + MUX_CHUNK])
+
+    def sendfile(self, file, offset=0, count=None):
+        # No zero-copy path through the framing
+        file.seek(offset)
+        sent = 0
+        while count is None or sent < count:
+            block = file.read(MUX_CHUNK if count is None else
+                              min(MUX_CHUNK, count - sent))
+            if not block:
+                break
+            self.sendall(block)
+            sent += len(block)
+        return sent
+
+    def close(self):
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.buffer.clear()
+            self.cond.notify_all()
+        self.session.close_stream(self)
+
+
+class MuxSession:
+    """
+    A transfer connection opened with OP_SESSION, carrying many
+    transfers at once so a client pays for one connect and one login
+    instead of one per file. Every frame is MUX_FRAME (stream id, kind,
+    payload length) and its payload. A DATA frame with a new, higher
+    stream id opens a stream, which carries exactly what a transfer
+    connection would and is served by file_transfer() on stream_pool;
+    CLOSE ends it. Bodies are cut into MUX_CHUNK frames, so a large
+    transfer never holds up the small ones for long. The session reads on
+    a thread of its own, outside the transfer workers, and holds one of
+    the session_slots; only its streams count as transfers.
+    """
+
+    def __init__(self, conn, addr, user):
+        self.conn = conn
+        self.addr = addr
+        self.user = user
+        self.send_lock = Lock()
+        self.lock = Lock()
+        self.streams = {}  # {stream id: MuxStream}
+        self.last_id = 0
+        self.opened = 0
+
+    def send(self, stream_id, kind, data=b""):
+        with self.send_lock:
+            header = MUX_FRAME.pack(stream_id, kind, len(data))
+            if len(data) < MUX_CHUNK:
+                # Header and payload in one segment, small frames are common
+                self.conn.sendall(header + bytes(data))
+            else:
+                self.conn.sendall(header)
+                self.conn.sendall(data)
+
+    def close_stream(self, stream):
+        with self.lock:
+            if self.streams.get(stream.id) is not stream:
+                return
+            del self.streams[stream.id]
+        try:
+            self.send(stream.id, MUX_CLOSE)
+        except OSError:
+            pass
+
+    def serve(self):
+        mux_sessions.add(self)
+        try:
+            while True:
+                try:
+                    header = self.conn.recv(MUX_FRAME.size)
+                except timeout:
+                    return  # idle for MUX_IDLE_TIMEOUT
+                if not header:
+                    return
+                stream_id, kind, length = MUX_FRAME.unpack(
+                    header + recv_exact(self.conn,
+                                        MUX_FRAME.size - len(header)))
+                if length > MUX_CHUNK:
+                    raise ValueError("Session frame too large")
+                data = recv_exact(self.conn, length) if length else b""
+                with self.lock:
+                    stream = self.streams.get(stream_id)
+                if kind == MUX_CLOSE:
+                    if stream is not None:
+                        stream.end()
+                    continue
+                if stream is None:
+                    # Frames still in flight for a stream we closed
+                    if stream_id <= self.last_id:
+                        continue
+                    stream = self.open_stream(stream_id)
+                stream.feed(data)
+        except (OSError, ValueError) as e:
+            log.error(f"@TCP Error - {str(e)}")
+        finally:
+            mux_sessions.discard(self)
+            with self.lock:
+                streams = list(self.streams.values())
+            for stream in streams:
+                stream.end()
+            self.conn.close()
+            session_slots.release()
+            log.info(f"@TCP - Transfer session of {self.user} from "
+                     f"{self.addr} closed after {self.opened} transfers")
+
+    def open_stream(self, stream_id):
+        stream = MuxStream(self, stream_id)
+        with self.lock:
+            if len(self.streams) >= MUX_STREAMS:
+                raise ValueError("Too many session streams")
+            self.streams[stream_id] = stream
+        self.last_id = stream_id
+        self.opened += 1
+        # A transfer like any other connection, and BUSY rather than a
+        # wait when the transfers or the stream workers are all taken
+        if not bandwidth.enter():
+            log.info(f"@TCP - BUSY, {bandwidth.transfers} transfers running")
+            refuse_busy(stream)
+        elif not stream_slots.acquire(blocking=False):
+            bandwidth.leave()
+            log.info(f"@TCP - BUSY, {STREAM_WORKERS} session streams running")
+            refuse_busy(stream)
+        else:
+            stream_pool.submit(self.run_stream, stream)
+        return stream
+
+    def run_stream(self, stream):
+        try:
+            file_transfer(stream, self.addr, user=self.user, admitted=True)
+        finally:
+            stream_slots.release()
+
+
+def open_session(conn, addr, names, token):
+    # The token from SES proves the user is logged in from this address
+    user = names[0] if len(names) == 1 else None
+    logged_in = active_users.get(user) if user else None
+    if logged_in is None or logged_in[0] != addr[0] or \
+            not hmac.compare_digest(token, session_token(user, addr[0])):
+        log.info(f"@TCP - Transfer session refused for {addr}")
+        return reject_transfer(conn, "Transfer session not authorized")
+    if not session_slots.acquire(blocking=False):
+        log.info(f"@TCP - BUSY, {MAX_SESSIONS} transfer sessions open")
+        send_transfer_header(conn, STATUS_ERROR, names=[
+            f"{BUSY_REPLY}{TRANSFER_RETRY_AFTER}"])
+        return False
+    try:
+        send_transfer_header(conn, STATUS_OK)
+    except OSError:
+        session_slots.release()
+        raise
+    log.info(f"@TCP - Transfer session of {user} from {addr}")
+    if isinstance(conn, socket):
+        # Frames are written as soon as they are ready, do not let Nagle
+        # hold a small one back waiting for an ACK
+        conn.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+    # An idle session gives its slot back soon, the client reopens it
+    conn.settimeout(MUX_IDLE_TIMEOUT)
+    # Served on a thread of its own, so it does not hold a transfer worker
+    # (or a --max-transfers slot) while it waits for the next stream
+    Thread(target=MuxSession(conn, addr, user).serve, daemon=True).start()
+    return True
+
+
+def relay_stream(stream, owner, request, addr):
+    # A session stream has no descriptor to hand over: the owner gets one
+    # end of a socket pair instead, and the bytes are pumped across
+    ours, theirs = socketpair()
+    with theirs:
+        peers.hand_over(owner, theirs, request, addr)
+
+    def pump_back():
+        try:
+            while True:
+                data = ours.recv(TRANSFER_CHUNK)
+                if not data:
+                    break
+                stream.sendall(data)
+        except OSError:
+            pass
+        stream.end()
+
+    back = Thread(target=pump_back, daemon=True)
+    back.start()
     try:
         while True:
-            time.sleep(7200)
+            data = stream.recv(TRANSFER_CHUNK)
+            if not data:
+                break
+            ours.sendall(data)
+        ours.shutdown(SHUT_WR)
+        back.join()
+    finally:
+        ours.close()
+    return False
+
+
+class StreamConn:
+    """
+    Blocking socket-like view of an asyncio stream, so file_transfer() can
+    run unchanged in a worker thread while the event loop owns the socket.
+    """
+
+    def __init__(self, reader, writer, loop):
+        self.reader = reader
+        self.writer = writer
+        self.loop = loop
+        self.timeout = None
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def _send(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def _close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def recv(self, bufsize):
+        try:
+            return self._run(asyncio.wait_for(self.reader.read(bufsize),
+                                              self.timeout))
+        except asyncio.TimeoutError:
+            raise timeout("timed out")
+
+    def recv_into(self, buffer, nbytes=0):
+        data = self.recv(nbytes or len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def sendall(self, data):
+        self._run(self._send(data))
+
+    def sendfile(self, file, offset=0, count=None):
+        return self._run(self.loop.sendfile(
+            self.writer.transport, file, offset, count))
+
+    def close(self):
+        self._run(self._close())
+
+
+class ForumDatagramProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        # Pushes are sent from the pusher thread
+        loop = asyncio.get_running_loop()
+        pushes.send = lambda data, addr: loop.call_soon_threadsafe(
+            transport.sendto, data, addr)
+
+    def datagram_received(self, data, addr):
+        busy = admit(data, addr)
+        if busy is not None:
+            self.transport.sendto(busy, addr)
+            return
+        future = asyncio.wrap_future(
+            enqueue(self.pool, handle_datagram, data, addr))
+        future.add_done_callback(lambda f: self.reply(f, addr))
+
+    def reply(self, future, addr):
+        if future.cancelled() or future.exception() is not None:
+            return
+        for datagram in future.result():
+            self.transport.sendto(datagram, addr)
+
+
+async def async_server():
+    loop = asyncio.get_running_loop()
+    command_pool = ThreadPoolExecutor(max_workers=COMMAND_WORKERS)
+    transfer_pool = ThreadPoolExecutor(max_workers=TRANSFER_WORKERS)
+
+    async def handle_transfer(reader, writer):
+        conn = StreamConn(reader, writer, loop)
+        addr = writer.get_extra_info("peername")
+        await loop.run_in_executor(transfer_pool, file_transfer, conn, addr)
+
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: ForumDatagramProtocol(command_pool),
+        local_addr=("0.0.0.0", serverPort))
+    log.info(f"@UDP Server listening on port {serverPort}...")
+    tcp = await asyncio.start_server(handle_transfer, "", serverPort)
+    log.info(f"@TCP Server listening on port {serverPort}...")
+    try:
+        async with tcp:
+            await tcp.serve_forever()
+    finally:
+        transport.close()
+        command_pool.shutdown(wait=False)
+        transfer_pool.shutdown(wait=False)
+
+
+def parse_rate(text):
+    # "50M" -> 50 * 1024 ** 2; plain numbers are bytes
+    scale = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}.get(text[-1:].upper())
+    try:
+        return int(float(text[:-1] if scale else text) * (scale or 1))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid rate: {text}")
+
+
+def setup_logging(level="INFO", prefix=""):
+    # Records are queued and written to stdout by a listener thread, so a
+    # request never waits on the terminal; "OFF" drops them all
+    global log_listener, log_level
+    log.handlers.clear()
+    log_listener = None
+    log_level = level
+    if level == "OFF":
+        log.addHandler(logging.NullHandler())
+        log.setLevel(logging.CRITICAL + 1)
+        return
+    records = queue.SimpleQueue()
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(logging.Formatter(prefix + "%(message)s"))
+    log.addHandler(QueueHandler(records))
+    log.setLevel(level)
+    log.propagate = False
+    log_listener = QueueListener(records, console)
+    log_listener.start()
+
+
+def start_server(engine="threads", credentials_db=None, stats_file=None,
+                 stats_interval=STATS_INTERVAL):
+    log.info("=== Starting server... ===")
+    load_credentials(credentials_db)
+    if peers is None:
+        migrate_layout()
+        # Logs of an earlier --workers run
+        fold_logs(os.listdir(), keep=wal.prefix)
+    load_threads()
+    compact_threads()
+    Thread(target=compactor, daemon=True).start()
+    Thread(target=session_reaper, daemon=True).start()
+    Thread(target=pushes.run, daemon=True).start()
+    if stats_file:
+        Thread(target=stats_dumper, args=(stats_file, stats_interval),
+               daemon=True).start()
+    log.info(f"Server started ({engine} engine). Press Ctrl+C to shut down.")
+    try:
+        if engine == "asyncio":
+            asyncio.run(async_server())
+        else:
+            udpThread = Thread(target=udp_server, daemon=True)
+            udpThread.start()
+            tcpThread = Thread(target=tcp_server, daemon=True)
+            tcpThread.start()
+            while True:
+                time.sleep(7200)
     except KeyboardInterrupt:
-        print("\nShutting down server...")
+        log.info("\nShutting down server...")
+        compact_threads()
+        wal.close()
+        credentials.close()
+        if log_listener:
+            log_listener.stop()
+
+
+def stop_server(signum, frame):
+    # SIGTERM shuts down like Ctrl+C
+    raise KeyboardInterrupt
+
+
+def watch_parent(pid):
+    # A worker stops with the process that started it
+    while os.getppid() == pid:
+        time.sleep(1)
+    os.kill(os.getpid(), signal.SIGTERM)
+
+
+def worker_main(index, links, credentials_db, stats_file, stats_interval):
+    global shard, shard_count, peers, wal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the parent relays Ctrl+C
+    signal.signal(signal.SIGTERM, stop_server)
+    setup_logging(log_level, f"[worker {index}] ")
+    shard, shard_count, peers = index, len(links), links[index]
+    for link in links:
+        if link is not peers:
+            link.close()
+    wal = WriteAheadLog(f"{WAL_PREFIX}-{index}")
+    sessions.replicate = peers.replicate
+    Thread(target=watch_parent, args=(os.getppid(),), daemon=True).start()
+    start_server("threads", credentials_db, stats_file, stats_interval)
+
+
+def run_workers(count, credentials_db=None, stats_file=None,
+                stats_interval=STATS_INTERVAL):
+    # --workers N: N processes bind the port with SO_REUSEPORT and the
+    # kernel spreads clients over them. Each owns the titles and users
+    # hashing to it and passes everything else on (see ShardPeers).
+    log.info(f"=== Starting {count} workers... ===")
+    # Each worker opens the credentials itself, migrate_layout() only
+    # asks who the users are
+    load_credentials(credentials_db)
+    migrate_layout()
+    credentials.close()
+    sweep_partial_uploads(thread_titles())
+    fold_logs(os.listdir())
+    directory = tempfile.mkdtemp(prefix="forum-")
+    links = [ShardPeers(directory, index, count) for index in range(count)]
+    context = multiprocessing.get_context("fork")
+    processes = []
+    for index in range(count):
+        worker_stats = None
+        if stats_file:
+            root, ext = os.path.splitext(stats_file)
+            worker_stats = f"{root}-{index}{ext}"
+        processes.append(context.Process(
+            target=worker_main, name=f"worker-{index}",
+            args=(index, links, credentials_db, worker_stats, stats_interval)))
+    sys.stdout.flush()
+    for process in processes:
+        process.start()
+    for link in links:
+        link.close()
+    signal.signal(signal.SIGTERM, stop_server)
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        log.info("\nShutting down workers...")
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+        if log_listener:
+            log_listener.stop()
 
 
 if __name__ == "__main__":
-    start_server()
+    parser = argparse.ArgumentParser(description="Forum Application Server")
+    parser.add_argument("port", type=int, help="SERVER_PORT")
+    parser.add_argument("--engine", choices=["threads", "asyncio"],
+                        default="threads",
+                        help="thread pool (default) or asyncio event loop")
+    parser.add_argument("--credentials-db", metavar="FILE",
+                        help="keep users in this SQLite database instead "
+                             f"of {CREDENTIALS_FILE}")
+    parser.add_argument("--log-level", default="INFO",
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR", "OFF"],
+                        help="DEBUG adds a line per request (default INFO)")
+    parser.add_argument("--stats-file", metavar="FILE",
+                        help="write STATS as JSON to FILE periodically")
+    parser.add_argument("--stats-interval", type=float, default=STATS_INTERVAL,
+                        metavar="SECONDS",
+                        help=f"seconds between dumps (default {STATS_INTERVAL})")
+    parser.add_argument("--workers", type=int, default=1, metavar="N",
+                        help="processes sharing the port, threads engine only")
+    parser.add_argument("--rate", type=float, default=RATE_LIMIT,
+                        metavar="N",
+                        help="commands per second per user, 0 for no limit "
+                             f"(default {RATE_LIMIT})")
+    parser.add_argument("--burst", type=int, default=RATE_BURST, metavar="N",
+                        help=f"commands a user may send at once "
+                             f"(default {RATE_BURST})")
+    parser.add_argument("--max-queue", type=int, default=MAX_QUEUED_DATAGRAMS,
+                        metavar="N",
+                        help="datagrams waiting for a worker before clients "
+                             f"are told BUSY (default {MAX_QUEUED_DATAGRAMS})")
+    parser.add_argument("--bandwidth", type=parse_rate, default=BANDWIDTH_LIMIT,
+                        metavar="RATE",
+                        help="bytes/s shared fairly by all transfers, e.g. "
+                             "50M (default no limit)")
+    parser.add_argument("--user-bandwidth", type=parse_rate,
+                        default=USER_BANDWIDTH, metavar="RATE",
+                        help="bytes/s cap on each user's transfers")
+    parser.add_argument("--max-transfers", type=int, default=MAX_TRANSFERS,
+                        metavar="N",
+                        help="transfer connections served at once "
+                             f"(default {MAX_TRANSFERS})")
+    parser.add_argument("--no-search-cache", action="store_true",
+                        help="rebuild the SRC index at startup instead of "
+                             "saving it with the snapshots")
+    parser.add_argument("--admin", action="append", default=[],
+                        metavar="USER",
+                        help="user allowed to run STATS remotely (repeatable)")
+    cli = parser.parse_args()
+    if cli.workers > 1 and cli.engine != "threads":
+        parser.error("--workers runs the threads engine")
+    serverPort = cli.port
+    admins.update(cli.admin)
+    search_cache = not cli.no_search_cache
+    admission = AdmissionControl(cli.rate, cli.burst, cli.max_queue)
+    bandwidth = BandwidthScheduler(cli.bandwidth, cli.user_bandwidth,
+                                   cli.max_transfers)
+    setup_logging(cli.log_level)
+    if cli.workers > 1:
+        run_workers(cli.workers, cli.credentials_db, cli.stats_file,
+                    cli.stats_interval)
+    else:
+        start_server(cli.engine, cli.credentials_db, cli.stats_file,
+                     cli.stats_interval)
 
 # python server.py 8888
 # python client.py 127.0.0.1 8888
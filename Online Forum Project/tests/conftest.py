@@ -0,0 +1,87 @@
+"""
+"conftest.py"
+Shared fixtures: a forum server's storage in a scratch directory and a
+transfer listener in front of it
+"""
+
+from socket import *
+from threading import Thread
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "src"))
+
+import server
+
+
+class Forum:
+    """
+    The server module's storage state, run in a scratch directory.
+    restart() drops everything in memory and loads it back from disk, as
+    a new server process would; crash=True skips the clean WAL close.
+    """
+
+    def __init__(self, workdir):
+        self.workdir = workdir
+        self.start()
+
+    def start(self):
+        server.thread_metadata.clear()
+        server.dirty_threads.clear()
+        server.response_cache = server.ResponseCache(
+            server.RESPONSE_CACHE_BYTES)
+        server.wal = server.WriteAheadLog(server.WAL_PREFIX)
+        server.thread_locks = server.LockManager()
+        server.load_threads()
+
+    def restart(self, crash=False):
+        if crash:
+            # The process died: whatever was fsynced is all that is left
+            server.wal.file.close()
+        else:
+            server.wal.close()
+        self.start()
+
+    def files(self):
+        return sorted(os.listdir(self.workdir))
+
+
+@pytest.fixture
+def forum(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    forum = Forum(str(tmp_path))
+    yield forum
+    server.wal.close()
+
+
+@pytest.fixture
+def transfers(forum):
+    # A transfer listener on loopback serving file_transfer()
+    listener = socket(AF_INET, SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(8)
+
+    def serve():
+        while True:
+            try:
+                conn, addr = listener.accept()
+            except OSError:
+                return
+            Thread(target=server.file_transfer, args=(conn, addr),
+                   daemon=True).start()
+
+    Thread(target=serve, daemon=True).start()
+    yield listener.getsockname()
+    listener.close()
+
+
+def download(address, user, title, fname, result):
+    with create_connection(address) as sock:
+        server.send_transfer_header(sock, server.OP_DOWNLOAD,
+                                    names=[user, title, fname])
+        header = server.recv_exact(sock, server.TRANSFER_HEADER.size)
+        size = server.TRANSFER_HEADER.unpack(header)[4]
+        server.recv_exact(sock, server.TRANSFER_HEADER.unpack(header)[6])
+        result.append(len(server.recv_exact(sock, size)))
@@ -0,0 +1,46 @@
+"""
+"test_bandwidth.py"
+Fair-share transfer throttling and who it is charged to
+"""
+
+from threading import Thread
+import os
+import time
+
+from conftest import download
+import server
+
+
+def test_made_up_names_share_one_account(forum, transfers, monkeypatch):
+    rate = 1024 * 1024
+    monkeypatch.setattr(server, "bandwidth",
+                        server.BandwidthScheduler(0, rate, 8))
+    server.create_thread("alice", None, "net")
+    path = server.attachment_path("net", "data.bin")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(os.urandom(rate))
+    received = []
+    clients = [Thread(target=download,
+                      args=(transfers, name, "net", "data.bin", received))
+               for name in ("mallory", "not-mallory")]
+    start = time.monotonic()
+    for client in clients:
+        client.start()
+    while server.bandwidth.transfers < 2 and time.monotonic() - start < 5:
+        time.sleep(0.01)
+    # Both connections come from 127.0.0.1 and neither name is verified
+    assert len(server.bandwidth.users) == 1
+    for client in clients:
+        client.join(10)
+    assert received == [rate, rate]
+    # Two files at one share of `rate` take about two seconds, not one
+    assert time.monotonic() - start > 1.5
+
+
+def test_session_user_is_its_own_account():
+    assert server.bandwidth_account(("10.0.0.1", 4000), "alice") == "alice"
+    assert server.bandwidth_account(("10.0.0.1", 4001), None) == \
+        server.bandwidth_account(("10.0.0.1", 4002), None)
+    assert server.bandwidth_account(("10.0.0.1", 4000), None) != \
+        server.bandwidth_account(("10.0.0.2", 4000), None)
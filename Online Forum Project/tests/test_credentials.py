@@ -0,0 +1,52 @@
+"""
+"test_credentials.py"
+Password records and the AUTH verification cache
+"""
+
+import hashlib
+
+import server
+
+
+def test_verify_caches_only_successes(tmp_path):
+    store = server.CredentialStore(str(tmp_path / "credentials.txt"))
+    store.load()
+    assert store.register("alice", "s3cret")
+    assert not store.verify("alice", "wrong")
+    assert not store.verify("alice", "wrong")
+    assert not store.verified
+    assert store.verify("alice", "s3cret")
+    assert len(store.verified) == 1
+    assert store.verify("alice", "s3cret")
+    store.close()
+
+
+def test_cache_key_needs_the_process_secret(tmp_path):
+    store = server.CredentialStore(str(tmp_path / "credentials.txt"))
+    store.load()
+    store.register("alice", "s3cret")
+    store.verify("alice", "s3cret")
+    record = store.lookup("alice")
+    (_, digest), = store.verified
+    # A plain digest of what is on disk plus a guess does not match
+    assert digest != hashlib.sha256(f"{record}\0s3cret".encode()).digest()
+    other = server.CredentialStore(store.fname)
+    assert other.cache_key("alice", record, "s3cret") != \
+        store.cache_key("alice", record, "s3cret")
+    store.close()
+
+
+def test_plaintext_record_upgraded_on_login(tmp_path):
+    path = tmp_path / "credentials.txt"
+    path.write_text("bob hunter2\n")
+    store = server.CredentialStore(str(path))
+    store.load()
+    assert store.verify("bob", "hunter2")
+    assert store.lookup("bob").startswith("pbkdf2_sha256$")
+    assert store.verify("bob", "hunter2")
+    store.close()
+    reloaded = server.CredentialStore(str(path))
+    reloaded.load()
+    assert reloaded.verify("bob", "hunter2")
+    assert not reloaded.verify("bob", "hunter3")
+    reloaded.close()
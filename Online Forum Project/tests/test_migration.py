@@ -0,0 +1,78 @@
+"""
+"test_migration.py"
+Moving a store in the old flat layout under threads/
+"""
+
+import json
+import os
+
+import pytest
+
+from conftest import Forum
+import server
+
+
+@pytest.fixture
+def flat(tmp_path, monkeypatch):
+    # A working directory as the old server left it, users alice and bob
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "credentials.txt").write_text("alice pw1\nbob pw2\n")
+    store = server.CredentialStore("credentials.txt")
+    store.load()
+    monkeypatch.setattr(server, "credentials", store)
+    yield tmp_path
+    store.close()
+    if server.wal.file:
+        server.wal.close()
+
+
+def test_flat_store_moved(flat):
+    (flat / "net").write_text("alice\n1 alice: hello\n"
+                              "bob uploaded notes.txt\n2 bob: hi\n")
+    (flat / "net-notes.txt").write_text("attached")
+    (flat / "net-big.bin.part").write_text("half")
+    server.migrate_layout()
+    assert not (flat / "net").exists()
+    assert not (flat / "net-notes.txt").exists()
+    assert not (flat / "net-big.bin.part").exists()
+    Forum(str(flat))
+    meta = server.thread_metadata["net"]
+    assert meta["owner"] == "alice"
+    assert [m["content"] for m in meta["messages"]] == ["hello", "hi"]
+    with open(server.attachment_path("net", "notes.txt")) as f:
+        assert f.read() == "attached"
+
+
+def test_other_files_left_alone(flat):
+    files = {"pid": "12345\n", "Makefile": "all:\n\techo hi\n",
+             "LICENSE": "MIT License\n\nCopyright\n",
+             "stray": "mallory\n1 mallory: not a user here\n",
+             "other-y.part": "partial"}
+    for name, content in files.items():
+        (flat / name).write_text(content)
+    server.migrate_layout()
+    for name, content in files.items():
+        assert (flat / name).read_text() == content
+    assert not (flat / server.THREAD_DIR).exists()
+    Forum(str(flat))
+    assert not server.thread_metadata
+
+
+def test_owner_vouched_for_by_old_log(flat):
+    # Owner unknown to the credentials, but the old log wrote the thread
+    (flat / "net").write_text("carol 1\n1 carol: from the log\n")
+    (flat / f"{server.WAL_PREFIX}.000001").write_text(json.dumps(
+        {"op": "CRT", "t": "net", "u": "carol", "lsn": 1}) + "\n")
+    (flat / "pid").write_text("12345\n")
+    server.migrate_layout()
+    assert (flat / "pid").exists()
+    Forum(str(flat))
+    assert list(server.thread_metadata) == ["net"]
+    assert server.thread_metadata["net"]["owner"] == "carol"
+
+
+def test_empty_directory(flat):
+    os.remove(flat / "credentials.txt")
+    server.migrate_layout()
+    Forum(str(flat))
+    assert not server.thread_metadata
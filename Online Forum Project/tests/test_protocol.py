@@ -0,0 +1,57 @@
+"""
+"test_protocol.py"
+Text and binary command decoding
+"""
+
+import pytest
+
+import client
+import server
+
+
+@pytest.fixture(autouse=True)
+def user(monkeypatch):
+    monkeypatch.setattr(client, "current_user", "alice")
+
+
+@pytest.mark.parametrize("command, fields", [
+    ("MSG", ["net", "the quick brown fox"]),
+    ("RDT", ["net", "41", "20", "7"]),
+    ("RDT", ["net", "", "", ""]),
+    ("EDT", ["net", "3", "fixed: a typo"]),
+    ("DLT", ["net", "3"]),
+    ("CRT", ["net"]),
+    ("LST", ["12"]),
+    ("SRC", ["quick fox", "21", ""]),
+    ("XIT", []),
+])
+def test_text_and_binary_decode_alike(command, fields):
+    text = client.text_command(command, fields).encode()
+    binary = client.encode_command(command, fields)
+    assert server.decode_command(text) == (command, fields)
+    assert server.decode_command(binary) == (command, fields)
+
+
+def test_text_options():
+    assert server.decode_command(b"SRC fox from 2") == \
+        ("SRC", ["fox", "2", ""])
+    assert server.decode_command(b"RDT net count 5 from 3") == \
+        ("RDT", ["net", "3", "5", ""])
+    # Option words inside free text are text
+    assert server.decode_command(b"MSG alice net meet me from 2") == \
+        ("MSG", ["net", "meet me from 2"])
+    # Only ASCII digits make an option value
+    assert server.decode_command("SRC fox from ²".encode()) == \
+        ("SRC", ["fox from ²", "", ""])
+
+
+def test_invalid_commands():
+    assert server.decode_command(b"DLT alice net") == ("DLT", None)
+    assert server.decode_command(
+        client.encode_command("RDT", ["net", "²", "", ""])) == ("RDT", None)
+    assert server.decode_command(
+        client.encode_command("RDT", ["net", "1"])) == ("RDT", None)
+    data = client.encode_command("MSG", ["net", "hello"])
+    for end in range(len(data)):
+        assert server.decode_command(data[:end])[1] is None
+    assert server.decode_command(b"\0\xff\0") == ("", None)
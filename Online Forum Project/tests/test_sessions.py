@@ -0,0 +1,88 @@
+"""
+"test_sessions.py"
+Transfer sessions: slots, stream admission and idle timeout
+"""
+
+from threading import BoundedSemaphore
+import os
+import time
+
+import pytest
+
+from conftest import download
+import client
+import server
+
+
+@pytest.fixture
+def logins():
+    # Users logged in from loopback, as AUTH would leave them
+    names = []
+
+    def login(name):
+        server.sessions.login(name, ("127.0.0.1", 40000 + len(names)))
+        names.append(name)
+        return server.session_token(name, "127.0.0.1")
+
+    yield login
+    for name in names:
+        server.sessions.logout(name)
+
+
+def wait_for(condition, limit=5):
+    end = time.monotonic() + limit
+    while not condition() and time.monotonic() < end:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_idle_sessions_hold_no_transfer_slots(forum, transfers, logins,
+                                              monkeypatch):
+    monkeypatch.setattr(server, "bandwidth",
+                        server.BandwidthScheduler(0, 0, 2))
+    server.create_thread("alice", None, "net")
+    path = server.attachment_path("net", "data.bin")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(b"x" * 1000)
+    opened = [client.TransferSession(transfers, name, logins(name))
+              for name in ("alice", "bob", "carol")]
+    assert wait_for(lambda: len(server.mux_sessions) == 3)
+    # Each opening connection gives its slot back once the session runs
+    assert wait_for(lambda: server.bandwidth.transfers == 0)
+    # More sessions than --max-transfers, and a plain transfer still runs
+    received = []
+    download(transfers, "dave", "net", "data.bin", received)
+    assert received == [1000]
+    for session in opened:
+        session.close()
+
+
+def test_stream_busy_when_workers_taken(forum, transfers, logins,
+                                        monkeypatch):
+    monkeypatch.setattr(server, "stream_slots", BoundedSemaphore(1))
+    server.stream_slots.acquire()
+    session = client.TransferSession(transfers, "alice", logins("alice"))
+    stream = session.open_stream()
+    client.send_transfer_header(stream, client.OP_STAT,
+                                names=("alice", "net", "data.bin"))
+    with pytest.raises(client.ServerBusy):
+        client.read_transfer_reply(stream)
+    assert server.bandwidth.transfers == 0
+    session.close()
+    server.stream_slots.release()
+
+
+def test_session_slots_and_idle_timeout(forum, transfers, logins,
+                                        monkeypatch):
+    monkeypatch.setattr(server, "session_slots", BoundedSemaphore(1))
+    monkeypatch.setattr(server, "MUX_IDLE_TIMEOUT", 0.3)
+    first = client.TransferSession(transfers, "alice", logins("alice"))
+    with pytest.raises(client.ServerBusy):
+        client.TransferSession(transfers, "bob", logins("bob"))
+    # The idle session is closed and gives its slot back
+    assert wait_for(lambda: not server.mux_sessions)
+    second = client.TransferSession(transfers, "bob", logins("bob"))
+    assert wait_for(lambda: len(server.mux_sessions) == 1)
+    first.close()
+    second.close()
@@ -0,0 +1,159 @@
+"""
+"test_storage.py"
+Write-ahead log replay, segment rotation and compaction into snapshots
+"""
+
+from threading import Event, Thread
+import os
+
+import server
+
+
+def messages(title):
+    return [(m["user"], m["content"])
+            for m in server.thread_metadata[title]["messages"]]
+
+
+def segments(forum):
+    return [f for f in forum.files() if f.startswith(server.WAL_PREFIX)]
+
+
+def test_replay_after_crash(forum):
+    server.create_thread("alice", None, "net")
+    server.post_message("alice", None, "net", "first")
+    server.post_message("bob", None, "net", "second")
+    server.edit_message("alice", None, "net", "1", "first, edited")
+    server.post_message("bob", None, "net", "third")
+    server.delete_message("bob", None, "net", "2")
+    forum.restart(crash=True)
+    assert messages("net") == [("alice", "first, edited"), ("bob", "third")]
+    assert server.thread_metadata["net"]["owner"] == "alice"
+
+
+def test_replay_skips_torn_tail(forum):
+    server.create_thread("alice", None, "net")
+    server.post_message("alice", None, "net", "kept")
+    server.wal.file.write('{"op": "MSG", "t": "net", "u": "alice"')
+    forum.restart(crash=True)
+    assert messages("net") == [("alice", "kept")]
+    # Later writes still replay after the torn record
+    server.post_message("alice", None, "net", "after")
+    forum.restart(crash=True)
+    assert messages("net") == [("alice", "kept"), ("alice", "after")]
+
+
+def test_compaction_drops_sealed_segments(forum):
+    server.create_thread("alice", None, "net")
+    server.post_message("alice", None, "net", "hello")
+    server.create_thread("bob", None, "gone")
+    server.remove_thread("bob", None, "gone")
+    server.compact_threads()
+    # Only the fresh segment is left, and the snapshot holds the rest
+    assert len(segments(forum)) == 1
+    assert os.path.isfile(server.thread_path("net", "thread"))
+    assert not os.path.exists(server.thread_path("gone"))
+    assert not server.dirty_threads
+    forum.restart()
+    assert messages("net") == [("alice", "hello")]
+    assert "gone" not in server.thread_metadata
+
+
+def test_replay_on_top_of_snapshot(forum):
+    server.create_thread("alice", None, "net")
+    server.post_message("alice", None, "net", "one")
+    server.compact_threads()
+    server.post_message("bob", None, "net", "two")
+    server.delete_message("alice", None, "net", "1")
+    forum.restart(crash=True)
+    assert messages("net") == [("bob", "two")]
+    # Records the snapshot already holds are not applied twice
+    server.compact_threads()
+    forum.restart(crash=True)
+    assert messages("net") == [("bob", "two")]
+
+
+def test_write_racing_compaction_survives(forum, monkeypatch):
+    # The writer is paused after its record is in the log but before it is
+    # applied, while compaction seals and drops that segment
+    server.create_thread("alice", None, "net")
+    server.compact_threads()
+    appended, resume = Event(), Event()
+    apply_record = server.apply_record
+
+    def paused_apply(record):
+        appended.set()
+        resume.wait(5)
+        apply_record(record)
+
+    monkeypatch.setattr(server, "apply_record", paused_apply)
+    writer = Thread(target=server.post_message,
+                    args=("alice", None, "net", "acknowledged"))
+    writer.start()
+    assert appended.wait(5)
+    sealed = len(server.wal.sealed)
+    compactor = Thread(target=server.compact_threads)
+    compactor.start()
+    # Let compaction rotate the log before the record is applied
+    for _ in range(500):
+        if len(server.wal.sealed) > sealed:
+            break
+        compactor.join(0.01)
+    resume.set()
+    writer.join(5)
+    compactor.join(5)
+    monkeypatch.setattr(server, "apply_record", apply_record)
+    forum.restart(crash=True)
+    assert messages("net") == [("alice", "acknowledged")]
+
+
+def thread_state(title):
+    # Everything a snapshot has to carry, without the in-memory ids
+    meta = server.thread_metadata[title]
+    lines = [{k: v for k, v in entry.items() if k != "id"}
+             for entry in meta["lines"]]
+    return meta["owner"], meta["lsn"], lines, meta["files"]
+
+
+def test_snapshot_round_trip(forum):
+    server.create_thread("alice", None, "net")
+    for user, content in [("alice", "a: b"),
+                          ("bob", "2 bob: not a second message"),
+                          ("carol", "carol uploaded notes.txt"),
+                          ("bob", "  spaced out  "),
+                          ("alice", "ünïcödé ✓ ends with: "),
+                          ("carol", "gone soon")]:
+        server.post_message(user, None, "net", content)
+    with server.thread_locks.writing("net"):
+        lsn = server.log_mutation({"op": "UPD", "t": "net", "u": "bob",
+                                   "f": "notes.txt", "b": "0" * 64})
+    server.wal.sync(lsn)
+    server.post_message("alice", None, "net", "after the upload")
+    server.edit_message("bob", None, "net", "4", "edited: 1 alice: x")
+    server.delete_message("carol", None, "net", "6")
+    before = thread_state("net")
+    server.compact_threads()
+    forum.restart()
+    assert thread_state("net") == before
+    # And again from the snapshot the reload just wrote
+    server.dirty_threads.add("net")
+    server.compact_threads()
+    forum.restart()
+    assert thread_state("net") == before
+
+
+def test_control_characters_rejected(forum):
+    server.create_thread("alice", None, "net")
+    server.post_message("alice", None, "net", "hello")
+    forged = "hi\n1 bob: I never wrote this"
+    assert server.post_message("alice", None, "net", forged).startswith(
+        "ERROR")
+    assert server.edit_message("alice", None, "net", "1", forged).startswith(
+        "ERROR")
+    assert server.post_message("alice", None, "net", "a\rb").startswith(
+        "ERROR")
+    assert server.create_thread("alice", None, "bad\ntitle").startswith(
+        "ERROR")
+    server.compact_threads()
+    forum.restart()
+    assert messages("net") == [("alice", "hello")]
+    assert list(server.thread_metadata) == ["net"]